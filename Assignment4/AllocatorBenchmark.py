@@ -0,0 +1,40 @@
+from Memory import Memory, page_size
+from typing import List
+import sys
+import time
+
+
+def time_batches(memory: Memory, total_pages: int, batch_size: int) -> List[float]:
+    """
+    Allocate total_pages single pages, return the mean cost in microseconds of an allocation in every batch
+    """
+    costs = []
+    for _ in range(total_pages // batch_size):
+        start = time.perf_counter()
+        for _ in range(batch_size):
+            memory.allocate_page(page_size)
+        costs.append((time.perf_counter() - start) / batch_size * 1e6)
+    return costs
+
+
+def benchmark(total_pages: int = 1000000, batch_size: int = 100000) -> None:
+    memory = Memory(start_address=0)
+
+    # Fill memory, the cost per allocation should not grow with the number of allocated pages
+    for index, cost in enumerate(time_batches(memory, total_pages, batch_size)):
+        print(f"allocate {(index + 1) * batch_size:>8} pages: {cost:6.2f} us/page")
+
+    # Punch a hole every other page, then refill the holes, each one is the first extent in turn
+    start = time.perf_counter()
+    for page in range(1, total_pages, 2):
+        memory.free_page(page)
+    print(f"free     {total_pages // 2:>8} pages: {(time.perf_counter() - start) / (total_pages // 2) * 1e6:6.2f} us/page")
+    print(f"free extents: {len(memory.frames)}")
+
+    for index, cost in enumerate(time_batches(memory, total_pages // 2, batch_size // 2)):
+        print(f"refill   {(index + 1) * batch_size // 2:>8} pages: {cost:6.2f} us/page")
+    print(f"free extents: {len(memory.frames)}")
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
@@ -1,16 +1,26 @@
 from Utils import *
+from array import array
+from bisect import bisect_left
 import math
-from collections import deque
-from typing import List, Tuple, Union
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import random
 
 
 class DirectCacheBase:
     # If it is direct matched, there will be no replace algorithm
-    def __init__(self, cache_size: int, cache_line_size: int, replace_algorithm: CacheReplaceAlgorithm):
+    def __init__(self, cache_size: int, cache_line_size: int, replace_algorithm: CacheReplaceAlgorithm,
+                 store_data: bool = True, victim_cache_size: int = 0):
+        """
+        victim_cache_size lines evicted from a direct mapped cache are kept in a fully associative LRU victim
+        cache, the associative caches do not use it
+        """
         self.cache_size = cache_size
         self.cache_line_size = cache_line_size
         self.replace_algorithm = replace_algorithm
+        # Without data the cache only tracks tags, every payload is stored and read back as None
+        self.store_data = store_data
+        self.victim_cache_size = victim_cache_size
 
         self.cache_line_num = self.cache_size // self.cache_line_size
 
@@ -19,7 +29,10 @@ class DirectCacheBase:
 
         self.hits = 0
         self.misses = 0
-        self.cache: List[Tuple] = [() for _ in range(self.cache_line_num)]
+        self.victim_hits = 0
+        # (address, value, dirty) of every line replaced while it is a list, for the owner to drain
+        self.evictions: Union[None, List[Tuple[int, bytes, bool]]] = None
+        self.flush()
 
     def __contains__(self, item):
         return self.access_cache_free(item)
@@ -30,17 +43,23 @@ class DirectCacheBase:
 
         return index
 
-    def access_cache(self, address: int, value: bytes = None) -> bool:
-
+    def probe(self, address: int) -> int:
+        """
+        Counted lookup, return the slot holding address or -1 on a miss
+        The slot stays valid for read_slot / write_slot until the next replacement
+        """
         index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
         tag: int = address >> (self.offset_bits + self.index_bits)
 
         if self.cache[index] and self.cache[index][0] == tag:
             self.hits += 1
-            return True
+            return index
         else:
             self.misses += 1
-            return False
+            return -1
+
+    def access_cache(self, address: int, value: bytes = None) -> bool:
+        return self.probe(address) >= 0
 
     def access_cache_free(self, address):
         result = self.access_cache(address)
@@ -50,13 +69,87 @@ class DirectCacheBase:
             self.misses -= 1
         return result
 
-    def replace_cache_line(self, address: int, value: bytes):
+    def replace_cache_line(self, address: int, value: bytes, dirty: bool = False) -> Optional[Tuple[int, bytes]]:
+        """
+        Install the line holding address, return (address, value) of the line it evicts if that one was dirty
+        """
         tag: int = address >> (self.offset_bits + self.index_bits)
         replace_index: int = self.get_evict_index(address)
-        self.cache[replace_index] = (tag, value)
+        victim = None
+        if self.evictions is not None and self.cache[replace_index]:
+            self.evictions.append((self.line_address(replace_index), self.cache[replace_index][1],
+                                   bool(self.dirty[replace_index])))
+        if self.victim_cache_size and self.cache[replace_index]:
+            victim = self.evict_to_victim_cache(self.line_address(replace_index), self.cache[replace_index][1],
+                                                self.dirty[replace_index])
+        elif self.dirty[replace_index]:
+            victim = self.line_address(replace_index), self.cache[replace_index][1]
+        self.dirty[replace_index] = dirty
+        self.cache[replace_index] = (tag, value if self.store_data else None)
+        return victim
+
+    def fill_unprobed(self, address: int, value: bytes, dirty: bool = False) -> Optional[Tuple[int, bytes]]:
+        # Install a line no probe of this cache asked for, a prefetch or a line evicted into an exclusive level
+        return self.replace_cache_line(address, value, dirty)
+
+    def evict_to_victim_cache(self, address: int, value: bytes, dirty: bool) -> Optional[Tuple[int, bytes]]:
+        # The evicted line becomes the most recent victim, the least recent one leaves the level
+        self.victim_lines[address] = (value, dirty)
+        if len(self.victim_lines) > self.victim_cache_size:
+            address, (value, dirty) = self.victim_lines.popitem(last=False)
+            if dirty:
+                return address, value
+        return None
+
+    def probe_victim(self, address: int) -> int:
+        """
+        Look up the victim cache after a miss, a hit swaps the line with the one holding its slot
+        return the slot it is now in or -1
+        """
+        entry = self.victim_lines.pop(address - address % self.cache_line_size, None)
+        if entry is None:
+            return -1
+        self.victim_hits += 1
+        # The victim cache just lost a line, the one swapped out takes its place without evicting anything
+        self.replace_cache_line(address, *entry)
+        return self.get_evict_index(address)
+
+    def line_address(self, slot: int) -> int:
+        return (self.cache[slot][0] << self.index_bits | slot) << self.offset_bits
+
+    def locate(self, address: int) -> int:
+        # Uncounted lookup, the slot holding address or -1
+        index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
+        tag: int = address >> (self.offset_bits + self.index_bits)
+        return index if self.cache[index] and self.cache[index][0] == tag else -1
+
+    def mark_dirty(self, slot: int):
+        self.dirty[slot] = 1
+
+    def invalidate(self, slot: int):
+        self.cache[slot] = ()
+        self.dirty[slot] = 0
+
+    def dirty_lines(self) -> List[Tuple[int, bytes]]:
+        # (address, value) of every dirty line, they are clean afterwards
+        lines = []
+        slot = self.dirty.find(1)
+        while slot >= 0:
+            lines.append((self.line_address(slot), self.read_slot(slot)))
+            self.dirty[slot] = 0
+            slot = self.dirty.find(1, slot + 1)
+        for address, (value, dirty) in self.victim_lines.items():
+            if dirty:
+                lines.append((address, value))
+                self.victim_lines[address] = (value, False)
+        return lines
 
     def flush(self):
         self.cache = [() for _ in range(self.cache_line_num)]
+        # Lines written under a write back policy, they go to the next level when evicted
+        self.dirty = bytearray(self.cache_line_num)
+        # Victim cache, line address -> (value, dirty) in LRU order
+        self.victim_lines: OrderedDict = OrderedDict()
         self.helper_queue = deque()
 
     def read_cache(self, address: int):
@@ -67,201 +160,532 @@ class DirectCacheBase:
     def write_cache(self, address: int, value: bytes):
         assert self.access_cache(address)
         index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
-        self.cache[index] = (self.cache[index][0], value)
+        self.write_slot(index, value)
+
+    def read_slot(self, slot: int) -> Union[bytes, None]:
+        return self.cache[slot][1]
+
+    def write_slot(self, slot: int, value: Union[bytes, None]):
+        self.cache[slot] = (self.cache[slot][0], value if self.store_data else None)
+
+
+# Re-reference prediction values of RRIP, a line predicted for the distant future is evicted first
+RRPV_MAX = 3
+RRPV_LONG = RRPV_MAX - 1
+# BRRIP inserts one line in BRRIP_LONG_INTERVAL with a long instead of a distant re-reference prediction
+BRRIP_LONG_INTERVAL = 32
+# Next use of a line that is never accessed again
+NEVER = 1 << 62
+
+# Policies that update their state when a line hits
+HIT_POLICIES = (CacheReplaceAlgorithm.PLRU, CacheReplaceAlgorithm.SRRIP, CacheReplaceAlgorithm.BRRIP,
+                CacheReplaceAlgorithm.LFU)
+
+
+def next_use_positions(lines: List[int]) -> array:
+    """
+    For every position of a sequence of cache line numbers, the position of the next access to the same line,
+    NEVER if there is none
+    """
+    next_use = array('q', [NEVER]) * len(lines)
+    last_seen: Dict[int, int] = {}
+    for position in range(len(lines) - 1, -1, -1):
+        line = lines[position]
+        next_use[position] = last_seen.get(line, NEVER)
+        last_seen[line] = position
+    return next_use
 
 
 class AssociativeCacheBase(DirectCacheBase):
     def __init__(self, associative: Associativity, n_way: int, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
+        """
+        LRU and FIFO keep the order of every set in linked lists, the other policies keep one value per slot in
+        policy_data: the re-reference prediction for SRRIP/BRRIP, the access count for LFU and the position of
+        the next access for OPT. PLRU keeps n_way - 1 tree bits per set and needs a power of two ways
+        """
         self.associative = associative
         self.n_way = n_way
 
+        # OPT replays a recorded sequence of probed lines, probe_log records it when it is a list
+        self.future: Union[None, List[int]] = None
+        self.future_next_use = array('q')
+        # Line -> positions of its probes in the recorded sequence
+        self.future_positions: Dict[int, List[int]] = {}
+        self.future_position = 0
+        self.probe_next_use = NEVER
+        self.probe_log: Union[None, List[int]] = None
+
+        super().__init__(*args, **kwargs)
+
         self.num_sets = self.cache_line_num // self.n_way
         self.index_bits = int(math.log2(self.num_sets))
+        if self.replace_algorithm == CacheReplaceAlgorithm.PLRU:
+            assert self.n_way & (self.n_way - 1) == 0, "Tree PLRU needs a power of two ways"
 
-        self.cache: List[List[tuple]] = [[() for _ in range(self.n_way)] for _ in range(self.num_sets)]
-        self.policy_data = [[0 for _ in range(self.n_way)] for _ in range(self.num_sets)]
-
-    def replace_set_cache_line(self, set_index: int, tag: int, value: bytes):
-        set_cache: List[Tuple] = self.cache[set_index]
-        policy_data: List[int] = self.policy_data[set_index]
-
-        is_full = True
-        empty_n_way = 0
-        for n_way in range(len(set_cache)):
-            if not set_cache[n_way]:
-                is_full = False
-                empty_n_way = n_way
-                break
-
-        if is_full:
-            if self.replace_algorithm == CacheReplaceAlgorithm.Random:
-                replace_index: int = random.randint(0, self.n_way - 1)
-            elif self.replace_algorithm in [CacheReplaceAlgorithm.LRU, CacheReplaceAlgorithm.FIFO]:
-                replace_index: int = policy_data.index(min(policy_data))
+    def flush(self):
+        # Flat (num_sets, n_way) matrices, cache line `way` of set `set_index` is slot set_index * n_way + way
+        slots = self.cache_line_num
+        num_sets = slots // self.n_way
+        self.tags = array('q', [-1]) * slots
+        self.valid = bytearray(slots)
+        self.dirty = bytearray(slots)
+        # Always empty, only direct mapped caches have a victim cache
+        self.victim_lines: OrderedDict = OrderedDict()
+        # Slot of every cached line, keyed by tag << index_bits | set_index, so a lookup does not scan the ways
+        self.line_slots: Dict[int, int] = {}
+
+        # LRU and FIFO keep every set in a circular doubly linked list, least recent first
+        # Node slots + set_index is the head of the list of the set, the victim is the node after it
+        # Empty slots start at the front in way order, so they are filled before anything is evicted
+        self.order_prev: List[int] = []
+        self.order_next: List[int] = []
+        for set_index in range(num_sets):
+            base = set_index * self.n_way
+            ways = list(range(base, base + self.n_way))
+            head = slots + set_index
+            self.order_prev += [head] + ways[:-1]
+            self.order_next += ways[1:] + [head]
+        self.order_prev += [base + self.n_way - 1 for base in range(0, slots, self.n_way)]
+        self.order_next += [base for base in range(0, slots, self.n_way)]
+
+        self.policy_data = array('q', [0]) * slots
+        # Tree PLRU, node i of a set has children 2i + 1 and 2i + 2, a bit set to 1 points the victim right
+        self.plru_bits = bytearray(num_sets * (self.n_way - 1))
+        self.brrip_insertions = 0
+
+        # Payloads live in one preallocated buffer, data_length is -1 for a line stored without payload
+        self.data = bytearray(slots * self.cache_line_size if self.store_data else 0)
+        self.data_view = memoryview(self.data)
+        self.data_length = array('q', [-1]) * slots
+
+    def set_future(self, lines: List[int]):
+        """
+        Lines (address >> offset_bits) of every probe this cache will see, in order, for OPT
+        A probe that does not match the recorded sequence treats its line as never used again
+        """
+        self.future = lines
+        self.future_next_use = next_use_positions(lines)
+        self.future_positions = {}
+        for position, line in enumerate(lines):
+            self.future_positions.setdefault(line, []).append(position)
+        self.future_position = 0
+
+    def find_slot(self, set_index: int, tag: int) -> int:
+        return self.line_slots.get(tag << self.index_bits | set_index, -1)
+
+    def move_to_back(self, slot: int):
+        # Unlink slot and put it back as the most recent line of its set, O(1) whatever the associativity
+        order_prev, order_next = self.order_prev, self.order_next
+        prev_slot, next_slot = order_prev[slot], order_next[slot]
+        order_next[prev_slot] = next_slot
+        order_prev[next_slot] = prev_slot
+
+        head = self.cache_line_num + slot // self.n_way
+        last = order_prev[head]
+        order_next[last] = slot
+        order_prev[slot] = last
+        order_next[slot] = head
+        order_prev[head] = slot
+
+    def move_to_front(self, slot: int):
+        # Unlink slot and make it the next victim of its set
+        order_prev, order_next = self.order_prev, self.order_next
+        prev_slot, next_slot = order_prev[slot], order_next[slot]
+        order_next[prev_slot] = next_slot
+        order_prev[next_slot] = prev_slot
+
+        head = self.cache_line_num + slot // self.n_way
+        first = order_next[head]
+        order_prev[first] = slot
+        order_next[slot] = first
+        order_prev[slot] = head
+        order_next[head] = slot
+
+    def invalidate(self, slot: int):
+        # The empty way is filled before any line of the set is evicted
+        del self.line_slots[self.tags[slot] << self.index_bits | slot // self.n_way]
+        self.tags[slot] = -1
+        self.valid[slot] = 0
+        self.dirty[slot] = 0
+        self.data_length[slot] = -1
+        self.move_to_front(slot)
+
+    def read_slot(self, slot: int) -> Union[bytes, None]:
+        length = self.data_length[slot]
+        if length < 0:
+            return None
+        start = slot * self.cache_line_size
+        return bytes(self.data_view[start:start + length])
+
+    def write_slot(self, slot: int, value: Union[bytes, None]):
+        if value is None or not self.store_data:
+            self.data_length[slot] = -1
+            return
+        assert len(value) <= self.cache_line_size
+        start = slot * self.cache_line_size
+        self.data[start:start + len(value)] = value
+        self.data_length[slot] = len(value)
+
+    def plru_touch(self, slot: int):
+        # Point every node on the path to slot away from it
+        set_index, way = divmod(slot, self.n_way)
+        bits, base = self.plru_bits, set_index * (self.n_way - 1)
+        node, low, span = 0, 0, self.n_way
+        while span > 1:
+            span //= 2
+            if way < low + span:
+                bits[base + node] = 1
+                node = 2 * node + 1
+            else:
+                bits[base + node] = 0
+                low += span
+                node = 2 * node + 2
+
+    def plru_victim(self, set_index: int) -> int:
+        bits, base = self.plru_bits, set_index * (self.n_way - 1)
+        node, low, span = 0, 0, self.n_way
+        while span > 1:
+            span //= 2
+            if bits[base + node]:
+                low += span
+                node = 2 * node + 2
             else:
-                replace_index: int = set_cache.index(()) if () in set_cache else 0
+                node = 2 * node + 1
+        return set_index * self.n_way + low
+
+    def rrip_victim(self, set_index: int) -> int:
+        # First line predicted for the distant future, aging the whole set until there is one
+        base = set_index * self.n_way
+        rrpv = self.policy_data[base:base + self.n_way]
+        oldest = max(rrpv)
+        if oldest < RRPV_MAX:
+            for slot in range(base, base + self.n_way):
+                self.policy_data[slot] += RRPV_MAX - oldest
+        return base + rrpv.index(oldest)
+
+    def victim(self, set_index: int) -> int:
+        base = set_index * self.n_way
+        if self.replace_algorithm == CacheReplaceAlgorithm.Random:
+            return base + random.randint(0, self.n_way - 1)
+        elif self.replace_algorithm == CacheReplaceAlgorithm.PLRU:
+            return self.plru_victim(set_index)
+        elif self.replace_algorithm in [CacheReplaceAlgorithm.SRRIP, CacheReplaceAlgorithm.BRRIP]:
+            return self.rrip_victim(set_index)
+        elif self.replace_algorithm == CacheReplaceAlgorithm.LFU:
+            counts = self.policy_data[base:base + self.n_way]
+            return base + counts.index(min(counts))
+        elif self.replace_algorithm == CacheReplaceAlgorithm.OPT:
+            next_uses = self.policy_data[base:base + self.n_way]
+            return base + next_uses.index(max(next_uses))
+        return base
+
+    def policy_hit(self, slot: int):
+        if self.replace_algorithm == CacheReplaceAlgorithm.PLRU:
+            self.plru_touch(slot)
+        elif self.replace_algorithm == CacheReplaceAlgorithm.LFU:
+            self.policy_data[slot] += 1
         else:
-            replace_index: int = empty_n_way
-
-        set_cache[replace_index] = (tag, value)
-
-        if self.replace_algorithm == CacheReplaceAlgorithm.LRU:
-            policy_data[replace_index] = self.hits
-        elif self.replace_algorithm == CacheReplaceAlgorithm.FIFO:
-            policy_data[replace_index] = self.hits + self.misses
+            self.policy_data[slot] = 0
+
+    def policy_fill(self, slot: int):
+        if self.replace_algorithm == CacheReplaceAlgorithm.PLRU:
+            self.plru_touch(slot)
+        elif self.replace_algorithm == CacheReplaceAlgorithm.SRRIP:
+            self.policy_data[slot] = RRPV_LONG
+        elif self.replace_algorithm == CacheReplaceAlgorithm.BRRIP:
+            self.brrip_insertions += 1
+            self.policy_data[slot] = RRPV_LONG if self.brrip_insertions % BRRIP_LONG_INTERVAL == 0 else RRPV_MAX
+        elif self.replace_algorithm == CacheReplaceAlgorithm.LFU:
+            self.policy_data[slot] = 1
+        elif self.replace_algorithm == CacheReplaceAlgorithm.OPT:
+            self.policy_data[slot] = self.probe_next_use
+
+    def line_address(self, slot: int) -> int:
+        return (self.tags[slot] << self.index_bits | slot // self.n_way) << self.offset_bits
+
+    def locate(self, address: int) -> int:
+        set_index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
+        tag: int = address >> (self.offset_bits + self.index_bits)
+        return self.find_slot(set_index, tag)
+
+    def replace_set_cache_line(self, set_index: int, tag: int, value: bytes,
+                               dirty: bool = False) -> Optional[Tuple[int, bytes]]:
+        if self.replace_algorithm in [CacheReplaceAlgorithm.LRU, CacheReplaceAlgorithm.FIFO]:
+            # The least recent line, or the first empty way, is right after the head of the set
+            replace_slot: int = self.order_next[self.cache_line_num + set_index]
+            self.move_to_back(replace_slot)
         else:
-            policy_data[replace_index] = 0
-
-        self.policy_data[set_index] = policy_data
-        self.cache[set_index] = set_cache
-
-    def access_cache(self, address: int, value: bytes = None) -> bool:
+            base = set_index * self.n_way
+            empty_slot = self.valid.find(0, base, base + self.n_way)
+            replace_slot: int = empty_slot if empty_slot >= 0 else self.victim(set_index)
+            self.policy_fill(replace_slot)
+
+        victim = None
+        if self.valid[replace_slot]:
+            if self.evictions is not None:
+                self.evictions.append((self.line_address(replace_slot), self.read_slot(replace_slot),
+                                       bool(self.dirty[replace_slot])))
+            if self.dirty[replace_slot]:
+                victim = self.line_address(replace_slot), self.read_slot(replace_slot)
+            del self.line_slots[self.tags[replace_slot] << self.index_bits | set_index]
+        self.line_slots[tag << self.index_bits | set_index] = replace_slot
+        self.tags[replace_slot] = tag
+        self.valid[replace_slot] = 1
+        self.dirty[replace_slot] = dirty
+        self.write_slot(replace_slot, value)
+        return victim
+
+    def probe(self, address: int) -> int:
         set_index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
         tag: int = address >> (self.offset_bits + self.index_bits)
 
-        set_cache: List[Tuple] = self.cache[set_index]
-        tags_in_set: List[int] = [line[0] for line in set_cache if line]
+        if self.probe_log is not None:
+            self.probe_log.append(address >> self.offset_bits)
+        if self.future is not None:
+            self.probe_next_use = self.next_use(address >> self.offset_bits)
 
-        if tag in tags_in_set:
-            way: int = tags_in_set.index(tag)
+        slot = self.find_slot(set_index, tag)
+        if slot >= 0:
             self.hits += 1
             if self.replace_algorithm == CacheReplaceAlgorithm.LRU:
-                self.policy_data[set_index][way] = self.hits
-            return True
+                self.move_to_back(slot)
+            elif self.replace_algorithm in HIT_POLICIES:
+                self.policy_hit(slot)
+            elif self.future is not None:
+                self.policy_data[slot] = self.probe_next_use
         else:
             self.misses += 1
-            return False
-            # self.replace_set_cache_line(set_index, tag, value)
+        return slot
+
+    def upcoming_use(self, line: int) -> int:
+        # Position of the next recorded probe of line, without moving through the recorded probes
+        positions = self.future_positions.get(line, ())
+        index = bisect_left(positions, self.future_position)
+        return positions[index] if index < len(positions) else NEVER
+
+    def next_use(self, line: int) -> int:
+        # Advance through the recorded probes, the line is used again at the returned position
+        position = self.future_position
+        self.future_position += 1
+        if position < len(self.future) and self.future[position] == line:
+            return self.future_next_use[position]
+        return NEVER
 
     def read_cache(self, address: int):
-        assert self.access_cache_free(address)
         set_index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
         tag: int = address >> (self.offset_bits + self.index_bits)
-        set_cache: List[Tuple] = self.cache[set_index]
-        tags_in_set: List[int] = [line[0] for line in set_cache if line]
-        way = tags_in_set.index(tag)
-        return set_cache[way][1]
+        slot = self.find_slot(set_index, tag)
+        assert slot >= 0
+        return self.read_slot(slot)
 
     def write_cache(self, address: int, value: bytes):
-        assert self.access_cache_free(address)
         set_index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
         tag: int = address >> (self.offset_bits + self.index_bits)
-        set_cache: List[tuple] = self.cache[set_index]
-        tags_in_set: List[int] = [line[0] for line in set_cache if line]
-        way: int = tags_in_set.index(tag)
-        set_cache[way] = (tag, value)
-        self.cache[set_index] = set_cache
+        slot = self.find_slot(set_index, tag)
+        assert slot >= 0
+        self.write_slot(slot, value)
 
-    def replace_cache_line(self, address: int, value: bytes):
+    def replace_cache_line(self, address: int, value: bytes, dirty: bool = False) -> Optional[Tuple[int, bytes]]:
         set_index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
         tag: int = address >> (self.offset_bits + self.index_bits)
 
-        self.replace_set_cache_line(set_index, tag, value)
+        return self.replace_set_cache_line(set_index, tag, value, dirty)
 
-    def flush(self):
-        self.cache: List[List[tuple]] = [[() for _ in range(self.n_way)] for _ in range(self.num_sets)]
-        self.policy_data = [[0 for _ in range(self.n_way)] for _ in range(self.num_sets)]
+    def fill_unprobed(self, address: int, value: bytes, dirty: bool = False) -> Optional[Tuple[int, bytes]]:
+        # Install a line no probe of this cache asked for, a prefetch or a line evicted into an exclusive level
+        # probe_next_use belongs to the last probed line, OPT ranks this one by its own next recorded probe
+        if self.future is None:
+            return self.replace_cache_line(address, value, dirty)
+        probe_next_use = self.probe_next_use
+        self.probe_next_use = self.upcoming_use(address >> self.offset_bits)
+        victim = self.replace_cache_line(address, value, dirty)
+        self.probe_next_use = probe_next_use
+        return victim
 
     def access_cache_free(self, address):
+        # Lookup that leaves the hit/miss counters and the replacement state untouched
         set_index: int = (address >> self.offset_bits) & ((1 << self.index_bits) - 1)
         tag: int = address >> (self.offset_bits + self.index_bits)
-        set_cache: List[Tuple] = self.cache[set_index]
-        tags_in_set: List[int] = [line[0] for line in set_cache if line]
-
-        if tag not in tags_in_set:
-            return False
-
-        way = tags_in_set.index(tag)
-        before_hit = self.policy_data[set_index][way]
-        result = self.access_cache(address)
-        if result:
-            self.hits -= 1
-            if self.replace_algorithm == CacheReplaceAlgorithm.LRU:
-
-                self.policy_data[set_index][way] = before_hit
+        return self.find_slot(set_index, tag) >= 0
+
+
+class TwoLevelCache:
+    def __init__(self, l1_cache: DirectCacheBase, l2_cache: DirectCacheBase,
+                 write_policy: Optional[WritePolicy] = None, write_allocate: bool = True, shared_l2: bool = False):
+        """
+        Lookup, promotion and fill shared by the two level caches, l1_cache serves the data accesses
+        Without a write policy, writes only update the cached copies and evictions drop them
+        With WriteBack a written line is dirty in L1, an evicted dirty L1 line updates L2 if L2 holds it and
+        memory otherwise, an evicted dirty L2 line goes to memory. With WriteThrough every write also goes to
+        memory. Without write_allocate a write miss goes to memory only and a write hit in L2 stays in L2
+        Memory writes go through write_memory(address, value), set by the owner of the cache
+        A shared L2 is used by the caches of other cores too, a flush only empties the L1
+        """
+        self.l1_cache = l1_cache
+        self.L2Cache = l2_cache
+        self.write_policy = write_policy
+        self.write_allocate = write_allocate
+        self.shared_l2 = shared_l2
+        self.write_memory: Callable[[int, Optional[bytes]], None] = lambda address, value: None
+
+        self.l1_writebacks = 0
+        self.l2_writebacks = 0
+
+    def lookup(self, address: int) -> Tuple[CacheLevel, int]:
+        """
+        One counted tag search per level, return the level holding address and its slot there
+        (CacheLevel.NoCache, -1) on a miss in both levels, then the line is brought in with fill
+        A hit in the victim cache of L1 returns CacheLevel.Victim and the L1 slot the line was swapped into
+        """
+        slot = self.l1_cache.probe(address)
+        if slot >= 0:
+            return CacheLevel.L1, slot
+        if self.l1_cache.victim_cache_size:
+            slot = self.l1_cache.probe_victim(address)
+            if slot >= 0:
+                return CacheLevel.Victim, slot
+        slot = self.L2Cache.probe(address)
+        if slot >= 0:
+            return CacheLevel.L2, slot
+        return CacheLevel.NoCache, -1
+
+    def write_back_l1(self, victim: Tuple[int, bytes]):
+        self.l1_writebacks += 1
+        address, value = victim
+        slot = self.L2Cache.locate(address)
+        if slot >= 0:
+            self.L2Cache.write_slot(slot, value)
+            self.L2Cache.mark_dirty(slot)
         else:
-            self.misses -= 1
-        return result
-
-
-class Level2Cache:
-    def __init__(self, l1_cache_size, l1_cache_line_size, l1_cache_policy, l2_cache_size, l2_cache_line_size,
-                 l2_cache_policy, l2_cache_associativity, l2_n_way):
-        self.L1Cache = DirectCacheBase(cache_size=l1_cache_size, cache_line_size=l1_cache_line_size,
-                                       replace_algorithm=l1_cache_policy)
-        self.L2Cache = AssociativeCacheBase(associative=l2_cache_associativity, n_way=l2_n_way,
-                                            cache_size=l2_cache_size, cache_line_size=l2_cache_line_size,
-                                            replace_algorithm=l2_cache_policy)
+            self.write_memory(address, value)
+
+    def write_back_l2(self, victim: Tuple[int, bytes]):
+        self.l2_writebacks += 1
+        self.write_memory(*victim)
+
+    def read(self, address: int, cache_level: CacheLevel, slot: int) -> Union[bytes, None]:
+        if cache_level != CacheLevel.L2:
+            return self.l1_cache.read_slot(slot)
+        value = self.L2Cache.read_slot(slot)
+        victim = self.l1_cache.replace_cache_line(address, value)
+        if victim is not None:
+            self.write_back_l1(victim)
+        return value
+
+    def write(self, address: int, cache_level: CacheLevel, slot: int, value: bytes):
+        write_back = self.write_policy == WritePolicy.WriteBack
+        if cache_level != CacheLevel.L2:
+            self.l1_cache.write_slot(slot, value)
+            if write_back:
+                self.l1_cache.mark_dirty(slot)
+        else:
+            self.L2Cache.write_slot(slot, value)
+            if self.write_allocate:
+                victim = self.l1_cache.replace_cache_line(address, value, write_back)
+                if victim is not None:
+                    self.write_back_l1(victim)
+            elif write_back:
+                self.L2Cache.mark_dirty(slot)
+        if self.write_policy == WritePolicy.WriteThrough:
+            self.write_memory(address, value)
+
+    def write_miss(self, address: int, value: bytes):
+        # Write to a line no level holds, only used with a write policy
+        if not self.write_allocate:
+            self.write_memory(address, value)
+            return
+        self.fill(address, value, self.write_policy == WritePolicy.WriteBack)
+        if self.write_policy == WritePolicy.WriteThrough:
+            self.write_memory(address, value)
+
+    def fill(self, address: int, value: bytes, dirty: bool = False):
+        victim = self.L2Cache.replace_cache_line(address, value)
+        if victim is not None:
+            self.write_back_l2(victim)
+        victim = self.l1_cache.replace_cache_line(address, value, dirty)
+        if victim is not None:
+            self.write_back_l1(victim)
+
+    def prefetch(self, address: int, value: bytes) -> bool:
+        # Bring a line into L2 unless a level already holds it, return whether it was brought in
+        if self.l1_cache.locate(address) >= 0 or self.L2Cache.locate(address) >= 0:
+            return False
+        victim = self.L2Cache.fill_unprobed(address, value)
+        if victim is not None:
+            self.write_back_l2(victim)
+        return True
 
     def read_cache(self, address: int) -> (int, bytes):
-        if self.L1Cache.access_cache(address):
-            return CacheLevel.L1, self.L1Cache.read_cache(address)
-        elif self.L2Cache.access_cache(address):
-            value = self.L2Cache.read_cache(address)
-            self.L1Cache.replace_cache_line(address, value)
-            return CacheLevel.L2, value
-        else:
+        cache_level, slot = self.lookup(address)
+        if cache_level == CacheLevel.NoCache:
             return CacheLevel.NoCache, None
+        return cache_level, self.read(address, cache_level, slot)
 
     def write_cache(self, address: int, value: bytes):
-        if self.L1Cache.access_cache(address):
-            self.L1Cache.write_cache(address, value)
-            return CacheLevel.L1
-        elif self.L2Cache.access_cache(address):
-            self.L2Cache.write_cache(address, value)
-            self.L1Cache.replace_cache_line(address, value)
-            return CacheLevel.L2
+        cache_level, slot = self.lookup(address)
+        if cache_level == CacheLevel.NoCache:
+            self.fill(address, value)
         else:
-            self.L2Cache.replace_cache_line(address, value)
-            self.L1Cache.replace_cache_line(address, value)
-            return CacheLevel.NoCache
+            self.write(address, cache_level, slot, value)
+        return cache_level
+
+    def write_back_all(self):
+        # Push every dirty line down before the caches are cleared
+        for victim in self.l1_cache.dirty_lines():
+            self.write_back_l1(victim)
+        for victim in self.L2Cache.dirty_lines():
+            self.write_back_l2(victim)
 
     def flush(self):
-        self.L1Cache.flush()
+        if self.shared_l2:
+            for victim in self.l1_cache.dirty_lines():
+                self.write_back_l1(victim)
+            self.l1_cache.flush()
+            return
+        self.write_back_all()
+        self.l1_cache.flush()
         self.L2Cache.flush()
 
+
+class Level2Cache(TwoLevelCache):
+    def __init__(self, l1_cache_size, l1_cache_line_size, l1_cache_policy, l2_cache_size, l2_cache_line_size,
+                 l2_cache_policy, l2_cache_associativity, l2_n_way, store_data=True, write_policy=None,
+                 write_allocate=True, victim_cache_size=0, l2_cache=None):
+        # An L2 given by the caller may be shared with the caches of other cores
+        shared_l2 = l2_cache is not None
+        self.L1Cache = DirectCacheBase(cache_size=l1_cache_size, cache_line_size=l1_cache_line_size,
+                                       replace_algorithm=l1_cache_policy, store_data=store_data,
+                                       victim_cache_size=victim_cache_size)
+        if l2_cache is None:
+            l2_cache = AssociativeCacheBase(associative=l2_cache_associativity, n_way=l2_n_way,
+                                            cache_size=l2_cache_size, cache_line_size=l2_cache_line_size,
+                                            replace_algorithm=l2_cache_policy, store_data=store_data)
+        super().__init__(self.L1Cache, l2_cache, write_policy, write_allocate, shared_l2)
+
     def __contains__(self, item):
         return item in self.L1Cache or item in self.L2Cache
 
 
-class SplitCache:
+class SplitCache(TwoLevelCache):
     def __init__(self, l1_cache_size, l1_cache_line_size, l1_cache_policy, l2_cache_size, l2_cache_line_size,
-                 l2_cache_policy, l2_cache_associativity, l2_n_way):
+                 l2_cache_policy, l2_cache_associativity, l2_n_way, store_data=True, write_policy=None,
+                 write_allocate=True, victim_cache_size=0, l2_cache=None):
+        # An L2 given by the caller may be shared with the caches of other cores
+        shared_l2 = l2_cache is not None
         self.L1DCache = DirectCacheBase(cache_size=l1_cache_size // 2, cache_line_size=l1_cache_line_size,
-                                       replace_algorithm=l1_cache_policy)
+                                       replace_algorithm=l1_cache_policy, store_data=store_data,
+                                       victim_cache_size=victim_cache_size)
         self.L1ICache = DirectCacheBase(cache_size=l1_cache_size // 2, cache_line_size=l1_cache_line_size,
-                                       replace_algorithm=l1_cache_policy)
-        if l2_n_way > 1:
-            self.L2Cache = AssociativeCacheBase(associative=l2_cache_associativity, n_way=l2_n_way,
-                                                cache_size=l2_cache_size, cache_line_size=l2_cache_line_size,
-                                                replace_algorithm=l2_cache_policy)
-        else:
-            self.L2Cache = DirectCacheBase(cache_size=l2_cache_size, cache_line_size=l2_cache_line_size,
-                                           replace_algorithm=l2_cache_policy)
-    def read_cache(self, address: int) -> (int, bytes):
-        if self.L1DCache.access_cache(address):
-            return CacheLevel.L1, self.L1DCache.read_cache(address)
-        elif self.L2Cache.access_cache(address):
-            value = self.L2Cache.read_cache(address)
-            self.L1DCache.replace_cache_line(address, value)
-            return CacheLevel.L2, value
-        else:
-            return CacheLevel.NoCache, None
-
-    def write_cache(self, address: int, value: bytes):
-        if self.L1DCache.access_cache(address):
-            self.L1DCache.write_cache(address, value)
-            return CacheLevel.L1
-        elif self.L2Cache.access_cache(address):
-            self.L2Cache.write_cache(address, value)
-            self.L1DCache.replace_cache_line(address, value)
-            return CacheLevel.L2
-        else:
-            self.L2Cache.replace_cache_line(address, value)
-            self.L1DCache.replace_cache_line(address, value)
-            return CacheLevel.NoCache
+                                       replace_algorithm=l1_cache_policy, store_data=store_data,
+                                       victim_cache_size=victim_cache_size)
+        if l2_cache is None and l2_n_way > 1:
+            l2_cache = AssociativeCacheBase(associative=l2_cache_associativity, n_way=l2_n_way,
+                                            cache_size=l2_cache_size, cache_line_size=l2_cache_line_size,
+                                            replace_algorithm=l2_cache_policy, store_data=store_data)
+        elif l2_cache is None:
+            l2_cache = DirectCacheBase(cache_size=l2_cache_size, cache_line_size=l2_cache_line_size,
+                                       replace_algorithm=l2_cache_policy, store_data=store_data)
+        super().__init__(self.L1DCache, l2_cache, write_policy, write_allocate, shared_l2)
 
     def read_instruction(self, address: int):
         if self.L1ICache.access_cache(address):
@@ -272,9 +696,60 @@ class SplitCache:
             return CacheLevel.L2, value
 
     def flush(self):
-        self.L1DCache.flush()
+        super().flush()
         self.L1ICache.flush()
-        self.L2Cache.flush()
 
     def __contains__(self, item):
-        return item in self.L1DCache or item in self.L2Cache
\ No newline at end of file
+        return item in self.L1DCache or item in self.L2Cache
+
+
+class MissStatusHoldingRegisters:
+    def __init__(self, entries: int):
+        """
+        Lines missing in L1 that are on their way, each with the cycle its fill completes, at most entries at once
+        An access to a line in flight merges into its register instead of taking a new one,
+        a miss while every register is busy waits for the first one to free up
+        """
+        self.entries = entries
+        # Line address -> cycle the line arrives
+        self.in_flight: Dict[int, int] = {}
+
+        self.allocations = 0
+        self.merges = 0
+        self.full_stalls = 0
+        self.stall_cycles = 0
+
+    def retire(self, cycle: int):
+        for line in [line for line, ready in self.in_flight.items() if ready <= cycle]:
+            del self.in_flight[line]
+
+    def access(self, line: int, cycle: int, latency: int, blocking: bool) -> int:
+        """
+        An access to line after the L1 lookup ending at cycle, latency is the time it takes to bring the line in,
+        0 on an L1 hit. A blocking access waits for its line, the others only wait for a free register
+        return the cycle the access lets the core go on
+        """
+        ready = self.in_flight.get(line)
+        if ready is not None and ready > cycle:
+            self.merges += 1
+            if blocking:
+                self.stall_cycles += ready - cycle
+                return ready
+            return cycle
+        if not latency:
+            return cycle
+
+        if len(self.in_flight) >= self.entries:
+            self.retire(cycle)
+        if len(self.in_flight) >= self.entries:
+            free = min(self.in_flight.values())
+            self.full_stalls += 1
+            self.stall_cycles += free - cycle
+            cycle = free
+            self.retire(cycle)
+        self.allocations += 1
+        self.in_flight[line] = cycle + latency
+        return cycle + latency if blocking else cycle
+
+    def flush(self):
+        self.in_flight.clear()
@@ -0,0 +1,192 @@
+from Utils import *
+from Cache import DirectCacheBase, AssociativeCacheBase
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple, Union
+
+
+@dataclass
+class CacheLevelSpec:
+    cache_size: int
+    cache_line_size: int = 32 * Size.B
+    # One way is direct mapped
+    n_way: int = 1
+    replace_algorithm: CacheReplaceAlgorithm = CacheReplaceAlgorithm.LRU
+    # Cycles of a lookup in this level
+    access: int = 1
+    # Relation to the levels above, ignored for the first level
+    inclusion: InclusionPolicy = InclusionPolicy.NINE
+
+
+class CacheHierarchy:
+    def __init__(self, specs: List[CacheLevelSpec], store_data: bool = True,
+                 write_policy: Optional[WritePolicy] = None, write_allocate: bool = True):
+        """
+        Cache levels from L1 down, an access looks them up in order and a miss in every level goes to memory
+        A line from memory is filled into every level but the exclusive ones, a line found in a level is brought
+        into the levels above it the same way
+        An exclusive level only takes the lines evicted from the level right above it, a line found there moves up
+        and leaves it. When an inclusive level evicts a line the levels above drop their copies
+        Write policies work as in TwoLevelCache, a dirty line goes to the first level below holding it and to
+        memory through write_memory(address, value) otherwise
+        """
+        assert len(specs) >= 2, "A hierarchy has at least two levels"
+        assert len({spec.cache_line_size for spec in specs}) == 1, "Every level uses the same cache line size"
+        # The future OPT needs is recorded for L2 only, see Simulator.record_l2_probes
+        assert all(spec.replace_algorithm != CacheReplaceAlgorithm.OPT for depth, spec in enumerate(specs)
+                   if depth != 1), "OPT is only supported in L2"
+        self.specs = list(specs)
+        self.write_policy = write_policy
+        self.write_allocate = write_allocate
+        self.write_memory: Callable[[int, Optional[bytes]], None] = lambda address, value: None
+
+        self.levels: List[DirectCacheBase] = []
+        for spec in self.specs:
+            if spec.n_way > 1:
+                cache = AssociativeCacheBase(associative=Associativity.SetAssociative, n_way=spec.n_way,
+                                             cache_size=spec.cache_size, cache_line_size=spec.cache_line_size,
+                                             replace_algorithm=spec.replace_algorithm, store_data=store_data)
+            else:
+                cache = DirectCacheBase(cache_size=spec.cache_size, cache_line_size=spec.cache_line_size,
+                                        replace_algorithm=spec.replace_algorithm, store_data=store_data)
+            # Every replaced line is handled by evict, dirty or not
+            cache.evictions = []
+            self.levels.append(cache)
+        self.l1_cache = self.levels[0]
+        self.L2Cache = self.levels[1]
+
+        self.writebacks = [0] * len(self.levels)
+        self.back_invalidations = 0
+
+    @property
+    def l1_writebacks(self) -> int:
+        return self.writebacks[0]
+
+    @property
+    def l2_writebacks(self) -> int:
+        return self.writebacks[1]
+
+    def lookup(self, address: int) -> Tuple[int, int]:
+        """
+        One counted tag search per level until one holds address, return (depth of that level, its slot)
+        (number of levels, -1) on a miss in every level, then the line is brought in with fill
+        """
+        for depth, cache in enumerate(self.levels):
+            slot = cache.probe(address)
+            if slot >= 0:
+                return depth, slot
+        return len(self.levels), -1
+
+    def install(self, depth: int, address: int, value: Union[bytes, None], dirty: bool = False,
+                probed: bool = True):
+        # probed is False for a line the level was not probed for, a prefetch or a line evicted from above
+        cache = self.levels[depth]
+        slot = cache.locate(address)
+        if slot >= 0:
+            # Already there, a line coming from above is the newer copy
+            cache.write_slot(slot, value)
+            if dirty:
+                cache.mark_dirty(slot)
+            return
+        if probed:
+            cache.replace_cache_line(address, value, dirty)
+        else:
+            cache.fill_unprobed(address, value, dirty)
+        evictions, cache.evictions = cache.evictions, []
+        for evicted in evictions:
+            self.evict(depth, *evicted)
+
+    def evict(self, depth: int, address: int, value: Union[bytes, None], dirty: bool):
+        if self.specs[depth].inclusion == InclusionPolicy.Inclusive:
+            # Back invalidation, the copy closest to L1 is the most recent one
+            for upper in reversed(range(depth)):
+                cache = self.levels[upper]
+                slot = cache.locate(address)
+                if slot >= 0:
+                    self.back_invalidations += 1
+                    if cache.dirty[slot]:
+                        value, dirty = cache.read_slot(slot), True
+                    cache.invalidate(slot)
+
+        below = depth + 1
+        if below < len(self.levels) and self.specs[below].inclusion == InclusionPolicy.Exclusive:
+            self.install(below, address, value, dirty, probed=False)
+        elif dirty:
+            self.write_back(depth, address, value)
+
+    def write_back(self, depth: int, address: int, value: Union[bytes, None]):
+        self.writebacks[depth] += 1
+        for cache in self.levels[depth + 1:]:
+            slot = cache.locate(address)
+            if slot >= 0:
+                cache.write_slot(slot, value)
+                cache.mark_dirty(slot)
+                return
+        self.write_memory(address, value)
+
+    def promote(self, address: int, depth: int, value: Union[bytes, None], dirty: bool = False):
+        # Bring a line found at depth, or in memory, into the levels above it
+        for upper in range(depth - 1, 0, -1):
+            if self.specs[upper].inclusion != InclusionPolicy.Exclusive:
+                self.install(upper, address, value)
+        self.install(0, address, value, dirty)
+
+    def take(self, depth: int, slot: int) -> bool:
+        # A line leaving an exclusive level on its way up, return whether it was dirty
+        if self.specs[depth].inclusion != InclusionPolicy.Exclusive:
+            return False
+        cache = self.levels[depth]
+        dirty = bool(cache.dirty[slot])
+        cache.invalidate(slot)
+        return dirty
+
+    def read(self, address: int, depth: int, slot: int) -> Union[bytes, None]:
+        value = self.levels[depth].read_slot(slot)
+        if depth > 0:
+            self.promote(address, depth, value, self.take(depth, slot))
+        return value
+
+    def write(self, address: int, depth: int, slot: int, value: bytes):
+        write_back = self.write_policy == WritePolicy.WriteBack
+        cache = self.levels[depth]
+        if depth > 0 and self.write_allocate:
+            cache.write_slot(slot, value)
+            self.promote(address, depth, value, self.take(depth, slot) or write_back)
+        else:
+            cache.write_slot(slot, value)
+            if write_back:
+                cache.mark_dirty(slot)
+        if self.write_policy == WritePolicy.WriteThrough:
+            self.write_memory(address, value)
+
+    def write_miss(self, address: int, value: bytes):
+        # Write to a line no level holds, only used with a write policy
+        if not self.write_allocate:
+            self.write_memory(address, value)
+            return
+        self.fill(address, value, self.write_policy == WritePolicy.WriteBack)
+        if self.write_policy == WritePolicy.WriteThrough:
+            self.write_memory(address, value)
+
+    def fill(self, address: int, value: bytes, dirty: bool = False):
+        self.promote(address, len(self.levels), value, dirty)
+
+    def prefetch(self, address: int, value: bytes) -> bool:
+        # Bring a line into L2 unless a level already holds it, return whether it was brought in
+        if address in self:
+            return False
+        self.install(1, address, value, probed=False)
+        return True
+
+    def write_back_all(self):
+        # From L1 down, so lines written back into a level are pushed further down with it
+        for depth, cache in enumerate(self.levels):
+            for victim in cache.dirty_lines():
+                self.write_back(depth, *victim)
+
+    def flush(self):
+        self.write_back_all()
+        for cache in self.levels:
+            cache.flush()
+
+    def __contains__(self, item):
+        return any(cache.locate(item) >= 0 for cache in self.levels)
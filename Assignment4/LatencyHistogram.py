@@ -0,0 +1,142 @@
+from Utils import *
+from typing import Dict, List, Tuple
+import csv
+import json
+import math
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Instructions with a latency, the others do not touch memory
+LATENCY_OPS = (OP.MemoryRead, OP.MemoryWrite, OP.InstructionFetch)
+
+
+class LatencyHistogram:
+    def __init__(self, sub_bucket_bits: int = 4, max_bits: int = 40) -> None:
+        """
+        Log bucketed counts of non negative latencies in cycles, every power of two range is split into
+        2 ** sub_bucket_bits equal buckets, so a bucket is at most 1 / 2 ** sub_bucket_bits of its values wide
+        Values below 2 ** sub_bucket_bits get a bucket each, values of 2 ** max_bits and more share the last one
+        Memory is fixed by the two widths whatever is recorded
+        """
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.max_bits = max_bits
+        self.counts = [0] * ((max_bits - sub_bucket_bits + 1) * self.sub_buckets)
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value: int) -> int:
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        index = (shift + 1) * self.sub_buckets + (value >> shift) - self.sub_buckets
+        return min(index, len(self.counts) - 1)
+
+    def bucket_range(self, index: int) -> Tuple[int, int]:
+        # Smallest and largest value of the bucket
+        if index < self.sub_buckets:
+            return index, index
+        shift = index // self.sub_buckets - 1
+        low = (self.sub_buckets + index % self.sub_buckets) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value: int, count: int = 1) -> None:
+        self.counts[self.bucket(value)] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        assert (self.sub_bucket_bits, self.max_bits) == (other.sub_bucket_bits, other.max_bits)
+        if not other.count:
+            return
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent: float) -> int:
+        """
+        Upper bound of the bucket holding the latency percent of the recorded ones do not exceed, kept within
+        the smallest and largest recorded latency, 0 when nothing was recorded
+        """
+        if not self.count:
+            return 0
+        rank = max(math.ceil(percent / 100 * self.count), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return max(min(self.bucket_range(index)[1], self.max), self.min)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0
+
+    def summary(self) -> Dict[str, float]:
+        summary = {"count": self.count, "mean": self.mean, "min": self.min or 0, "max": self.max or 0}
+        for percent in PERCENTILES:
+            summary[f"p{percent}"] = self.percentile(percent)
+        return summary
+
+    def buckets(self) -> List[Tuple[int, int, int]]:
+        # (smallest value, largest value, count) of the buckets that counted something
+        return [self.bucket_range(index) + (count,) for index, count in enumerate(self.counts) if count]
+
+
+class LatencyProfile:
+    def __init__(self, level_names: List[str], sub_bucket_bits: int = 4, max_bits: int = 40) -> None:
+        """
+        One histogram of instruction latencies per op, per TLB outcome and per level that served the
+        instruction, named by level_names from L1 down to memory
+        An instruction spanning several lines is served by the deepest level it reached, the page walk
+        accesses of a TLB miss do not count towards it but their cycles do
+        """
+        self.level_names = level_names
+        new = lambda: LatencyHistogram(sub_bucket_bits, max_bits)
+        self.ops = {op: new() for op in LATENCY_OPS}
+        self.tlb = {True: new(), False: new()}
+        self.levels = [new() for _ in level_names]
+
+    def record(self, op: OP, tlb_hit: bool, depth: int, latency: int) -> None:
+        self.ops[op].record(latency)
+        self.tlb[tlb_hit].record(latency)
+        self.levels[depth].record(latency)
+
+    def histograms(self) -> Dict[Tuple[str, str], LatencyHistogram]:
+        histograms = {("op", op.name): histogram for op, histogram in self.ops.items()}
+        histograms[("tlb", "hit")] = self.tlb[True]
+        histograms[("tlb", "miss")] = self.tlb[False]
+        for name, histogram in zip(self.level_names, self.levels):
+            histograms[("served", name)] = histogram
+        return histograms
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {f"{group}/{name}": histogram.summary() for (group, name), histogram in self.histograms().items()}
+
+    def to_csv(self, path: str) -> None:
+        # One row of summary statistics per histogram
+        with open(path, 'w', newline='') as file:
+            writer = None
+            for (group, name), histogram in self.histograms().items():
+                row = {"group": group, "name": name, **histogram.summary()}
+                if writer is None:
+                    writer = csv.DictWriter(file, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+
+    def to_json(self, path: str) -> None:
+        # Summary statistics and the non empty buckets of every histogram
+        histograms = [{"group": group, "name": name, **histogram.summary(), "buckets": histogram.buckets()}
+                      for (group, name), histogram in self.histograms().items()]
+        with open(path, 'w') as file:
+            json.dump(histograms, file, indent=1)
@@ -1,43 +1,222 @@
 from Utils import *
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, Union
+import bisect
 import math
+import mmap
+import tempfile
 
 page_bit = 12
 page_size = 2 ** page_bit
 
 
+# Contents of a page that was never written
+ZERO_PAGE = bytes(page_size)
+
+
 class MemoryPage:
     def __init__(self, address: int) -> None:
         self.address = address
         self.base_address = address >> page_bit
-        self.data = {}
+        # Allocated on the first write, until then the page reads as zeros
+        self.data: Optional[bytearray] = None
 
     def write(self, address: int, data: int) -> None:
         assert address >> page_bit == self.base_address
         offset = address & (page_size - 1)
+        if self.data is None:
+            self.data = bytearray(page_size)
         self.data[offset] = data
 
     def read(self, address: int) -> int:
         assert address >> page_bit == self.base_address
         offset = address & (page_size - 1)
-        if offset not in self.data:
+        if self.data is None:
             return 0
         return self.data[offset]
 
-    def read_page(self) -> Dict[int, int]:
-        return self.data
+    def write_bytes(self, offset: int, data: bytes) -> None:
+        assert offset + len(data) <= page_size
+        if self.data is None:
+            self.data = bytearray(page_size)
+        self.data[offset:offset + len(data)] = data
+
+    def read_bytes(self, offset: int, size: int) -> memoryview:
+        assert offset + size <= page_size
+        if self.data is None:
+            return memoryview(ZERO_PAGE)[offset:offset + size]
+        return memoryview(self.data)[offset:offset + size]
+
+    def read_page(self) -> memoryview:
+        return self.read_bytes(0, page_size)
+
+    def write_page(self, data: bytes) -> None:
+        assert len(data) == page_size
+        self.data = bytearray(data)
+
+
+class FrameAllocator:
+    # Extents per bucket, a bucket twice this size is split in two
+    BUCKET_SIZE = 256
+
+    def __init__(self) -> None:
+        """
+        Free extents of page numbers between the lowest and the highest allocated page
+        Extents never touch and are kept sorted in buckets, extent i of bucket b covers [starts[b][i], ends[b][i])
+        firsts holds the first start of every bucket, so an extent is found with two bisections and
+        inserting or removing one only shifts a single bucket
+        """
+        self.lowest: Optional[int] = None
+        self.highest: Optional[int] = None
+        self.starts: List[List[int]] = []
+        self.ends: List[List[int]] = []
+        self.firsts: List[int] = []
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.starts)
+
+    def clear(self) -> None:
+        self.lowest = None
+        self.highest = None
+        self.starts = []
+        self.ends = []
+        self.firsts = []
 
-    def write_page(self, data: Dict[int, int]) -> None:
-        self.data = data
+    def locate(self, page: int) -> Tuple[int, int]:
+        # (bucket, index) of the last extent starting at or before page, index is -1 if there is none
+        bucket = bisect.bisect_right(self.firsts, page) - 1
+        if bucket < 0:
+            return 0, -1
+        return bucket, bisect.bisect_right(self.starts[bucket], page) - 1
+
+    def next_extent(self, bucket: int, index: int) -> Optional[Tuple[int, int]]:
+        if index + 1 < len(self.starts[bucket]):
+            return bucket, index + 1
+        if bucket + 1 < len(self.starts):
+            return bucket + 1, 0
+        return None
+
+    def insert_extent(self, start: int, end: int) -> None:
+        if start >= end:
+            return
+        if not self.starts:
+            self.starts, self.ends, self.firsts = [[start]], [[end]], [start]
+            return
+        bucket = max(bisect.bisect_right(self.firsts, start) - 1, 0)
+        starts, ends = self.starts[bucket], self.ends[bucket]
+        index = bisect.bisect_right(starts, start)
+        starts.insert(index, start)
+        ends.insert(index, end)
+        if index == 0:
+            self.firsts[bucket] = start
+        if len(starts) > 2 * self.BUCKET_SIZE:
+            self.starts.insert(bucket + 1, starts[self.BUCKET_SIZE:])
+            self.ends.insert(bucket + 1, ends[self.BUCKET_SIZE:])
+            self.firsts.insert(bucket + 1, starts[self.BUCKET_SIZE])
+            del starts[self.BUCKET_SIZE:]
+            del ends[self.BUCKET_SIZE:]
+
+    def remove_extent(self, bucket: int, index: int) -> None:
+        del self.starts[bucket][index]
+        del self.ends[bucket][index]
+        if not self.starts[bucket]:
+            del self.starts[bucket]
+            del self.ends[bucket]
+            del self.firsts[bucket]
+        elif index == 0:
+            self.firsts[bucket] = self.starts[bucket][0]
+
+    def set_start(self, bucket: int, index: int, start: int) -> None:
+        self.starts[bucket][index] = start
+        if index == 0:
+            self.firsts[bucket] = start
+
+    def mark_allocated(self, page: int) -> None:
+        if self.lowest is None:
+            self.lowest = self.highest = page
+        elif page < self.lowest:
+            self.insert_extent(page + 1, self.lowest)
+            self.lowest = page
+        elif page > self.highest:
+            self.insert_extent(self.highest + 1, page)
+            self.highest = page
+        else:
+            # Cut page out of the free extent holding it
+            bucket, index = self.locate(page)
+            assert index >= 0, f"Page {page} is already allocated"
+            start, end = self.starts[bucket][index], self.ends[bucket][index]
+            assert start <= page < end, f"Page {page} is already allocated"
+            if page + 1 == end:
+                if page == start:
+                    self.remove_extent(bucket, index)
+                else:
+                    self.ends[bucket][index] = page
+            elif page == start:
+                self.set_start(bucket, index, page + 1)
+            else:
+                self.ends[bucket][index] = page
+                self.insert_extent(page + 1, end)
+
+    def mark_free(self, page: int) -> None:
+        if self.lowest == self.highest:
+            self.clear()
+        elif page == self.lowest:
+            if self.starts and self.starts[0][0] == page + 1:
+                self.lowest = self.ends[0][0]
+                self.remove_extent(0, 0)
+            else:
+                self.lowest = page + 1
+        elif page == self.highest:
+            if self.starts and self.ends[-1][-1] == page:
+                self.highest = self.starts[-1][-1] - 1
+                self.remove_extent(len(self.starts) - 1, len(self.starts[-1]) - 1)
+            else:
+                self.highest = page - 1
+        else:
+            # Coalesce with the extents ending at page and starting right after it
+            bucket, index = self.locate(page)
+            if index >= 0:
+                following = self.next_extent(bucket, index)
+            else:
+                following = (0, 0) if self.starts else None
+            merge_previous = index >= 0 and self.ends[bucket][index] == page
+            merge_next = following is not None and self.starts[following[0]][following[1]] == page + 1
+            if merge_previous and merge_next:
+                self.ends[bucket][index] = self.ends[following[0]][following[1]]
+                self.remove_extent(*following)
+            elif merge_previous:
+                self.ends[bucket][index] = page + 1
+            elif merge_next:
+                self.set_start(following[0], following[1], page)
+            else:
+                self.insert_extent(page, page + 1)
+
+    def first_fit(self, pages_needed: int) -> Optional[int]:
+        """
+        First page of the lowest free extent holding pages_needed pages, past the highest page if none does
+        None when nothing is allocated
+        A single page is always the start of the first extent, longer runs scan the extents (not the pages)
+        """
+        if self.lowest is None:
+            return None
+        if pages_needed <= 1:
+            return self.starts[0][0] if self.starts else self.highest + 1
+        for starts, ends in zip(self.starts, self.ends):
+            for start, end in zip(starts, ends):
+                if end - start >= pages_needed:
+                    return start
+        return self.highest + 1
 
 
 class Memory:
     def __init__(self, start_address: int) -> None:
         self.start_address = start_address
         self.allocated_pages: Dict[int, MemoryPage] = {}
+        self.frames = FrameAllocator()
 
     def allocate_page_at_address(self, address: int) -> None:
         page = MemoryPage(address)
+        if page.base_address not in self.allocated_pages:
+            self.frames.mark_allocated(page.base_address)
         self.allocated_pages[page.base_address] = page
 
     def allocate_page(self, size: int) -> List[int]:
@@ -48,47 +227,35 @@ class Memory:
         ret = []
 
         pages_needed = math.ceil(size / page_size)
-        allocated_pages = list(self.allocated_pages.keys())
-        allocated_pages.sort()
-
-        if len(allocated_pages) == 0:
+        page_start = self.frames.first_fit(pages_needed)
+        if page_start is None:
             page_start = self.start_address
-            for i in range(pages_needed):
-                i_th_page = page_start + i * page_size
-                self.allocate_page_at_address(i_th_page << page_bit)
-                ret.append(i_th_page)
-            return ret
-        elif len(allocated_pages) == 1:
-            page_start = allocated_pages[0] + 1
-            for i in range(pages_needed):
-                i_th_page = page_start + i * page_size
-                self.allocate_page_at_address(i_th_page << page_bit)
-                ret.append(i_th_page)
-            return ret
-        else:
 
-            # Allocate pages in the middle
-            for i in range(len(allocated_pages) - 1):
-                if allocated_pages[i + 1] - allocated_pages[i] > pages_needed:
-                    page_start = allocated_pages[i] + 1
-                    for j in range(pages_needed):
-                        j_th_page = page_start + j * page_size
-                        self.allocate_page_at_address(j_th_page << page_bit)
-                        ret.append(j_th_page)
-                    return ret
-            # No space in the middle, allocate at the end
-            page_start = allocated_pages[-1] + 1
-            for i in range(pages_needed):
-                i_th_page = page_start + i * page_size
-                self.allocate_page_at_address(i_th_page << page_bit)
-                ret.append(i_th_page)
-            return ret
+        for i in range(pages_needed):
+            i_th_page = page_start + i * page_size
+            self.allocate_page_at_address(i_th_page << page_bit)
+            ret.append(i_th_page)
+        return ret
+
+    def allocate_contiguous(self, pages_needed: int) -> int:
+        """
+        Allocate pages_needed consecutive page numbers, for huge pages
+        return the first one
+        """
+        page_start = self.frames.first_fit(pages_needed)
+        if page_start is None:
+            page_start = self.start_address
+        for page in range(page_start, page_start + pages_needed):
+            self.allocate_page_at_address(page << page_bit)
+        return page_start
 
     def free_page(self, address: int) -> None:
-        self.allocated_pages.pop(address, None)
+        if self.allocated_pages.pop(address, None) is not None:
+            self.frames.mark_free(address)
 
     def flush(self) -> None:
         self.allocated_pages = {}
+        self.frames.clear()
 
     def write(self, address: int, data: int) -> None:
         page_address = address >> page_bit
@@ -96,24 +263,127 @@ class Memory:
         self.allocated_pages[page_address].write(address, data)
 
     def write_bytes(self, address: int, data: bytes) -> None:
-        for i in range(len(data)):
-            page_address = (address + i) >> page_bit
+        data = memoryview(data)
+        written = 0
+        while written < len(data):
+            page_address = (address + written) >> page_bit
             assert page_address in self
-            self.allocated_pages[page_address].write(address + i, data[i])
+            offset = (address + written) & (page_size - 1)
+            length = min(len(data) - written, page_size - offset)
+            self.write_page_bytes(page_address, offset, data[written:written + length])
+            written += length
 
     def read(self, address: int) -> int:
         page_address = address >> page_bit
         assert page_address in self
         return self.allocated_pages[page_address].read(address)
 
-    def read_bytes(self, address: int, size: int) -> bytes:
-        ret = []
-        for i in range(size):
-            page_address = (address + i) >> page_bit
+    def read_view(self, address: int, size: int) -> Union[memoryview, bytes]:
+        """
+        Zero copy view when the range sits in one page, it follows later writes to that page
+        A range spanning pages is copied out
+        """
+        chunks = []
+        end = address + size
+        while address < end:
+            page_address = address >> page_bit
             assert page_address in self
-            ret.append(self.allocated_pages[page_address].read(address + i))
-        return bytes(ret)
+            offset = address & (page_size - 1)
+            length = min(end - address, page_size - offset)
+            chunks.append(self.read_page_bytes(page_address, offset, length))
+            address += length
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def read_bytes(self, address: int, size: int) -> bytes:
+        return bytes(self.read_view(address, size))
+
+    def read_page_bytes(self, page_address: int, offset: int, size: int) -> Union[memoryview, bytes]:
+        return self.allocated_pages[page_address].read_bytes(offset, size)
+
+    def write_page_bytes(self, page_address: int, offset: int, data: bytes) -> None:
+        self.allocated_pages[page_address].write_bytes(offset, data)
 
     def __contains__(self, address: int) -> bool:
         return address in self.allocated_pages
 
+
+
+class MappedMemory(Memory):
+    def __init__(self, start_address: int, reserve_size: int = 4 * Size.GB, directory: Optional[str] = None) -> None:
+        """
+        Frames live in a sparse memory mapped temporary file instead of page objects
+        allocated_pages maps a page to its frame slot in the file, only touched frames take host memory
+        and the OS can page them out, the file doubles when reserve_size is used up
+        """
+        super().__init__(start_address)
+        self.allocated_pages: Dict[int, int] = {}
+        self.reserve_size = reserve_size
+        self.directory = directory
+        self.file = None
+        self.map = None
+        self.free_slots: List[int] = []
+        self.next_slot = 0
+        self.open()
+
+    def open(self) -> None:
+        self.file = tempfile.TemporaryFile(dir=self.directory)
+        self.file.truncate(self.reserve_size)
+        self.map = mmap.mmap(self.file.fileno(), self.reserve_size)
+        self.free_slots = []
+        self.next_slot = 0
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+    def allocate_page_at_address(self, address: int) -> None:
+        page_address = address >> page_bit
+        slot = self.allocated_pages.get(page_address)
+        if slot is None:
+            self.frames.mark_allocated(page_address)
+        if slot is None and self.free_slots:
+            slot = self.free_slots.pop()
+        if slot is None:
+            # Never used slots are holes of the sparse file and read as zeros
+            slot = self.next_slot
+            self.next_slot += 1
+            if self.next_slot * page_size > len(self.map):
+                self.map.resize(len(self.map) * 2)
+        else:
+            # Reallocating a page, or reusing the slot of a freed one, wipes it
+            self.map[slot * page_size:(slot + 1) * page_size] = ZERO_PAGE
+        self.allocated_pages[page_address] = slot
+
+    def free_page(self, address: int) -> None:
+        slot = self.allocated_pages.pop(address, None)
+        if slot is not None:
+            self.frames.mark_free(address)
+            self.free_slots.append(slot)
+
+    def flush(self) -> None:
+        # A fresh file gives back the disk space and host memory of every frame
+        self.close()
+        self.allocated_pages = {}
+        self.frames.clear()
+        self.open()
+
+    def write(self, address: int, data: int) -> None:
+        page_address = address >> page_bit
+        assert page_address in self
+        self.map[self.allocated_pages[page_address] * page_size + (address & (page_size - 1))] = data
+
+    def read(self, address: int) -> int:
+        page_address = address >> page_bit
+        assert page_address in self
+        return self.map[self.allocated_pages[page_address] * page_size + (address & (page_size - 1))]
+
+    def read_page_bytes(self, page_address: int, offset: int, size: int) -> bytes:
+        # Copied out, a view into the map would keep it from being resized
+        start = self.allocated_pages[page_address] * page_size + offset
+        return self.map[start:start + size]
+
+    def write_page_bytes(self, page_address: int, offset: int, data: bytes) -> None:
+        start = self.allocated_pages[page_address] * page_size + offset
+        self.map[start:start + len(data)] = data
@@ -0,0 +1,190 @@
+from Utils import *
+from Simulator import Simulator, SimulatorConfigure, Instruction
+from Cache import DirectCacheBase, SplitCache
+from dataclasses import dataclass, field, replace
+from functools import partial
+from typing import Dict, List, Set, Tuple
+import sys
+
+
+class MESIDirectory:
+    def __init__(self, caches: List[SplitCache], cache_line_size: int):
+        """
+        MESI state of every line held by the private L1 data caches of the cores, a line no core holds is Invalid
+        A read miss downgrades a Modified or Exclusive copy of another core to Shared, a write invalidates every
+        other copy. A dirty copy is written back to the shared L2 first
+        A miss on a line the core lost to an invalidation is a coherence miss
+        Lines the L1s replace or flush reach the directory through their evictions lists
+        """
+        self.caches = caches
+        self.cache_line_size = cache_line_size
+        # Line address -> {core: state}
+        self.lines: Dict[int, Dict[int, MESIState]] = {}
+        # Lines every core lost to an invalidation and has not missed on since
+        self.invalidated: List[Set[int]] = [set() for _ in caches]
+
+        self.invalidations = [0] * len(caches)
+        self.coherence_misses = [0] * len(caches)
+        for cache in caches:
+            cache.l1_cache.evictions = []
+
+    def state(self, core: int, address: int) -> MESIState:
+        holders = self.lines.get(address - address % self.cache_line_size, {})
+        return holders.get(core, MESIState.Invalid)
+
+    def drain_evictions(self):
+        for core, cache in enumerate(self.caches):
+            evictions = cache.l1_cache.evictions
+            if not evictions:
+                continue
+            for line, _, _ in evictions:
+                holders = self.lines.get(line)
+                if holders is not None:
+                    holders.pop(core, None)
+                    if not holders:
+                        del self.lines[line]
+            evictions.clear()
+
+    def write_back(self, core: int, line: int, invalidate: bool) -> bool:
+        # Write back the copy of core if it is dirty, return whether core still had the line
+        # A line written without write allocate never reached the L1
+        l1_cache: DirectCacheBase = self.caches[core].l1_cache
+        slot = l1_cache.locate(line)
+        if slot < 0:
+            return False
+        if l1_cache.dirty[slot]:
+            self.caches[core].write_back_l1((line, l1_cache.read_slot(slot)))
+            l1_cache.dirty[slot] = 0
+        if invalidate:
+            l1_cache.invalidate(slot)
+        return True
+
+    def access(self, core: int, address: int, cache_level: CacheLevel, write: bool):
+        """
+        Called after core looked address up in its caches, before it reads or writes the line
+        """
+        self.drain_evictions()
+        line = address - address % self.cache_line_size
+        holders = self.lines.setdefault(line, {})
+        if cache_level != CacheLevel.L1:
+            holders.pop(core, None)
+            if line in self.invalidated[core]:
+                self.invalidated[core].discard(line)
+                self.coherence_misses[core] += 1
+
+        if write:
+            if holders.get(core) != MESIState.Modified:
+                for other in list(holders):
+                    if other == core:
+                        continue
+                    if self.write_back(other, line, invalidate=True):
+                        self.invalidated[other].add(line)
+                        self.invalidations[other] += 1
+                    del holders[other]
+            holders[core] = MESIState.Modified
+        elif core not in holders:
+            for other, state in list(holders.items()):
+                if state == MESIState.Shared:
+                    continue
+                if self.write_back(other, line, invalidate=False):
+                    holders[other] = MESIState.Shared
+                else:
+                    del holders[other]
+            holders[core] = MESIState.Shared if holders else MESIState.Exclusive
+
+
+class Core(Simulator):
+    def flush(self):
+        # Only the private caches are emptied, their lines leave like evictions so the directory sees them go
+        l1_cache = self.cache.l1_cache
+        l1_cache.evictions += [(l1_cache.line_address(slot), None, False)
+                               for slot in range(l1_cache.cache_line_num) if l1_cache.cache[slot]]
+        super().flush()
+
+
+@dataclass
+class MultiCoreConfigure:
+    # One trace per core
+    file_paths: Tuple[str, ...] = ()
+    # Settings of every core, file_path is replaced by the trace of the core
+    core: SimulatorConfigure = field(default_factory=SimulatorConfigure)
+    scheduler: Scheduler = Scheduler.RoundRobin
+    # Instructions a core runs before the scheduler picks again
+    quantum: int = 1
+    # The cores run threads of one process and share its page tables, otherwise each one has its own
+    shared_address_space: bool = False
+
+
+class MultiCore:
+    def __init__(self, config: MultiCoreConfigure):
+        """
+        One Simulator per core with a private split L1 and TLBs, all of them share physical memory and the L2
+        Coherence of the L1 data caches is kept by a MESI directory, its messages are not timed
+        """
+        assert config.file_paths, "One trace per core"
+        assert not config.core.cache_levels and config.core.victim_cache_size == 0, \
+            "The cores use split L1s without victim cache"
+        assert config.core.L2_replace_algorithm != CacheReplaceAlgorithm.OPT, "OPT needs the future of a single trace"
+        # Without a write policy written lines are never dirty, a Modified copy would leave without a write back
+        assert len(config.file_paths) == 1 or config.core.write_policy is not None, \
+            "Coherence needs a write policy to write Modified lines back"
+        self.config = config
+
+        first = Core(replace(config.core, file_path=config.file_paths[0], separate_instruction_data=True))
+        self.cores = [first]
+        for file_path in config.file_paths[1:]:
+            page_table = first.multi_page if config.shared_address_space else None
+            core = Core(replace(config.core, file_path=file_path, separate_instruction_data=True),
+                        memory=first.memory, page_table=page_table, l2_cache=first.cache.L2Cache)
+            # Page table contents when timing_only live in memory too
+            core.page_tables = first.page_tables
+            self.cores.append(core)
+        self.l2_cache = first.cache.L2Cache
+
+        self.directory = MESIDirectory([core.cache for core in self.cores], first.cache_line_size)
+        for index, core in enumerate(self.cores):
+            core.coherence = partial(self.directory.access, index)
+
+    def schedule(self, running: List[int], turn: int) -> int:
+        if self.config.scheduler == Scheduler.LeastCycles:
+            return min(running, key=lambda index: self.cores[index].cycle)
+        return running[turn % len(running)]
+
+    def start_simulation(self):
+        streams = [iter(core.instruction_stream()) for core in self.cores]
+        running = list(range(len(self.cores)))
+        turn = 0
+        while running:
+            index = self.schedule(running, turn)
+            turn += 1
+            core = self.cores[index]
+            for _ in range(self.config.quantum):
+                instruction: Instruction = next(streams[index], None)
+                if instruction is None:
+                    running.remove(index)
+                    break
+                core.execute(instruction)
+
+    def result(self):
+        cores = []
+        for index, core in enumerate(self.cores):
+            print(f"Core {index}: {core.file_path}")
+            result = core.result()
+            result["Invalidations"] = self.directory.invalidations[index]
+            result["Coherence_misses"] = self.directory.coherence_misses[index]
+            print(f"Invalidations: {result['Invalidations']}, Coherence Misses: {result['Coherence_misses']}")
+            cores.append(result)
+        l2_access = self.l2_cache.hits + self.l2_cache.misses
+        print(f"Shared L2 Hit Rate: {self.l2_cache.hits / l2_access, self.l2_cache.hits, l2_access}")
+        # The cores run in parallel, the slowest one decides
+        total_cycles = max(core.cycle for core in self.cores)
+        print(f"Total Cycles: {total_cycles}")
+        return {"Cores": cores, "L2_hit": self.l2_cache.hits, "L2_access": l2_access, "Total_Cycles": total_cycles}
+
+
+if __name__ == '__main__':
+    multi_core = MultiCore(MultiCoreConfigure(file_paths=tuple(sys.argv[1:]),
+                                              core=SimulatorConfigure(timing_only=True,
+                                                                      write_policy=WritePolicy.WriteBack)))
+    multi_core.start_simulation()
+    multi_core.result()
@@ -9,16 +9,28 @@ class PageTableEntry:
         self.valid = valid
 
 
+# Normalise raw bytes the way decoding then encoding an entry would: only the valid bit of the flag survives,
+# and the value of a last level entry keeps its low 21 bits
+FLAG_MASK = bytes(i & 0b1 for i in range(256))
+# Tables that can hold huge page mappings also keep the leaf bit
+LEAF_FLAG_MASK = bytes(i & 0b11 for i in range(256))
+VALID_BIT = 0b1
+LEAF_BIT = 0b10
+LAST_VALUE_MASK = bytes(i & 0x1f for i in range(256))
+
+
 class PageTable:
-    def __init__(self, page_bits: int, address: Union[None, int] = None, is_last: bool = False) -> None:
+    def __init__(self, page_bits: int, address: Union[None, int] = None, is_last: bool = False,
+                 huge_pages: bool = False) -> None:
         """
-        One bit for valid bit
+        One bit for valid bit, with huge_pages a second one marks a leaf entry that maps a huge page
         Unit is bytes
         | name | flag | value |
         | byte |  1   |  4   |
         For Last one
         | name | flag | value |
         | byte |  1   |  3  |
+        Entries stay in this layout in data and are only decoded when queried
         """
 
         if is_last:
@@ -28,9 +40,14 @@ class PageTable:
 
         self.is_last = is_last
         self.page_bit = page_bits
+        self.entry_size = 4 if is_last else 5
+        self.huge_pages = huge_pages
+        self.flag_mask = LEAF_FLAG_MASK if huge_pages else FLAG_MASK
 
-        self.entries: Dict[int, PageTableEntry] = {}
+        self.data = bytearray(self.page_size)
         self.address = address
+        # Set once an entry is added after the last deserialize
+        self.dirty = False
 
     @staticmethod
     def get_page_size(page_bits, is_last: bool):
@@ -39,58 +56,60 @@ class PageTable:
         else:
             return 2 ** page_bits * 5
 
-    def add_entry(self, key: int, value: int) -> None:
-        self.entries[key] = PageTableEntry(value, True)
+    def add_entry(self, key: int, value: int, leaf: bool = False) -> None:
+        assert self.huge_pages or not leaf
+        start = key * self.entry_size
+        self.data[start] = VALID_BIT | LEAF_BIT if leaf else VALID_BIT
+        self.data[start + 1:start + self.entry_size] = value.to_bytes(self.entry_size - 1, byteorder='big')
+        self.dirty = True
+
+    def value(self, key: int) -> int:
+        start = key * self.entry_size + 1
+        return int.from_bytes(self.data[start:start + self.entry_size - 1], byteorder='big')
+
+    def is_leaf(self, key: int) -> bool:
+        return self.huge_pages and bool(self.data[key * self.entry_size] & LEAF_BIT)
+
+    def __getitem__(self, key: int) -> PageTableEntry:
+        return PageTableEntry(self.value(key), key in self)
 
     def deserialize(self, data: bytes):
         # print(len(data), self.page_size)
         assert len(data) == self.page_size
+        self.data[:] = data
+        self.data[0::self.entry_size] = self.data[0::self.entry_size].translate(self.flag_mask)
+        if self.is_last:
+            self.data[1::self.entry_size] = self.data[1::self.entry_size].translate(LAST_VALUE_MASK)
+        self.dirty = False
 
-        for i in range(0, 2 ** self.page_bit):
-            if self.is_last:
-                flag_byte = data[i * 4]
-                address = int.from_bytes(data[i * 4 + 1:i * 4 + 4], byteorder='big') & ((2 << 20) - 1)
-            else:
-                flag_byte = data[i * 5]
-                address = int.from_bytes(data[i * 5 + 1:i * 5 + 5], byteorder='big')
-
-            valid = bool(flag_byte & 0b1)
-            self.entries[i] = PageTableEntry(address, valid)
-
-    def serialize(self):
-        buffer = b""
-        for i in range(2 ** self.page_bit):
-            if i in self.entries:
-                flag_byte = 0b00000000
-                if self.entries[i].valid:
-                    flag_byte |= 0b1
-                buffer += flag_byte.to_bytes(1, byteorder='big')
-                if self.is_last:
-                    buffer += self.entries[i].value.to_bytes(3, byteorder='big')
-                else:
-                    buffer += self.entries[i].value.to_bytes(4, byteorder='big')
-            else:
-                buffer += b'\x00' * (4 if self.is_last else 5)
-        assert len(buffer) == self.page_size
-        return buffer
+    def serialize(self) -> memoryview:
+        # Read only view of the table, it follows later changes to the table
+        return memoryview(self.data).toreadonly()
 
     def write_back_to_memory(self, memory_address: int, mmu: Memory):
         mmu.write_bytes(memory_address, self.serialize())
 
     def load_from_memory(self, memory_address: int, mmu: Memory):
-        self.deserialize(mmu.read_bytes(memory_address, self.page_size))
+        self.deserialize(mmu.read_view(memory_address, self.page_size))
 
     def __contains__(self, item):
-        return item in self.entries and self.entries[item].valid
+        return 0 <= item < 2 ** self.page_bit and bool(self.data[item * self.entry_size] & VALID_BIT)
 
 
 class MultiLevelPageTable:
-    def __init__(self, mmu: Memory, levels: Union[None, List[int]] = None) -> None:
+    def __init__(self, mmu: Memory, levels: Union[None, List[int]] = None, huge_pages: bool = False) -> None:
+        """
+        With huge_pages, an L1 entry can be a leaf mapping the whole 2 ** (32 - levels[0]) bytes it covers
+        to contiguous frames, the walk then stops at the L1 page table
+        """
         if levels is None:
             levels = [6, 8, 6]
         self.page_levels = levels
         assert len(levels) == 3
         assert sum(levels) == 20
+        self.huge_pages = huge_pages
+        self.huge_page_bits = 32 - levels[0]
+        self.huge_page_frames = 2 ** (self.huge_page_bits - PageSize)
 
         self.L1PageTable = PageTable(page_bits=self.page_levels[0])
         self.L2PageTable = PageTable(page_bits=self.page_levels[1])
@@ -100,7 +119,8 @@ class MultiLevelPageTable:
         self.root_page_address = mmu.allocate_page(self.L1PageTable.page_size)[0]
         self.last_empty_address = self.root_page_address + self.L1PageTable.page_size
 
-        self.L1PageTable = PageTable(page_bits=self.page_levels[0], address=self.root_page_address)
+        self.L1PageTable = PageTable(page_bits=self.page_levels[0], address=self.root_page_address,
+                                     huge_pages=huge_pages)
 
     def initial(self):
         self.L1PageTable = PageTable(page_bits=self.page_levels[0])
@@ -108,7 +128,8 @@ class MultiLevelPageTable:
         self.L3PageTable = PageTable(page_bits=self.page_levels[2], is_last=True)
         self.root_page_address = self.mmu.allocate_page(self.L1PageTable.page_size)[0]
 
-        self.L1PageTable = PageTable(address=self.root_page_address, page_bits=self.page_levels[0])
+        self.L1PageTable = PageTable(address=self.root_page_address, page_bits=self.page_levels[0],
+                                     huge_pages=self.huge_pages)
         self.last_empty_address = self.root_page_address + self.L1PageTable.page_size
 
     def allocate_page(self, page_level: int):
@@ -128,10 +149,16 @@ class MultiLevelPageTable:
             self.last_empty_address = new_page_address + page_size
         return new_page_address
 
+    def l1_index(self, address: int) -> int:
+        return address >> (32 - self.page_levels[0])
+
+    def l2_index(self, address: int) -> int:
+        return page_index(address) & (2 ** self.page_levels[1] - 1)
+
     def query_l1(self, address: int) -> int:
-        l1_index = address >> (32 - self.page_levels[0])
+        l1_index = self.l1_index(address)
         if l1_index in self.L1PageTable:
-            return self.L1PageTable.entries[l1_index].value
+            return self.L1PageTable.value(l1_index)
         else:
             # Allocate a new L2 page table
             # If it can be allocated in the same page
@@ -139,25 +166,40 @@ class MultiLevelPageTable:
 
             # Update L1 page table
             self.L1PageTable.add_entry(l1_index, new_l2_physical_address)
-            return self.L1PageTable.entries[l1_index].value
+            return new_l2_physical_address
+
+    def query_huge(self, address: int, allocate: bool) -> Optional[int]:
+        """
+        First frame of the huge page holding address when its L1 entry is a leaf, None otherwise
+        With allocate, an empty L1 entry is mapped to a new huge page instead of an L2 page table
+        """
+        l1_index = self.l1_index(address)
+        if l1_index in self.L1PageTable:
+            return self.L1PageTable.value(l1_index) if self.L1PageTable.is_leaf(l1_index) else None
+        if not allocate:
+            return None
+        first_frame = self.mmu.allocate_contiguous(self.huge_page_frames)
+        self.L1PageTable.add_entry(l1_index, first_frame, leaf=True)
+        return first_frame
 
     def query_l2(self, address: int) -> int:
-        l2_index = page_index(address) & (2 ** self.page_levels[1] - 1)
+        l2_index = self.l2_index(address)
         if l2_index in self.L2PageTable:
-            return self.L2PageTable.entries[l2_index].value
+            return self.L2PageTable.value(l2_index)
 
         else:
             # Allocate a new L3 page table
             new_l3_physical_address = self.allocate_page(page_level=3)
             self.L2PageTable.add_entry(l2_index, new_l3_physical_address)
 
-        return self.L2PageTable.entries[l2_index].value
+        return new_l3_physical_address
 
     def query_l3(self, address: int) -> int:
         l3_index = page_index(address) & (2 ** self.page_levels[2] - 1)
-        if l3_index in self.L3PageTable and self.L3PageTable.entries[l3_index].value != 0:
-            return self.L3PageTable.entries[l3_index].value
-        else:
-            new_page_address = self.mmu.allocate_page(1)[0]
-            self.L3PageTable.add_entry(l3_index, new_page_address)
-        return self.L3PageTable.entries[l3_index].value
+        if l3_index in self.L3PageTable:
+            value = self.L3PageTable.value(l3_index)
+            if value != 0:
+                return value
+        new_page_address = self.mmu.allocate_page(1)[0]
+        self.L3PageTable.add_entry(l3_index, new_page_address)
+        return new_page_address
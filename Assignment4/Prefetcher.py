@@ -0,0 +1,124 @@
+from Utils import *
+from collections import OrderedDict
+from typing import List
+
+
+class Prefetcher:
+    def __init__(self, cache_line_size: int, degree: int = 2) -> None:
+        """
+        Trained on the line addresses of the accesses that miss L1, access returns the line addresses to
+        bring into L2, at most degree of them per access
+        """
+        self.cache_line_size = cache_line_size
+        self.degree = degree
+
+    def access(self, address: int) -> List[int]:
+        return []
+
+    def flush(self) -> None:
+        pass
+
+
+class NextLinePrefetcher(Prefetcher):
+    def access(self, address: int) -> List[int]:
+        line = address - address % self.cache_line_size
+        return [line + i * self.cache_line_size for i in range(1, self.degree + 1)]
+
+
+class StrideEntry:
+    def __init__(self, last_address: int) -> None:
+        self.last_address = last_address
+        self.stride = 0
+        self.confidence = 0
+
+
+class StridePrefetcher(Prefetcher):
+    # Saturating confidence counter, prefetching starts once a stride repeated this often
+    MAX_CONFIDENCE = 3
+    THRESHOLD = 2
+
+    def __init__(self, cache_line_size: int, degree: int = 2, table_size: int = 64, region_bits: int = 12) -> None:
+        """
+        Without program counters the reference prediction table is keyed by address region,
+        the accesses of one 2 ** region_bits bytes region are assumed to come from one stream
+        The table keeps table_size regions in LRU order
+        """
+        super().__init__(cache_line_size, degree)
+        self.table_size = table_size
+        self.region_bits = region_bits
+        self.table: OrderedDict = OrderedDict()
+
+    def access(self, address: int) -> List[int]:
+        region = address >> self.region_bits
+        entry = self.table.get(region)
+        if entry is None:
+            if len(self.table) >= self.table_size:
+                self.table.popitem(last=False)
+            self.table[region] = StrideEntry(address)
+            return []
+        self.table.move_to_end(region)
+
+        stride = address - entry.last_address
+        entry.last_address = address
+        if stride == 0:
+            return []
+        if stride == entry.stride:
+            entry.confidence = min(entry.confidence + 1, self.MAX_CONFIDENCE)
+        else:
+            entry.stride = stride
+            entry.confidence = max(entry.confidence - 1, 0)
+        if entry.confidence < self.THRESHOLD:
+            return []
+
+        # Strides below a line still move on to the next line
+        step = stride if abs(stride) >= self.cache_line_size else \
+            (self.cache_line_size if stride > 0 else -self.cache_line_size)
+        line = address - address % self.cache_line_size
+        return [line + i * step for i in range(1, self.degree + 1) if line + i * step >= 0]
+
+    def flush(self) -> None:
+        self.table.clear()
+
+
+class StreamPrefetcher(Prefetcher):
+    def __init__(self, cache_line_size: int, degree: int = 2, buffers: int = 4, depth: int = 4) -> None:
+        """
+        Stream buffers: a miss outside every buffer allocates one, least recently used first, covering the
+        depth lines after it. A miss inside a buffer moves the buffer past it and tops it up, at most degree
+        lines per access. Streams are ascending
+        """
+        super().__init__(cache_line_size, degree)
+        self.buffers = buffers
+        self.depth = depth
+        # First line number the buffer covers -> next line number to prefetch, in LRU order
+        self.streams: OrderedDict = OrderedDict()
+
+    def access(self, address: int) -> List[int]:
+        line = address // self.cache_line_size
+        for start, next_line in self.streams.items():
+            if start <= line < next_line:
+                del self.streams[start]
+                break
+        else:
+            if len(self.streams) >= self.buffers:
+                self.streams.popitem(last=False)
+            next_line = line + 1
+
+        # Keep depth lines ahead of the miss
+        end = min(line + 1 + self.depth, next_line + self.degree)
+        self.streams[line + 1] = max(end, next_line)
+        return [prefetch_line * self.cache_line_size for prefetch_line in range(next_line, end)]
+
+    def flush(self) -> None:
+        self.streams.clear()
+
+
+def make_prefetcher(prefetcher_type: PrefetcherType, cache_line_size: int, degree: int = 2,
+                    table_size: int = 64, buffers: int = 4, depth: int = 4) -> Prefetcher:
+    if prefetcher_type == PrefetcherType.NextLine:
+        return NextLinePrefetcher(cache_line_size, degree)
+    elif prefetcher_type == PrefetcherType.Stride:
+        return StridePrefetcher(cache_line_size, degree, table_size)
+    elif prefetcher_type == PrefetcherType.Stream:
+        return StreamPrefetcher(cache_line_size, degree, buffers, depth)
+    raise ValueError(prefetcher_type)
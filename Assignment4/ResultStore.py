@@ -0,0 +1,108 @@
+from Simulator import SimulatorConfigure
+from dataclasses import fields
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import os
+import pickle
+import shutil
+
+# Bump when simulation semantics change in a way the source digest below cannot see
+SIMULATOR_VERSION = 1
+
+# Modules whose source decides a simulation result
+SIMULATOR_SOURCES = ["Cache.py", "CacheHierarchy.py", "LatencyHistogram.py", "Memory.py", "MultiCore.py", "Page.py",
+                     "Prefetcher.py", "Simulator.py", "TLBCache.py", "Trace.py", "Utils.py"]
+
+
+def simulator_version() -> str:
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SIMULATOR_SOURCES:
+        with open(os.path.join(directory, name), 'rb') as file:
+            digest.update(file.read())
+    return f"v{SIMULATOR_VERSION}-{digest.hexdigest()[:16]}"
+
+
+_trace_digests: Dict[Tuple[str, int, int], str] = {}
+
+
+def trace_digest(file_path: str) -> str:
+    """
+    Hash of the trace contents, remembered per (path, size, mtime) so each trace is read once
+    """
+    stat = os.stat(file_path)
+    cache_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if cache_key not in _trace_digests:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        _trace_digests[cache_key] = digest.hexdigest()
+    return _trace_digests[cache_key]
+
+
+def config_key(config: SimulatorConfigure) -> str:
+    """
+    Content address of one simulation: the trace contents plus every other configuration field
+    """
+    digest = hashlib.sha256(trace_digest(config.file_path).encode())
+    for field in fields(config):
+        if field.name != 'file_path':
+            digest.update(f"{field.name}={getattr(config, field.name)!r};".encode())
+    return digest.hexdigest()
+
+
+class ResultStore:
+    def __init__(self, root: str = "./result_store", version: Optional[str] = None, keep_stale: bool = False) -> None:
+        """
+        Results live in root/<simulator version>/<config key>.pickle
+        Unless keep_stale is set, results of every other simulator version are evicted on open
+        """
+        self.root = root
+        self.version = version or simulator_version()
+        self.directory = os.path.join(self.root, self.version)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+        if not keep_stale:
+            self.evict_stale()
+
+    def path(self, config: SimulatorConfigure) -> str:
+        return os.path.join(self.directory, config_key(config) + '.pickle')
+
+    def get(self, config: SimulatorConfigure) -> Optional[dict]:
+        path = self.path(config)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        with open(path, 'rb') as file:
+            result = pickle.load(file)
+        self.hits += 1
+        return result
+
+    def put(self, config: SimulatorConfigure, result: dict) -> None:
+        # Write then rename, an interrupted write never leaves a truncated result behind
+        path = self.path(config)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as file:
+            pickle.dump(result, file)
+        os.replace(temp_path, path)
+
+    def __contains__(self, config: SimulatorConfigure) -> bool:
+        return os.path.exists(self.path(config))
+
+    def stale_versions(self) -> List[str]:
+        return [name for name in os.listdir(self.root)
+                if name != self.version and os.path.isdir(os.path.join(self.root, name))]
+
+    def evict_stale(self) -> List[str]:
+        stale = self.stale_versions()
+        for name in stale:
+            shutil.rmtree(os.path.join(self.root, name))
+        return stale
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
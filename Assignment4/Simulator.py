@@ -1,15 +1,20 @@
-from Page import MultiLevelPageTable
-from TLBCache import TLB
+from Page import MultiLevelPageTable, PageTable
+from TLBCache import TLB, TLBHierarchy, PageWalkCache, translate
 from enum import Enum
 import matplotlib.pyplot as plt
-import pickle
-from collections import Counter
-from dataclasses import dataclass
-from typing import List
+import random
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, replace
+from itertools import accumulate
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from Utils import *
-from Memory import Memory
-from Cache import Level2Cache, SplitCache
-import multiprocessing
+from Memory import Memory, MappedMemory
+from Prefetcher import make_prefetcher
+from Cache import AssociativeCacheBase, DirectCacheBase, Level2Cache, SplitCache, MissStatusHoldingRegisters
+from CacheHierarchy import CacheHierarchy, CacheLevelSpec
+from LatencyHistogram import LatencyProfile, LATENCY_OPS, PERCENTILES
+from Trace import TRACE_SUFFIX, load_binary_trace, trace_columns
+import numpy as np
 
 
 class Instruction:
@@ -44,14 +49,122 @@ class SimulatorConfigure:
     TLB_size: int = 16
     TLB_access: int = 1
 
+    TLB_associativity: int = Associativity.FullyAssociative
+    TLB_n_way: int = 4
+    # TLBs only implement FIFO, LRU and Random
+    TLB_replace_algorithm: int = CacheReplaceAlgorithm.FIFO
+    # Separate instruction and data TLBs, TLB_size entries split between the two
+    TLB_split: bool = False
+
+    # Second level TLB shared by instructions and data, looked up after an L1 TLB miss, 0 entries disables it
+    STLB_size: int = 0
+    STLB_access: int = 7
+    STLB_associativity: int = Associativity.SetAssociative
+    STLB_n_way: int = 8
+    STLB_replace_algorithm: int = CacheReplaceAlgorithm.LRU
+
+    # Entries per upper page table level in the page walk cache, 0 disables it
+    # With it, walks skip the cached levels and only write back the page tables they changed
+    page_walk_cache_size: int = 0
+
+    # Virtual address ranges [start, end) backed by huge pages, the first walk into an empty L1 entry
+    # of a range maps the 2 ** 26 bytes the entry covers at once and later walks stop at the L1 page table
+    huge_page_regions: Tuple[Tuple[int, int], ...] = ()
+
+    # Cache levels from L1 down, when given they replace separate_instruction_data and the L1_* and L2_* settings
+    # The victim cache is only available with the two level caches
+    cache_levels: Tuple[CacheLevelSpec, ...] = ()
+
     Memory_access: int = 100
 
+    # None keeps the original model: a write miss writes memory and both levels, a hit only updates the caches
+    # and evicted lines are dropped. WriteBack or WriteThrough track dirty lines and memory write traffic
+    write_policy: Optional[WritePolicy] = None
+    # Without it, a write miss goes straight to memory, only used with a write policy
+    write_allocate: bool = True
+    # Cycles charged for every line written to memory by a write back or a write through
+    Memory_write_access: int = 100
+
+    # Prefetcher trained on the accesses that miss L1, it brings lines into L2, None disables it
+    # A prefetched line arrives Memory_access cycles after it is issued, a demand access before that waits
+    prefetcher: Optional[PrefetcherType] = None
+    prefetch_degree: int = 2
+    # Regions tracked by the stride prefetcher
+    prefetch_table_size: int = 64
+    # Stream buffers and the lines each one runs ahead, for the stream prefetcher
+    prefetch_stream_buffers: int = 4
+    prefetch_stream_depth: int = 4
+
+    # Lines in the fully associative victim cache behind every L1, 0 disables it
+    # A line found there costs L1_cache_access + victim_cache_access and swaps back into L1
+    victim_cache_size: int = 0
+    victim_cache_access: int = 1
+
+    # Miss status holding registers of L1, 0 keeps every miss blocking
+    # With them the core only waits for instruction fetches and page table reads, data reads and writes go on
+    # after the L1 lookup while their line is in flight. A miss waits when every register is busy and an access
+    # to a line in flight merges into its register
+    mshr_entries: int = 0
+
+    # Record a log bucketed histogram of instruction latencies by op, TLB outcome and serving level
+    latency_histograms: bool = False
+
+    # Keep simulated physical memory in a sparse memory mapped temporary file instead of page objects
+    mapped_memory: bool = False
+
+    # Pull instructions lazily from the trace file instead of parsing it up front
+    streaming: bool = False
+    stream_chunk_size: int = 1 * Size.MB
+
+    # Seed for the random replacement policy, None keeps the global random state
+    random_seed: Optional[int] = None
+
+    # Caches only track tags, data accesses are timed without carrying line payloads
+    # Page table contents are read and written straight from memory
+    # This changes the cache results, not only the speed: in functional mode page tables are read back through
+    # the caches from pages the original model wipes and reallocates (see simu_read_data), so the walks and
+    # the lines they touch differ. Compare results of one mode only, a sweep case never mixes the two
+    timing_only: bool = False
+
+
+OPS = tuple(OP)
+
+# Depth in the cache hierarchy of the level serving an access, for the two level caches
+LEVEL_DEPTH = {CacheLevel.L1: 0, CacheLevel.Victim: 0, CacheLevel.L2: 1, CacheLevel.NoCache: 2}
+
+# Stand in for the written value when timing_only, only its length matters
+EMPTY_WORD = bytes(4)
+
 
 def parse_instructions(instruction: str):
     op, address, value = instruction.split(' ')
     return Instruction(op=OP(int(op)), address=int(address, 16), value=int(value, 16))
 
 
+def iter_instructions(file_path: str, chunk_size: int = 1 * Size.MB):
+    """
+    Lazily parse a trace file, reading roughly chunk_size bytes of lines at a time
+    """
+    with open(file_path, 'r') as file:
+        while True:
+            lines = file.readlines(chunk_size)
+            if not lines:
+                break
+            for line in lines:
+                yield parse_instructions(line)
+
+
+def iter_records(ops: np.ndarray, addresses: np.ndarray, values: np.ndarray, chunk_size: int = 64 * Size.KB):
+    """
+    Replay decoded trace columns, converting them to Python ints one chunk at a time
+    """
+    for start in range(0, len(ops), chunk_size):
+        end = start + chunk_size
+        for op, address, value in zip(ops[start:end].tolist(), addresses[start:end].tolist(),
+                                      values[start:end].tolist()):
+            yield Instruction(op=OPS[op], address=address, value=value)
+
+
 def address_align(address: int, cache_size: int):
     # Ensure the address is the multiple of cache_size
     return address // cache_size * cache_size
@@ -68,15 +181,62 @@ def address_needed(address: int, size: int, unit: int):
 
 
 class Simulator:
-    def __init__(self, config: SimulatorConfigure):
+    def __init__(self, config: SimulatorConfigure,
+                 trace: Union[None, np.ndarray, Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+                 memory: Optional[Memory] = None, page_table: Optional[MultiLevelPageTable] = None,
+                 l2_cache: Optional[DirectCacheBase] = None):
+        """
+        memory, page_table and l2_cache are shared with other simulators when given, see MultiCore.py
+        """
+        # In functional mode the page tables read back depend on what the caches held, so the lines reaching L2
+        # change with the L2 policy and no recorded future holds for OPT
+        assert config.timing_only or CacheReplaceAlgorithm.OPT not in \
+            [config.L2_replace_algorithm] + [spec.replace_algorithm for spec in config.cache_levels], \
+            "OPT needs timing_only"
 
         self.config = config
         self.file_path = config.file_path
-        self.memory = Memory(start_address=0)
-        self.multi_page = MultiLevelPageTable(self.memory, levels=[6, 8, 6])
-        self.tlb = TLB(config.TLB_size)
+        # Binary trace records or decoded (op, address, value) arrays (see Trace.py),
+        # shared read only between simulators replaying the same trace
+        if trace is None and self.file_path.endswith(TRACE_SUFFIX):
+            trace = load_binary_trace(self.file_path)
+        self.trace = None if trace is None else trace_columns(trace)
+        if config.random_seed is not None:
+            random.seed(config.random_seed)
+        if memory is None:
+            memory = MappedMemory(start_address=0) if config.mapped_memory else Memory(start_address=0)
+        self.memory = memory
+        if page_table is None:
+            page_table = MultiLevelPageTable(self.memory, levels=[6, 8, 6], huge_pages=bool(config.huge_page_regions))
+        self.multi_page = page_table
+        # Page table contents by (table address, table size), only used when timing_only
+        self.page_tables: Dict[Tuple[int, int], bytearray] = {}
+        # tlb translates data accesses, itlb instruction fetches, both are the same TLB unless TLB_split
+        tlb_size = config.TLB_size // 2 if config.TLB_split else config.TLB_size
+        self.tlb = TLB(tlb_size, config.TLB_replace_algorithm, config.TLB_associativity, config.TLB_n_way)
+        if config.TLB_split:
+            self.itlb = TLB(tlb_size, config.TLB_replace_algorithm, config.TLB_associativity, config.TLB_n_way)
+        else:
+            self.itlb = self.tlb
 
-        if self.config.separate_instruction_data:
+        if config.STLB_size:
+            self.stlb = TLB(config.STLB_size, config.STLB_replace_algorithm, config.STLB_associativity,
+                            config.STLB_n_way)
+            self.tlb_hierarchy = TLBHierarchy([self.tlb, self.stlb], [config.TLB_access, config.STLB_access])
+            self.itlb_hierarchy = TLBHierarchy([self.itlb, self.stlb], [config.TLB_access, config.STLB_access])
+        else:
+            self.stlb = None
+            self.tlb_hierarchy = TLBHierarchy([self.tlb], [config.TLB_access])
+            self.itlb_hierarchy = TLBHierarchy([self.itlb], [config.TLB_access])
+        self.page_walk_cache = PageWalkCache(config.page_walk_cache_size) if config.page_walk_cache_size else None
+
+        if config.cache_levels:
+            assert config.victim_cache_size == 0, "The victim cache is only available with the two level caches"
+            self.cache = CacheHierarchy(config.cache_levels, store_data=not config.timing_only,
+                                        write_policy=config.write_policy, write_allocate=config.write_allocate)
+            latencies = [spec.access for spec in config.cache_levels]
+            self.cache_line_size = config.cache_levels[0].cache_line_size
+        elif self.config.separate_instruction_data:
             self.cache = SplitCache(
                 l1_cache_size=config.L1_cache_size,
                 l1_cache_line_size=config.L1_cacheline_size,
@@ -85,7 +245,12 @@ class Simulator:
                 l2_cache_line_size=config.L2_cacheline_size,
                 l2_cache_policy=config.L2_replace_algorithm,
                 l2_cache_associativity=config.L2_associativity,
-                l2_n_way=config.L2_n_way
+                l2_n_way=config.L2_n_way,
+                store_data=not config.timing_only,
+                write_policy=config.write_policy,
+                write_allocate=config.write_allocate,
+                victim_cache_size=config.victim_cache_size,
+                l2_cache=l2_cache
             )
         else:
             self.cache = Level2Cache(
@@ -96,21 +261,91 @@ class Simulator:
                 l2_cache_line_size=config.L2_cacheline_size,
                 l2_cache_policy=config.L2_replace_algorithm,
                 l2_cache_associativity=config.L2_associativity,
-                l2_n_way=config.L2_n_way
+                l2_n_way=config.L2_n_way,
+                store_data=not config.timing_only,
+                write_policy=config.write_policy,
+                write_allocate=config.write_allocate,
+                victim_cache_size=config.victim_cache_size,
+                l2_cache=l2_cache
             )
+        if not config.cache_levels:
+            latencies = [config.L1_cache_access, config.L2_cache_access]
+            self.cache_line_size = config.L1_cacheline_size
+        # Cycles of an access served by each cache level, the last one served by memory
+        self.access_cycles = list(accumulate(latencies + [config.Memory_access]))
+
+        self.cache.write_memory = self.write_memory
+        # Called with (address, cache level, write) after every cache lookup, before the line is read or written
+        self.coherence: Optional[Callable[[int, CacheLevel, bool], None]] = None
+
+        if config.prefetcher is not None:
+            self.prefetcher = make_prefetcher(config.prefetcher, self.cache_line_size, config.prefetch_degree,
+                                              config.prefetch_table_size, config.prefetch_stream_buffers,
+                                              config.prefetch_stream_depth)
+        else:
+            self.prefetcher = None
+        # Prefetched lines not used yet -> cycle they arrive in L2, at most as many as L2 holds
+        self.prefetched: OrderedDict = OrderedDict()
+
+        self.mshr = MissStatusHoldingRegisters(config.mshr_entries) if config.mshr_entries else None
 
-        self.instructions = self.parse_file()
+        if self.config.streaming or self.trace is not None:
+            self.instructions = None
+        else:
+            self.instructions = self.parse_file()
+        self.instruction_count = 0
 
         self.cycle = 0
 
         self.tlb_hit = 0
         self.tlb_access = 0
 
-        self.l1_hit = 0
-        self.l1_access = 0
+        self.stlb_hit = 0
+        self.stlb_access = 0
 
-        self.l2_hit = 0
-        self.l2_access = 0
+        self.pwc_hit = 0
+        self.pwc_access = 0
+
+        self.page_walks = 0
+        self.huge_page_walks = 0
+        self.page_walk_cycles = 0
+
+        # Accesses served by each cache level, the last entry counts the ones served by memory
+        self.served = [0] * len(self.access_cycles)
+        self.victim_hit = 0
+        # Deepest level that served the data accesses of the current instruction
+        self.served_depth = 0
+        if config.latency_histograms:
+            self.latency = LatencyProfile([f"L{depth + 1}" for depth in range(len(self.served) - 1)] + ["Memory"])
+        else:
+            self.latency = None
+
+        self.memory_writes = 0
+        self.memory_write_cycles = 0
+
+        self.prefetch_issued = 0
+        self.prefetch_useful = 0
+        self.prefetch_late = 0
+
+    def level_accesses(self, depth: int) -> int:
+        # Every access served at depth or below looked the level up, victim cache hits missed L1
+        return sum(self.served[depth:]) + (self.victim_hit if depth == 0 else 0)
+
+    @property
+    def l1_hit(self) -> int:
+        return self.served[0]
+
+    @property
+    def l1_access(self) -> int:
+        return self.level_accesses(0)
+
+    @property
+    def l2_hit(self) -> int:
+        return self.served[1]
+
+    @property
+    def l2_access(self) -> int:
+        return self.level_accesses(1)
 
     def parse_file(self):
         instruction_list: List[Instruction] = []
@@ -121,291 +356,427 @@ class Simulator:
 
         return instruction_list
 
-    def page_walk(self, address: int):
-        page_base_address = self.multi_page.root_page_address
-
-        # L1 page table
-        page_content = self.simu_read_data(page_base_address, self.multi_page.L1PageTable.page_size)
-        self.multi_page.L1PageTable.deserialize(page_content)
+    def instruction_stream(self):
+        if self.instructions is not None:
+            return self.instructions
+        if self.trace is not None:
+            return iter_records(*self.trace)
+        return iter_instructions(self.file_path, self.config.stream_chunk_size)
+
+    def read_page_table(self, page_table: PageTable, address: int):
+        if self.config.timing_only:
+            # The table works directly on the buffer kept for its address, queries update it in place
+            page_table.data = self.page_tables.setdefault((address, page_table.page_size),
+                                                          bytearray(page_table.page_size))
+            page_table.dirty = False
+            self.simu_touch_lines(self.read_line_addresses(address, page_table.page_size)[1])
+        else:
+            page_table.deserialize(self.simu_read_data(address, page_table.page_size))
 
-        # L2 page table
-        l2_base_address = self.multi_page.query_l1(address)
-        l2_page_content = self.simu_read_data(l2_base_address, self.multi_page.L2PageTable.page_size)
-        self.multi_page.L2PageTable.deserialize(l2_page_content)
+    def write_page_table(self, page_table: PageTable, address: int):
+        if self.config.timing_only:
+            self.simu_touch_lines(self.write_line_addresses(address, page_table.page_size)[1], write=True)
+        else:
+            self.simu_write_data(address, page_table.serialize())
+
+    def in_huge_page_region(self, address: int) -> bool:
+        return any(start <= address < end for start, end in self.config.huge_page_regions)
+
+    def page_walk(self, address: int) -> int:
+        frame_number, page_bits = self.walk(address)
+        return translate(address, frame_number, page_bits)
+
+    def walk(self, address: int) -> Tuple[int, int]:
+        """
+        Walk the page tables for address
+        return (first frame, page bits) of the page mapping it
+        """
+        start_cycle = self.cycle
+        self.page_walks += 1
+        page_base_address = self.multi_page.root_page_address
+        l2_base_address = l3_base_address = None
+        walked = []
+
+        # The longest cached prefix decides where the walk starts
+        if self.page_walk_cache is not None:
+            self.pwc_access += 1
+            l1_key = self.multi_page.l1_index(address)
+            l2_key = (l1_key << self.multi_page.page_levels[1]) | self.multi_page.l2_index(address)
+            l3_base_address = self.page_walk_cache.query(2, l2_key)
+            if l3_base_address is None:
+                l2_base_address = self.page_walk_cache.query(1, l1_key)
+            if l2_base_address is not None or l3_base_address is not None:
+                self.pwc_hit += 1
+
+        if l3_base_address is None:
+            if l2_base_address is None:
+                # L1 page table
+                self.read_page_table(self.multi_page.L1PageTable, page_base_address)
+                walked.append((self.multi_page.L1PageTable, page_base_address))
+
+                # A leaf L1 entry maps a huge page, the walk ends here
+                if self.multi_page.huge_pages:
+                    frame_number = self.multi_page.query_huge(address, self.in_huge_page_region(address))
+                    if frame_number is not None:
+                        self.huge_page_walks += 1
+                        self.write_back_walked(walked)
+                        self.page_walk_cycles += self.cycle - start_cycle
+                        return frame_number, self.multi_page.huge_page_bits
+
+                l2_base_address = self.multi_page.query_l1(address)
+
+            # L2 page table
+            self.read_page_table(self.multi_page.L2PageTable, l2_base_address)
+            walked.append((self.multi_page.L2PageTable, l2_base_address))
+            l3_base_address = self.multi_page.query_l2(address)
+
+            if self.page_walk_cache is not None:
+                self.page_walk_cache.update(1, l1_key, l2_base_address)
+                self.page_walk_cache.update(2, l2_key, l3_base_address)
 
         # L3 page table
-        l3_base_address = self.multi_page.query_l2(address)
-        l3_page_content = self.simu_read_data(l3_base_address, self.multi_page.L3PageTable.page_size)
-        self.multi_page.L3PageTable.deserialize(l3_page_content)
+        self.read_page_table(self.multi_page.L3PageTable, l3_base_address)
+        walked.append((self.multi_page.L3PageTable, l3_base_address))
 
         # Physical address
         physical_address = self.multi_page.query_l3(address)
 
-        # Update write back
-        self.simu_write_data(page_base_address, self.multi_page.L1PageTable.serialize())
-        self.simu_write_data(l2_base_address, self.multi_page.L2PageTable.serialize())
-        self.simu_write_data(l3_base_address, self.multi_page.L3PageTable.serialize())
+        self.write_back_walked(walked)
+        self.page_walk_cycles += self.cycle - start_cycle
+        return physical_address, PageSize
 
-        return physical_address
+    def write_back_walked(self, walked: List[Tuple[PageTable, int]]):
+        # Update write back, only the tables that changed when the page walk cache is on
+        for page_table, table_address in walked:
+            if self.page_walk_cache is None or page_table.dirty:
+                self.write_page_table(page_table, table_address)
 
-    def address_translate(self, v_address: int):
-        self.cycle += 1
+    def address_translate(self, v_address: int, instruction: bool = False):
+        hierarchy = self.itlb_hierarchy if instruction else self.tlb_hierarchy
+        level, entry = hierarchy.lookup(v_address)
+        self.cycle += hierarchy.lookup_cycles[level]
         self.tlb_access += 1
-
-        if v_address in self.tlb:
+        if level == 0:
             self.tlb_hit += 1
-            p_address = self.tlb.query(v_address).frame_number
+        elif self.stlb is not None:
+            self.stlb_access += 1
+            if level == 1:
+                self.stlb_hit += 1
+
+        if entry is not None:
+            p_address = entry.translate(v_address)
         else:
-            p_address = self.page_walk(v_address)
-            while p_address == 0:
+            frame_number, page_bits = self.walk(v_address)
+            while frame_number == 0:
                 print("Oops Zero p_address!")
-                p_address = self.page_walk(v_address)
-            self.tlb.update(v_address, p_address)
+                frame_number, page_bits = self.walk(v_address)
+            hierarchy.update(v_address, frame_number, page_bits)
+            p_address = translate(v_address, frame_number, page_bits)
         # print(hex(v_address), "->", hex(p_address))
 
+        # The accesses of the instruction come next, the page walk ones do not decide where it was served
+        self.served_depth = 0
+
         return p_address
 
     def simu_read_instruction(self, address: int):
-        if address in self.cache:
-            cache_level, result = self.cache.read_cache(address)
-            if cache_level == CacheLevel.L1:
-                self.cycle += self.config.L1_cache_access
-                self.l1_hit += 1
-                self.l1_access += 1
-            elif cache_level == CacheLevel.L2:
-                self.l1_access += 1
-                self.l2_access += 1
-                self.l2_hit += 1
-                self.cycle += self.config.L2_cache_access + self.config.L1_cache_access
-            else:
-                self.l1_access += 1
-                self.l2_access += 1
-        else:
+        cache_level, slot = self.cache.lookup(address)
+        if self.coherence is not None:
+            self.coherence(address, cache_level, False)
+        if slot < 0:
             if address not in self.memory:
                 self.memory.allocate_page_at_address(address)
-            result = self.memory.read_bytes(address, self.config.L1_cacheline_size)
-            self.l1_access += 1
-            self.l2_access += 1
-            self.cache.write_cache(address, result)
-            self.cycle += self.config.Memory_access + self.config.L2_cache_access + self.config.L1_cache_access
-
-    def simu_read_data(self, address: int, size: int = 4):
-        need_size = size
-        # p_address = self.address_translate(address)
-        aligned_address = address_align(address, self.config.L1_cacheline_size)
+            self.cache.fill(address, self.memory.read_bytes(address, self.cache_line_size))
+        else:
+            self.cache.read(address, cache_level, slot)
+        self.count_cache_access(cache_level, address)
+
+    def count_cache_access(self, cache_level: Union[CacheLevel, int], address: int = 0, blocking: bool = True):
+        """
+        cache_level is what the cache lookup returned, the depth of the serving level for a CacheHierarchy
+        """
+        depth = cache_level if type(cache_level) is int else LEVEL_DEPTH[cache_level]
+        victim = cache_level == CacheLevel.Victim
+        if depth > self.served_depth:
+            self.served_depth = depth
+        if (depth or victim) and self.prefetcher is not None:
+            self.prefetch(address, depth)
+
+        if victim:
+            self.victim_hit += 1
+            self.cycle += self.access_cycles[0] + self.config.victim_cache_access
+            return
+        self.served[depth] += 1
+        if self.mshr is None:
+            self.cycle += self.access_cycles[depth]
+        else:
+            self.cycle = self.mshr.access(address - address % self.cache_line_size, self.cycle + self.access_cycles[0],
+                                          self.access_cycles[depth] - self.access_cycles[0], blocking)
+
+    def prefetch(self, address: int, depth: int):
+        """
+        Credit the prefetch that brought in a line hit in L2 (depth 1), then train the prefetcher on the access
+        and issue its prefetches
+        """
+        line_size = self.cache_line_size
+        ready = self.prefetched.pop(address - address % line_size, None)
+        if ready is not None and depth == 1:
+            self.prefetch_useful += 1
+            if ready > self.cycle:
+                # Late, the line is still on its way from memory
+                self.prefetch_late += 1
+                self.cycle = ready
+
+        for prefetch_address in self.prefetcher.access(address):
+            if self.config.timing_only:
+                value = None
+            elif page_index(prefetch_address) in self.memory:
+                value = self.memory.read_bytes(prefetch_address, line_size)
+            else:
+                # Nothing to prefetch from a frame that was never allocated
+                continue
+            if self.cache.prefetch(prefetch_address, value):
+                self.prefetch_issued += 1
+                self.prefetched[prefetch_address] = self.cycle + self.config.Memory_access
+                if len(self.prefetched) > self.cache.L2Cache.cache_line_num:
+                    self.prefetched.popitem(last=False)
+
+    def read_line_addresses(self, address: int, size: int):
+        aligned_address = address_align(address, self.cache_line_size)
         aligned_size = address - aligned_address
         # padding
         padding_size = 0
-        while aligned_size % self.config.L1_cacheline_size:
+        while aligned_size % self.cache_line_size:
             aligned_size += 1
             padding_size += 1
+        return aligned_size, address_needed(aligned_address, aligned_size + size + padding_size,
+                                            self.cache_line_size)
 
-        needed_addresses = address_needed(aligned_address, aligned_size + need_size + padding_size,
-                                          self.config.L1_cacheline_size)
+    def write_line_addresses(self, address: int, size: int):
+        aligned_address = address_align(address, self.cache_line_size)
+        aligned_size = address - aligned_address
+        return aligned_size, address_needed(aligned_address, aligned_size + size, self.cache_line_size)
+
+    def write_memory(self, address: int, value: Optional[bytes]):
+        # A line written back or written through to memory
+        self.memory_writes += 1
+        self.memory_write_cycles += self.config.Memory_write_access
+        self.cycle += self.config.Memory_write_access
+        if value is not None:
+            if page_index(address) not in self.memory:
+                self.memory.allocate_page_at_address(address)
+            self.memory.write_bytes(address, value)
+
+    def simu_touch_lines(self, addresses: List[int], write: bool = False, blocking: bool = True):
+        # Tag only accesses for timing_only, a miss fills both levels without touching memory
+        blocking = blocking and not write
+        write_policy = write and self.config.write_policy is not None
+        for address in addresses:
+            cache_level, slot = self.cache.lookup(address)
+            if self.coherence is not None:
+                self.coherence(address, cache_level, write)
+            if slot < 0:
+                if write_policy:
+                    self.cache.write_miss(address, None)
+                else:
+                    self.cache.fill(address, None)
+            elif write_policy:
+                self.cache.write(address, cache_level, slot, None)
+            else:
+                # Promote into L1 as a functional read or write would
+                self.cache.read(address, cache_level, slot)
+            self.count_cache_access(cache_level, address, blocking)
+
+    def simu_read_data(self, address: int, size: int = 4, blocking: bool = True):
+        # p_address = self.address_translate(address)
+        aligned_size, needed_addresses = self.read_line_addresses(address, size)
+
+        if self.config.timing_only:
+            self.simu_touch_lines(needed_addresses, blocking=blocking)
+            return None
 
         result = b''
 
-        for idx, address in enumerate(needed_addresses):
-            if address in self.cache:
-                cache_level, r_result = self.cache.read_cache(address)
-                result += r_result
-                if cache_level == CacheLevel.L1:
-                    self.cycle += self.config.L1_cache_access
-                    self.l1_hit += 1
-                    self.l1_access += 1
-                elif cache_level == CacheLevel.L2:
-                    self.l1_access += 1
-                    self.l2_access += 1
-                    self.l2_hit += 1
-                    self.cycle += self.config.L2_cache_access + self.config.L1_cache_access
-                else:
-                    self.l1_access += 1
-                    self.l2_access += 1
-            else:
-                if address not in self.memory:
+        for address in needed_addresses:
+            cache_level, slot = self.cache.lookup(address)
+            if self.coherence is not None:
+                self.coherence(address, cache_level, False)
+            if slot < 0:
+                # The original model looks the byte address up among page numbers, so it reallocates and wipes
+                # pages it reads from, with a write policy memory has to stay consistent
+                page = address if self.config.write_policy is None else page_index(address)
+                if page not in self.memory:
                     self.memory.allocate_page_at_address(address)
-                result += self.memory.read_bytes(address, self.config.L1_cacheline_size)
-                self.l1_access += 1
-                self.l2_access += 1
-                self.cache.write_cache(address, result[-self.config.L1_cacheline_size:])
-                self.cycle += self.config.Memory_access + self.config.L2_cache_access + self.config.L1_cache_access
+                line = self.memory.read_bytes(address, self.cache_line_size)
+                self.cache.fill(address, line)
+            else:
+                line = self.cache.read(address, cache_level, slot)
+            result += line
+            self.count_cache_access(cache_level, address, blocking)
 
         result = result[aligned_size:aligned_size + size]
         return result
 
     def simu_write_data(self, address: int, data: bytes):
         # p_address = self.address_translate(address)
-        aligned_address = address_align(address, self.config.L1_cacheline_size)
-        aligned_size = address - aligned_address
+        aligned_size, needed_address = self.write_line_addresses(address, len(data))
+
+        if self.config.timing_only:
+            self.simu_touch_lines(needed_address, write=True)
+            return
+
         data = b'\x00' * aligned_size + data
-        need_size = len(data)
-        while need_size % self.config.L1_cacheline_size:
+        while len(data) % self.cache_line_size:
             data += b'\x00'
-            need_size = len(data)
-        assert need_size % self.config.L1_cacheline_size == 0
-
-        needed_address = address_needed(aligned_address, need_size, self.config.L1_cacheline_size)
-        sliced_data = [data[i:i + self.config.L1_cacheline_size] for i in
-                       range(0, len(data), self.config.L1_cacheline_size)]
+        sliced_data = [data[i:i + self.cache_line_size] for i in
+                       range(0, len(data), self.cache_line_size)]
 
         for idx, address in enumerate(needed_address):
-            if len(sliced_data[idx]) != self.config.L1_cacheline_size:
-                print("Oops, not aligned!", len(sliced_data[idx]), self.cache.L1Cache.cache_line_size)
-            if address in self.cache:
-                cache_level = self.cache.write_cache(address, sliced_data[idx])
-                if cache_level == CacheLevel.L1:
-                    self.l1_access += 1
-                    self.l1_hit += 1
-                    self.cycle += self.config.L1_cache_access
-                elif cache_level == CacheLevel.L2:
-                    self.l1_access += 1
-                    self.l2_access += 1
-                    self.l2_hit += 1
-                    self.cycle += self.config.L2_cache_access + self.config.L1_cache_access
-            else:
+            cache_level, slot = self.cache.lookup(address)
+            if self.coherence is not None:
+                self.coherence(address, cache_level, True)
+            if slot < 0 and self.config.write_policy is not None:
+                self.cache.write_miss(address, sliced_data[idx])
+            elif slot < 0:
                 self.memory.write_bytes(address, sliced_data[idx])
                 # Not Count, run simultaneously
-                self.cache.write_cache(address, sliced_data[idx])
-                self.l1_access += 1
-                self.l2_access += 1
-                self.cycle += self.config.Memory_access + self.config.L2_cache_access + self.config.L1_cache_access
+                self.cache.fill(address, sliced_data[idx])
+            else:
+                self.cache.write(address, cache_level, slot, sliced_data[idx])
+            self.count_cache_access(cache_level, address, blocking=False)
+
+    def record_l2_probes(self) -> List[int]:
+        """
+        Replay the trace once with FIFO in L2 and return the lines L2 is probed with, the future OPT needs
+        Which lines reach L2 only depends on L1 and the TLBs when timing_only, so the replay matches the OPT run
+        exactly. An inclusive or exclusive L2 changes what L1 holds, OPT is approximate then
+        """
+        cache_levels = self.config.cache_levels
+        if cache_levels:
+            cache_levels = (cache_levels[0], replace(cache_levels[1], replace_algorithm=CacheReplaceAlgorithm.FIFO)) \
+                           + tuple(cache_levels[2:])
+        recorder = Simulator(replace(self.config, L2_replace_algorithm=CacheReplaceAlgorithm.FIFO,
+                                     cache_levels=cache_levels), self.trace)
+        recorder.cache.L2Cache.probe_log = []
+        recorder.start_simulation()
+        if self.config.random_seed is not None:
+            random.seed(self.config.random_seed)
+        return recorder.cache.L2Cache.probe_log
 
     def start_simulation(self):
-        for instruction in self.instructions:
-            if instruction.op == OP.MemoryRead:
-                self.simu_read_data(self.address_translate(instruction.address), 4)
-                # self.memory.read_bytes(self.address_translate(instruction.address), 4)
-            elif instruction.op == OP.MemoryWrite:
+        l2_cache = self.cache.L2Cache
+        if l2_cache.replace_algorithm == CacheReplaceAlgorithm.OPT and \
+                isinstance(l2_cache, AssociativeCacheBase) and l2_cache.future is None:
+            l2_cache.set_future(self.record_l2_probes())
+
+        for instruction in self.instruction_stream():
+            self.execute(instruction)
+
+    def execute(self, instruction: Instruction):
+        self.instruction_count += 1
+        start_cycle, tlb_hit = self.cycle, self.tlb_hit
+        if instruction.op == OP.MemoryRead:
+            self.simu_read_data(self.address_translate(instruction.address), 4, blocking=False)
+            # self.memory.read_bytes(self.address_translate(instruction.address), 4)
+        elif instruction.op == OP.MemoryWrite:
+            if self.config.timing_only:
+                self.simu_write_data(self.address_translate(instruction.address), EMPTY_WORD)
+            else:
                 self.simu_write_data(self.address_translate(instruction.address),
                                      instruction.value.to_bytes(4, 'big'))
-            elif instruction.op == OP.Flush:
-                self.cache.flush()
-                self.tlb.flush()
-            elif instruction.op == OP.InstructionFetch:
-                self.simu_read_data(self.address_translate(instruction.address), 4)
-            else:
-                pass
+        elif instruction.op == OP.Flush:
+            self.flush()
+        elif instruction.op == OP.InstructionFetch:
+            self.simu_read_data(self.address_translate(instruction.address, instruction=True), 4)
+        else:
+            pass
+        if self.latency is not None and instruction.op in LATENCY_OPS:
+            self.latency.record(instruction.op, self.tlb_hit > tlb_hit, self.served_depth, self.cycle - start_cycle)
+
+    def flush(self):
+        self.cache.flush()
+        self.tlb.flush()
+        if self.itlb is not self.tlb:
+            self.itlb.flush()
+        if self.stlb is not None:
+            self.stlb.flush()
+        if self.page_walk_cache is not None:
+            self.page_walk_cache.flush()
+        if self.prefetcher is not None:
+            self.prefetcher.flush()
+            self.prefetched.clear()
+        if self.mshr is not None:
+            self.mshr.flush()
 
     def result(self):
         print(f"TLB Hit Rate: {self.tlb_hit / self.tlb_access, self.tlb_hit, self.tlb_access}")
-        print(f"L1 Hit Rate: {self.l1_hit / self.l1_access, self.l1_hit, self.l1_access}")
-        print(f"L2 Hit Rate: {self.l2_hit / self.l2_access, self.l2_hit, self.l2_access}")
+        if self.stlb_access:
+            print(f"STLB Hit Rate: {self.stlb_hit / self.stlb_access, self.stlb_hit, self.stlb_access}")
+        if self.pwc_access:
+            print(f"PWC Hit Rate: {self.pwc_hit / self.pwc_access, self.pwc_hit, self.pwc_access}")
+        if self.huge_page_walks:
+            print(f"Huge Page Walks: {self.huge_page_walks, self.page_walks}")
+        print(f"Page Walk Cycles: {self.page_walk_cycles, self.page_walks}")
+        levels = len(self.served) - 1
+        for depth in range(levels):
+            hits, accesses = self.served[depth], self.level_accesses(depth)
+            print(f"L{depth + 1} Hit Rate: {hits / accesses, hits, accesses}")
+        if self.config.cache_levels:
+            print(f"Back Invalidations: {self.cache.back_invalidations}")
+        if self.config.write_policy is not None:
+            if self.config.cache_levels:
+                print(f"Writebacks: {tuple(self.cache.writebacks)}")
+            else:
+                print(f"Writebacks: {self.cache.l1_writebacks, self.cache.l2_writebacks}")
+            print(f"Memory Writes: {self.memory_writes, self.memory_write_cycles}")
+        if self.prefetcher is not None:
+            print(f"Prefetches: {self.prefetch_issued, self.prefetch_useful, self.prefetch_late}")
+        if self.config.victim_cache_size:
+            print(f"Victim Cache Hits: {self.victim_hit, self.l1_access - self.l1_hit}")
+        mshr = self.mshr or MissStatusHoldingRegisters(0)
+        if self.mshr is not None:
+            print(f"MSHR: {mshr.allocations, mshr.merges, mshr.full_stalls, mshr.stall_cycles}")
+        if self.latency is not None:
+            for name, summary in self.latency.summary().items():
+                if summary["count"]:
+                    percentiles = tuple(summary[f"p{percent}"] for percent in PERCENTILES)
+                    print(f"Latency {name} p{PERCENTILES}: {percentiles, summary['count']}")
         print(f"Total Cycles: {self.cycle}")
-        print(f"Average Cycles: {self.cycle / len(self.instructions)}")
-        return {"TLB_hit": self.tlb_hit, "TLB_access": self.tlb_access,
-                "L1_hit": self.l1_hit, "L1_access": self.l1_access,
-                "L2_hit": self.l2_hit, "L2_access": self.l2_access,
-                "Total_Cycles": self.cycle, "Average_Cycles": self.cycle / len(self.instructions)}
+        print(f"Average Cycles: {self.cycle / self.instruction_count}")
+        result = {"TLB_hit": self.tlb_hit, "TLB_access": self.tlb_access,
+                  "STLB_hit": self.stlb_hit, "STLB_access": self.stlb_access,
+                  "PWC_hit": self.pwc_hit, "PWC_access": self.pwc_access,
+                  "Page_walks": self.page_walks, "Huge_page_walks": self.huge_page_walks,
+                  "Page_walk_cycles": self.page_walk_cycles,
+                  "L1_hit": self.l1_hit, "L1_access": self.l1_access,
+                  "L2_hit": self.l2_hit, "L2_access": self.l2_access,
+                  "L1_writebacks": self.cache.l1_writebacks, "L2_writebacks": self.cache.l2_writebacks,
+                  "Memory_writes": self.memory_writes, "Memory_write_cycles": self.memory_write_cycles,
+                  "Prefetch_issued": self.prefetch_issued, "Prefetch_useful": self.prefetch_useful,
+                  "Prefetch_late": self.prefetch_late, "Victim_hit": self.victim_hit,
+                  "MSHR_allocations": mshr.allocations, "MSHR_merges": mshr.merges,
+                  "MSHR_full_stalls": mshr.full_stalls, "MSHR_stall_cycles": mshr.stall_cycles,
+                  "Total_Cycles": self.cycle, "Average_Cycles": self.cycle / self.instruction_count}
+        if self.config.cache_levels:
+            # Levels below L2 and the inclusion traffic of a configured hierarchy
+            for depth in range(2, levels):
+                result[f"L{depth + 1}_hit"] = self.served[depth]
+                result[f"L{depth + 1}_access"] = self.level_accesses(depth)
+                result[f"L{depth + 1}_writebacks"] = self.cache.writebacks[depth]
+            result["Back_invalidations"] = self.cache.back_invalidations
+        if self.latency is not None:
+            result["Latency"] = self.latency.summary()
+        return result
 
     def plot_instruction_address_range(self):
         instruction_address = []
-        for instruction in self.instructions:
+        for instruction in self.instruction_stream():
             instruction_address.append(instruction.address >> 12)
         print(Counter(instruction_address))
 
 
-def test_case_1():
-    config = SimulatorConfigure()
-    config.file_path = "./spec_benchmark/015.doduc.din"
-    total_result = {"Split": {}, "Unified": {}}
-    for split, name in [(True, "Split"), (False, "Unified")]:
-        for cache_line_size in [32 * Size.B, 64 * Size.B, 128 * Size.B]:
-            for l1_size, l1_latency in [(32 * Size.KB, 1), (64 * Size.KB, 2)]:
-                for l2_size, l2_latency in [(512 * Size.KB, 8), (1024 * Size.KB, 12), (2 * 1024 * Size.KB, 16)]:
-                    for tlb_size in [8, 16]:
-                        config.separate_instruction_data = split
-                        config.L2_replace_algorithm = CacheReplaceAlgorithm.FIFO
-                        config.L2_n_way = 4
-                        config.TLB_size = tlb_size
-                        config.L1_cacheline_size = cache_line_size
-                        config.L1_cache_size = l1_size
-                        config.L1_cache_access = l1_latency
-                        config.L2_cacheline_size = cache_line_size
-                        config.L2_cache_size = l2_size
-                        config.L2_cache_access = l2_latency
-                        simulator = Simulator(config)
-                        simulator.parse_file()
-                        simulator.start_simulation()
-                        res = simulator.result()
-                        total_result[name][(cache_line_size, l1_size, l2_size, tlb_size)] = res
-
-    print(total_result)
-    with open("case1.pickle", 'wb') as file:
-        pickle.dump(total_result, file)
-        file.close()
-
-
-def test_case_2():
-    config = SimulatorConfigure()
-    config.file_path = "./spec_benchmark/015.doduc.din"
-    total_result = {"FIFO": {}, "LRU": {}, "Random": {}}
-    for replace_algorithm, name in [(CacheReplaceAlgorithm.FIFO, "FIFO"), (CacheReplaceAlgorithm.LRU, "LRU"),
-                                    (CacheReplaceAlgorithm.Random, "Random")]:
-        for cache_line_size in [32 * Size.B, 64 * Size.B, 128 * Size.B]:
-            for l1_size, l1_latency in [(32 * Size.KB, 1), (64 * Size.KB, 2)]:
-                for l2_size, l2_latency in [(512 * Size.KB, 8), (1024 * Size.KB, 12), (2 * 1024 * Size.KB, 16)]:
-                    for tlb_size in [8, 16]:
-                        config.separate_instruction_data = True
-                        config.L2_replace_algorithm = replace_algorithm
-                        config.L2_n_way = 4
-                        config.TLB_size = tlb_size
-                        config.L1_cacheline_size = cache_line_size
-                        config.L1_cache_size = l1_size
-                        config.L1_cache_access = l1_latency
-                        config.L2_cacheline_size = cache_line_size
-                        config.L2_cache_size = l2_size
-                        config.L2_cache_access = l2_latency
-                        simulator = Simulator(config)
-                        simulator.parse_file()
-                        simulator.start_simulation()
-                        res = simulator.result()
-                        total_result[name][(cache_line_size, l1_size, l2_size, tlb_size)] = res
-
-    print(total_result)
-    with open("case2.pickle", 'wb') as file:
-        pickle.dump(total_result, file)
-        file.close()
-
-
-def test_case_3():
-    config = SimulatorConfigure()
-    config.file_path = "./spec_benchmark/015.doduc.din"
-    total_result = {"Direct": {}, "2-way": {}, "4-way": {}}
-    for n_way, name in [(4, "4-way"), (2, "2-way"), (1, "Direct")]:
-        for cache_line_size in [32 * Size.B, 64 * Size.B, 128 * Size.B]:
-            for l1_size, l1_latency in [(32 * Size.KB, 1), (64 * Size.KB, 2)]:
-                for l2_size, l2_latency in [(512 * Size.KB, 8), (1024 * Size.KB, 12), (2 * 1024 * Size.KB, 16)]:
-                    for tlb_size in [8, 16]:
-                        config.separate_instruction_data = True
-                        config.L2_replace_algorithm = CacheReplaceAlgorithm.Random
-                        config.L2_n_way = n_way
-                        config.TLB_size = tlb_size
-                        config.L1_cacheline_size = cache_line_size
-                        config.L1_cache_size = l1_size
-                        config.L1_cache_access = l1_latency
-                        config.L2_cacheline_size = cache_line_size
-                        config.L2_cache_size = l2_size
-                        config.L2_cache_access = l2_latency
-                        simulator = Simulator(config)
-                        instructions = simulator.parse_file()
-                        simulator.start_simulation()
-                        res = simulator.result()
-                        total_result[name][(cache_line_size, l1_size, l2_size, tlb_size)] = res
-
-    print(total_result)
-    with open("case3.pickle", 'wb') as file:
-        pickle.dump(total_result, file)
-        file.close()
-
-
 if __name__ == '__main__':
-    t1 = multiprocessing.Process(target=test_case_1)
-    t2 = multiprocessing.Process(target=test_case_2)
-    t3 = multiprocessing.Process(target=test_case_3)
-    t1.start()
-    t2.start()
-    t3.start()
-    t1.join()
-    t2.join()
-    t3.join()
-
+    # Same as python Sweep.py
+    import sys
+    from Sweep import main
+    main(sys.argv[1:])
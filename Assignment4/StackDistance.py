@@ -0,0 +1,145 @@
+from Utils import *
+from Trace import load_din, trace_columns
+from typing import Dict, List, Tuple
+import math
+
+
+class StackDistanceProfiler:
+    def __init__(self, set_counts: List[int], max_ways: int) -> None:
+        """
+        Mattson stack distance profiling of LRU caches, one pass over a stream of cache line numbers
+        Every set count keeps its own per-set recency stacks, truncated at max_ways entries since deeper
+        reuses miss in every cache of the grid anyway
+        histogram[d] counts accesses whose per-set reuse distance is d, histogram[max_ways] counts the misses
+        """
+        self.max_ways = max_ways
+        self.set_counts = sorted(set(set_counts))
+        for num_sets in self.set_counts:
+            assert num_sets & (num_sets - 1) == 0, "The number of sets must be a power of two"
+
+        self.accesses = 0
+        self.stacks: Dict[int, List[List[int]]] = {}
+        self.histograms: Dict[int, List[int]] = {num_sets: [0] * (max_ways + 1) for num_sets in self.set_counts}
+        self.flush()
+
+    def flush(self) -> None:
+        self.stacks = {num_sets: [[] for _ in range(num_sets)] for num_sets in self.set_counts}
+
+    def access(self, line: int) -> None:
+        self.accesses += 1
+        max_ways = self.max_ways
+        for num_sets, stacks in self.stacks.items():
+            stack = stacks[line & (num_sets - 1)]
+            try:
+                distance = stack.index(line)
+                del stack[distance]
+            except ValueError:
+                distance = max_ways
+                if len(stack) == max_ways:
+                    stack.pop()
+            stack.insert(0, line)
+            self.histograms[num_sets][distance] += 1
+
+    def hits(self, num_sets: int, n_way: int) -> int:
+        # An LRU set of n_way lines holds exactly the lines whose reuse distance is below n_way
+        assert n_way <= self.max_ways
+        return sum(self.histograms[num_sets][:n_way])
+
+
+class DirectMappedProfile:
+    def __init__(self, split: bool, cache_line_size: int, cache_size: int, next_level: StackDistanceProfiler) -> None:
+        """
+        Tag only direct mapped L1 that forwards its misses to next_level
+        """
+        self.split = split
+        self.cache_line_size = cache_line_size
+        self.cache_size = cache_size
+        self.next_level = next_level
+
+        self.offset_bits = int(math.log2(cache_line_size))
+        self.cache_line_num = (cache_size // 2 if split else cache_size) // cache_line_size
+        self.hits = 0
+        self.data_tags: List[int] = []
+        self.instruction_tags: List[int] = []
+        self.flush()
+
+    def flush(self) -> None:
+        self.data_tags = [-1] * self.cache_line_num
+        self.instruction_tags = [-1] * self.cache_line_num if self.split else self.data_tags
+        self.next_level.flush()
+
+    def access(self, address: int, is_instruction: bool) -> None:
+        line = address >> self.offset_bits
+        tags = self.instruction_tags if is_instruction else self.data_tags
+        index = line % self.cache_line_num
+        if tags[index] == line:
+            self.hits += 1
+        else:
+            tags[index] = line
+            self.next_level.access(line)
+
+
+def profile_hierarchy(trace, cache_line_sizes: List[int], l1_sizes: List[int], l2_configs: List[Tuple[int, int]],
+                      splits: Tuple[bool, ...] = (True, False)) -> Dict[bool, Dict[Tuple[int, int, int, int], dict]]:
+    """
+    Hit counts of a direct mapped L1 and an LRU L2 for every combination of the grid, in one trace pass
+    l2_configs is a list of (L2 size, L2 ways)
+    A split L1 gives instruction fetches and data accesses half of the L1 each
+    Every trace access touches the line holding its address, page walks and address translation are not modelled
+    return {split: {(cache line size, L1 size, L2 size, L2 ways): {"L1_hit", "L1_access", "L2_hit", "L2_access"}}}
+    """
+    ops, addresses, _ = trace_columns(trace)
+    max_ways = max(n_way for _, n_way in l2_configs)
+
+    # One direct mapped L1 per organisation, its misses feed an L2 profiler covering all L2 sizes and ways
+    l1_caches = []
+    for split in splits:
+        for cache_line_size in cache_line_sizes:
+            set_counts = [l2_size // (cache_line_size * n_way) for l2_size, n_way in l2_configs]
+            for l1_size in l1_sizes:
+                l1_caches.append(DirectMappedProfile(split, cache_line_size, l1_size,
+                                                     StackDistanceProfiler(set_counts, max_ways)))
+
+    instruction_fetch = OP.InstructionFetch.value
+    flush = OP.Flush.value
+    accesses = 0
+    for op, address in zip(ops.tolist(), addresses.tolist()):
+        if op == flush:
+            for l1 in l1_caches:
+                l1.flush()
+            continue
+        if op > instruction_fetch:
+            continue
+        accesses += 1
+        is_instruction = op == instruction_fetch
+        for l1 in l1_caches:
+            l1.access(address, is_instruction)
+
+    result = {split: {} for split in splits}
+    for l1 in l1_caches:
+        for l2_size, n_way in l2_configs:
+            num_sets = l2_size // (l1.cache_line_size * n_way)
+            result[l1.split][(l1.cache_line_size, l1.cache_size, l2_size, n_way)] = {
+                "L1_hit": l1.hits, "L1_access": accesses,
+                "L2_hit": l1.next_level.hits(num_sets, n_way), "L2_access": l1.next_level.accesses,
+            }
+    return result
+
+
+def lru_hit_rates(trace) -> Dict[str, Dict[Tuple[int, int, int, int], dict]]:
+    """
+    Quick LRU approximation over the cache and L2 sizes of the assignment cases, in a single trace pass
+    It works on virtual addresses without page walks, with an LRU L2 and every instruction fetch in the
+    instruction half of a split L1, so it does not reproduce the FIFO results of Sweep.case_1_grid
+    """
+    cache_line_sizes = [32 * Size.B, 64 * Size.B, 128 * Size.B]
+    l1_sizes = [32 * Size.KB, 64 * Size.KB]
+    l2_configs = [(512 * Size.KB, 4), (1024 * Size.KB, 4), (2 * 1024 * Size.KB, 4)]
+    result = profile_hierarchy(trace, cache_line_sizes, l1_sizes, l2_configs)
+    return {"Split": result[True], "Unified": result[False]}
+
+
+if __name__ == '__main__':
+    for name, configs in lru_hit_rates(load_din("./spec_benchmark/015.doduc.din")).items():
+        for key, stats in configs.items():
+            print(name, key, stats["L1_hit"] / stats["L1_access"], stats["L2_hit"] / max(stats["L2_access"], 1))
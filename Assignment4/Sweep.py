@@ -0,0 +1,219 @@
+from Simulator import Simulator, SimulatorConfigure
+from CacheHierarchy import CacheLevelSpec
+from ResultStore import ResultStore
+from Trace import ensure_binary_trace, load_binary_trace
+from Utils import *
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+
+BENCHMARK = "./spec_benchmark/015.doduc.din"
+
+
+@dataclass
+class SweepPoint:
+    case: str
+    group: str
+    key: Tuple
+    config: SimulatorConfigure
+
+
+def hierarchy_grid(case: str, group: str, config: SimulatorConfigure) -> List[SweepPoint]:
+    """
+    Cache line size x L1 size x L2 size x TLB size on top of config, keyed like the original test cases
+    """
+    points = []
+    for cache_line_size in [32 * Size.B, 64 * Size.B, 128 * Size.B]:
+        for l1_size, l1_latency in [(32 * Size.KB, 1), (64 * Size.KB, 2)]:
+            for l2_size, l2_latency in [(512 * Size.KB, 8), (1024 * Size.KB, 12), (2 * 1024 * Size.KB, 16)]:
+                for tlb_size in [8, 16]:
+                    point_config = replace(config,
+                                           TLB_size=tlb_size,
+                                           L1_cacheline_size=cache_line_size,
+                                           L1_cache_size=l1_size,
+                                           L1_cache_access=l1_latency,
+                                           L2_cacheline_size=cache_line_size,
+                                           L2_cache_size=l2_size,
+                                           L2_cache_access=l2_latency)
+                    points.append(SweepPoint(case, group, (cache_line_size, l1_size, l2_size, tlb_size), point_config))
+    return points
+
+
+def case_1_grid(file_path: str = BENCHMARK) -> List[SweepPoint]:
+    # Split versus unified L1
+    points = []
+    for split, name in [(True, "Split"), (False, "Unified")]:
+        config = SimulatorConfigure(file_path=file_path, separate_instruction_data=split,
+                                    L2_replace_algorithm=CacheReplaceAlgorithm.FIFO, L2_n_way=4, random_seed=0)
+        points += hierarchy_grid("case1", name, config)
+    return points
+
+
+def case_2_grid(file_path: str = BENCHMARK, with_opt: bool = False) -> List[SweepPoint]:
+    # L2 replacement algorithm
+    # with_opt adds case2_opt, every policy and Belady's bound timed on tags only since OPT needs timing_only
+    points = []
+    policies = [(CacheReplaceAlgorithm.FIFO, "FIFO"), (CacheReplaceAlgorithm.LRU, "LRU"),
+                (CacheReplaceAlgorithm.Random, "Random")]
+    for replace_algorithm, name in policies:
+        config = SimulatorConfigure(file_path=file_path, separate_instruction_data=True,
+                                    L2_replace_algorithm=replace_algorithm, L2_n_way=4, random_seed=0)
+        points += hierarchy_grid("case2", name, config)
+    if with_opt:
+        for replace_algorithm, name in policies + [(CacheReplaceAlgorithm.OPT, "OPT")]:
+            config = SimulatorConfigure(file_path=file_path, separate_instruction_data=True,
+                                        L2_replace_algorithm=replace_algorithm, L2_n_way=4, random_seed=0,
+                                        timing_only=True)
+            points += hierarchy_grid("case2_opt", name, config)
+    return points
+
+
+def case_3_grid(file_path: str = BENCHMARK) -> List[SweepPoint]:
+    # L2 associativity
+    points = []
+    for n_way, name in [(4, "4-way"), (2, "2-way"), (1, "Direct")]:
+        config = SimulatorConfigure(file_path=file_path, separate_instruction_data=True,
+                                    L2_replace_algorithm=CacheReplaceAlgorithm.Random, L2_n_way=n_way, random_seed=0)
+        points += hierarchy_grid("case3", name, config)
+    return points
+
+
+def case_4_grid(file_path: str = BENCHMARK) -> List[SweepPoint]:
+    # Cheap alternatives to doubling L1: a victim cache or miss status holding registers on the 32KB L1
+    points = []
+    config = SimulatorConfigure(file_path=file_path, separate_instruction_data=True,
+                                L2_replace_algorithm=CacheReplaceAlgorithm.FIFO, L2_n_way=4, random_seed=0)
+    variants = [("32KB", {}), ("64KB", {"L1_cache_size": 64 * Size.KB, "L1_cache_access": 2}),
+                ("Victim-8", {"victim_cache_size": 8}), ("Victim-16", {"victim_cache_size": 16}),
+                ("MSHR-8", {"mshr_entries": 8})]
+    for name, changes in variants:
+        for cache_line_size in [32 * Size.B, 64 * Size.B, 128 * Size.B]:
+            point_config = replace(config, L1_cacheline_size=cache_line_size, L2_cacheline_size=cache_line_size,
+                                   **changes)
+            points.append(SweepPoint("case4", name, (cache_line_size,), point_config))
+    return points
+
+
+def case_5_grid(file_path: str = BENCHMARK) -> List[SweepPoint]:
+    # Inclusion policy of the L2 and the shared L3 of a three level hierarchy, timed on tags only
+    points = []
+    for inclusion in InclusionPolicy:
+        for cache_line_size in [32 * Size.B, 64 * Size.B, 128 * Size.B]:
+            levels = (CacheLevelSpec(32 * Size.KB, cache_line_size, access=1),
+                      CacheLevelSpec(256 * Size.KB, cache_line_size, n_way=4, access=8, inclusion=inclusion),
+                      CacheLevelSpec(2 * 1024 * Size.KB, cache_line_size, n_way=16, access=20, inclusion=inclusion))
+            config = SimulatorConfigure(file_path=file_path, cache_levels=levels, random_seed=0, timing_only=True)
+            points.append(SweepPoint("case5", inclusion.name, (cache_line_size,), config))
+    return points
+
+
+# Trace shared by every point a worker runs, memory mapped once per worker process
+_worker_trace = None
+
+
+def _init_worker(trace_path: str) -> None:
+    global _worker_trace
+    _worker_trace = load_binary_trace(trace_path)
+
+
+def _run_point(point: SweepPoint) -> Tuple[SweepPoint, dict]:
+    simulator = Simulator(point.config, _worker_trace)
+    simulator.start_simulation()
+    return point, simulator.result()
+
+
+def run_sweep(points: List[SweepPoint], stream_path: str = "sweep.jsonl", processes: Optional[int] = None,
+              store: Optional[ResultStore] = None) -> Dict[str, Dict[str, Dict[Tuple, dict]]]:
+    """
+    Run every point on a process pool sized to the machine
+    Each result is appended to stream_path as a JSON line as soon as it finishes
+    With a store, points already computed are skipped and new results are saved as they arrive,
+    so an interrupted sweep resumes where it stopped
+    return {case: {group: {key: result}}}
+    """
+    trace_paths = {point.config.file_path for point in points}
+    assert len(trace_paths) == 1, "A sweep replays a single trace"
+    trace_path = ensure_binary_trace(trace_paths.pop())
+    # The two modes give different cache results, the points of one case are only comparable in one of them
+    modes = {}
+    for point in points:
+        modes.setdefault(point.case, set()).add(point.config.timing_only)
+    assert all(len(case_modes) == 1 for case_modes in modes.values()), "A case mixes timing_only and functional"
+
+    total_result = {}
+    for point in points:
+        total_result.setdefault(point.case, {}).setdefault(point.group, {})
+
+    pending = []
+    for point in points:
+        result = store.get(point.config) if store is not None else None
+        if result is None:
+            pending.append(point)
+        else:
+            total_result[point.case][point.group][point.key] = result
+
+    if not pending:
+        return total_result
+
+    with open(stream_path, 'a') as stream, \
+            multiprocessing.Pool(min(processes or os.cpu_count(), len(pending)), initializer=_init_worker,
+                                 initargs=(trace_path,)) as pool:
+        for point, result in pool.imap_unordered(_run_point, pending):
+            total_result[point.case][point.group][point.key] = result
+            if store is not None:
+                store.put(point.config, result)
+            stream.write(json.dumps({"case": point.case, "group": point.group, "key": list(point.key),
+                                     "result": result}) + "\n")
+            stream.flush()
+
+    return total_result
+
+
+def save_cases(total_result: Dict[str, Dict[str, Dict[Tuple, dict]]]) -> None:
+    for case, case_result in total_result.items():
+        with open(f"{case}.pickle", 'wb') as file:
+            pickle.dump(case_result, file)
+
+
+def test_case_1():
+    save_cases(run_sweep(case_1_grid(), store=ResultStore()))
+
+
+def test_case_2():
+    save_cases(run_sweep(case_2_grid(with_opt=True), store=ResultStore()))
+
+
+def test_case_3():
+    save_cases(run_sweep(case_3_grid(), store=ResultStore()))
+
+
+def test_case_4():
+    save_cases(run_sweep(case_4_grid(), store=ResultStore()))
+
+
+def test_case_5():
+    save_cases(run_sweep(case_5_grid(), store=ResultStore()))
+
+
+# Cases run when none is named on the command line
+DEFAULT_CASES = {"case1": case_1_grid, "case2": partial(case_2_grid, with_opt=True), "case3": case_3_grid}
+# Cases only run when named
+EXTRA_CASES = {"case4": case_4_grid, "case5": case_5_grid}
+
+
+def main(cases: List[str]) -> None:
+    grids = {**DEFAULT_CASES, **EXTRA_CASES}
+    points = []
+    for case in cases or DEFAULT_CASES:
+        points += grids[case]()
+    # All the cases share one pool so every core stays busy
+    save_cases(run_sweep(points, store=ResultStore()))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
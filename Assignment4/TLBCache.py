@@ -1,46 +1,198 @@
 from Utils import *
-from typing import Dict, Optional, Union
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union
+import random
 
 
 class TLBEntry:
-    def __init__(self, page_number: int, frame_number: int, valid: bool = True) -> None:
+    def __init__(self, page_number: int, frame_number: int, valid: bool = True, page_bits: int = PageSize) -> None:
+        """
+        page_number is the virtual address shifted by page_bits, a huge page maps to page frames starting at
+        frame_number, one per 4 KiB of the page
+        """
         self.page_number = page_number
         self.frame_number = frame_number
         self.valid = valid
+        self.page_bits = page_bits
 
+    def translate(self, virtual_address: int) -> int:
+        return translate(virtual_address, self.frame_number, self.page_bits)
 
-class TLB:
-    def __init__(self, tlb_size: int = 16) -> None:
-        self.entries: Dict[int, TLBEntry] = {}
 
-        self.fifo_list = []
+def translate(virtual_address: int, frame_number: int, page_bits: int = PageSize) -> int:
+    # Frame of the 4 KiB page holding virtual_address inside a page of page_bits starting at frame_number
+    if page_bits == PageSize:
+        return frame_number
+    return frame_number + (page_index(virtual_address) & ((1 << (page_bits - PageSize)) - 1))
+
+
+def tlb_key(page_number: int, page_bits: int) -> int:
+    # Pages of different sizes may share a page number, the size goes in the low bits of the key
+    return page_number << 6 | page_bits
+
+
+# Replacement policies a TLB implements, evict would run anything else as FIFO
+TLB_POLICIES = (CacheReplaceAlgorithm.FIFO, CacheReplaceAlgorithm.LRU, CacheReplaceAlgorithm.Random)
+
+
+class TLB:
+    def __init__(self, tlb_size: int = 16, replace_algorithm: CacheReplaceAlgorithm = CacheReplaceAlgorithm.FIFO,
+                 associativity: Associativity = Associativity.FullyAssociative, n_way: int = 4) -> None:
+        """
+        Every set is an OrderedDict from page number to entry, oldest first, so insert and evict are O(1)
+        LRU moves an entry to the end when it is queried, FIFO only follows insertion
+        Random keeps the page numbers of every set in a list and evicts by swapping with the last one
+        Entries of different page sizes share the sets, a lookup probes every page size held so far
+        """
+        assert replace_algorithm in TLB_POLICIES, f"TLBs only support {[policy.name for policy in TLB_POLICIES]}"
         self.size = tlb_size
+        self.replace_algorithm = replace_algorithm
+        if associativity == Associativity.FullyAssociative:
+            n_way = tlb_size
+        elif associativity == Associativity.DirectMapped:
+            n_way = 1
+        assert tlb_size % n_way == 0
+        self.n_way = n_way
+        self.num_sets = tlb_size // n_way
+
+        self.sets: List[OrderedDict] = []
+        self.random_pages: List[List[int]] = []
+        self.random_positions: Dict[int, int] = {}
+        self.page_sizes: List[int] = [PageSize]
+        self.flush()
+
+    def __len__(self):
+        return sum(len(tlb_set) for tlb_set in self.sets)
+
+    def find(self, virtual_address: int) -> Tuple[Optional[OrderedDict], int]:
+        """
+        return (set, key) of the entry translating virtual_address, (None, 0) if there is none
+        """
+        for page_bits in self.page_sizes:
+            page_number = virtual_address >> page_bits
+            tlb_set = self.sets[page_number % self.num_sets]
+            key = tlb_key(page_number, page_bits)
+            if key in tlb_set:
+                return tlb_set, key
+        return None, 0
 
     def __contains__(self, item):
-        return page_index(item) in self.entries
+        return self.find(item)[0] is not None
 
     def __getitem__(self, item):
-        return self.entries[page_index(item)]
+        tlb_set, key = self.find(item)
+        if tlb_set is None:
+            raise KeyError(item)
+        return tlb_set[key]
+
+    def lookup(self, virtual_address: int) -> Optional[TLBEntry]:
+        tlb_set, key = self.find(virtual_address)
+        if tlb_set is None:
+            return None
+        if self.replace_algorithm == CacheReplaceAlgorithm.LRU:
+            tlb_set.move_to_end(key)
+        return tlb_set[key]
 
     def query(self, virtual_address: int) -> TLBEntry:
-        page_number = page_index(virtual_address)
-        assert page_number in self.entries
-        return self.entries[page_number]
+        entry = self.lookup(virtual_address)
+        assert entry is not None
+        return entry
 
-    def update(self, virtual_address: int, frame_number: int) -> None:
-        page_number = page_index(virtual_address)
-        assert page_number not in self.entries
-        if len(self.entries) >= self.size:
-            pop_item = self.fifo_list.pop(0)
-            self.entries.pop(pop_item)
+    def evict(self, set_index: int) -> None:
+        tlb_set = self.sets[set_index]
+        if self.replace_algorithm == CacheReplaceAlgorithm.Random:
+            pages = self.random_pages[set_index]
+            position = random.randrange(len(pages))
+            key = pages[position]
+            last_key = pages.pop()
+            if last_key != key:
+                pages[position] = last_key
+                self.random_positions[last_key] = position
+            del self.random_positions[key]
+            del tlb_set[key]
+        else:
+            tlb_set.popitem(last=False)
 
-        self.entries[page_number] = TLBEntry(page_number, frame_number)
-        self.fifo_list.append(page_number)
+    def update(self, virtual_address: int, frame_number: int, page_bits: int = PageSize) -> None:
+        page_number = virtual_address >> page_bits
+        set_index = page_number % self.num_sets
+        tlb_set = self.sets[set_index]
+        key = tlb_key(page_number, page_bits)
+        assert key not in tlb_set
+        if page_bits not in self.page_sizes:
+            self.page_sizes.append(page_bits)
+        if len(tlb_set) >= self.n_way:
+            self.evict(set_index)
 
-        assert len(self.entries) <= self.size
-        assert len(self.fifo_list) <= self.size
+        tlb_set[key] = TLBEntry(page_number, frame_number, page_bits=page_bits)
+        if self.replace_algorithm == CacheReplaceAlgorithm.Random:
+            self.random_positions[key] = len(self.random_pages[set_index])
+            self.random_pages[set_index].append(key)
+
+        assert len(tlb_set) <= self.n_way
+
+    def flush(self):
+        self.sets = [OrderedDict() for _ in range(self.num_sets)]
+        self.random_pages = [[] for _ in range(self.num_sets)]
+        self.random_positions = {}
+        self.page_sizes = [PageSize]
+
+
+class TLBHierarchy:
+    def __init__(self, levels: List[TLB], latencies: List[int]) -> None:
+        """
+        TLB levels looked up in order, levels[0] first, levels may be shared between hierarchies (a shared STLB)
+        A hit fills the levels above it, a miss in every level is filled by update after the page walk
+        lookup_cycles[level] is the time spent by a lookup served at level, the last entry covers a full miss
+        """
+        assert len(levels) == len(latencies)
+        self.levels = levels
+        self.latencies = latencies
+        self.lookup_cycles = [sum(latencies[:level + 1]) for level in range(len(levels))]
+        self.lookup_cycles.append(self.lookup_cycles[-1])
+
+    def lookup(self, virtual_address: int) -> Tuple[int, Optional[TLBEntry]]:
+        """
+        return (level of the hit, entry), (len(levels), None) on a miss
+        """
+        for level, tlb in enumerate(self.levels):
+            entry = tlb.lookup(virtual_address)
+            if entry is not None:
+                for upper in self.levels[:level]:
+                    upper.update(virtual_address, entry.frame_number, entry.page_bits)
+                return level, entry
+        return len(self.levels), None
+
+    def update(self, virtual_address: int, frame_number: int, page_bits: int = PageSize) -> None:
+        for tlb in self.levels:
+            if virtual_address not in tlb:
+                tlb.update(virtual_address, frame_number, page_bits)
 
     def flush(self):
-        self.entries.clear()
-        self.fifo_list.clear()
+        for tlb in self.levels:
+            tlb.flush()
+
+
+class PageWalkCache:
+    def __init__(self, size: int = 16) -> None:
+        """
+        Paging structure cache, remembers the address of the L2 and L3 page tables a walk went through
+        Level 1 is keyed by the L1 index and gives the L2 table, level 2 is keyed by the L1 and L2 indexes
+        and gives the L3 table, each level holds size entries replaced in FIFO order
+        """
+        self.size = size
+        self.levels: List[Dict[int, int]] = [{}, {}]
 
+    def query(self, level: int, key: int) -> Optional[int]:
+        return self.levels[level - 1].get(key)
+
+    def update(self, level: int, key: int, table_address: int) -> None:
+        entries = self.levels[level - 1]
+        if key not in entries and len(entries) >= self.size:
+            # Dicts keep insertion order, the first key is the oldest one
+            entries.pop(next(iter(entries)))
+        entries[key] = table_address
+
+    def flush(self):
+        for entries in self.levels:
+            entries.clear()
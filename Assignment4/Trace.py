@@ -0,0 +1,158 @@
+from Utils import *
+from typing import Iterator, Optional, Tuple
+import os
+import numpy as np
+
+# Pre-parsed binary trace format
+# | name | magic | count | records         |
+# | byte |   8   |   8   | count * 9 bytes |
+# Each record is | op: uint8 | address: uint32 | value: uint32 |, little endian and packed
+TRACE_DTYPE = np.dtype([('op', np.uint8), ('address', '<u4'), ('value', '<u4')])
+TRACE_MAGIC = b'DINTRACE'
+TRACE_HEADER_SIZE = 16
+TRACE_SUFFIX = '.dinb'
+
+# Hex digit value of every byte, SEPARATOR for whitespace and INVALID for anything else
+SEPARATOR = -1
+INVALID = -2
+HEX_DIGITS = np.full(256, INVALID, dtype=np.int8)
+for _i, _c in enumerate(b'0123456789abcdef'):
+    HEX_DIGITS[_c] = _i
+for _i, _c in enumerate(b'ABCDEF'):
+    HEX_DIGITS[_c] = 10 + _i
+for _c in b' \t\r\n':
+    HEX_DIGITS[_c] = SEPARATOR
+MAX_HEX_DIGITS = 8
+
+
+def decode_din(data: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Decode the text of a .din trace into (op, address, value) arrays without a per-line Python loop
+    data must contain whole lines only
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    digits = np.take(HEX_DIGITS, raw)
+    if np.any(digits == INVALID):
+        raise ValueError("Unexpected character in trace")
+
+    # A field is a run of digits between two separators, -1 and len(raw) act as sentinels
+    separators = np.flatnonzero(digits == SEPARATOR)
+    bounds = np.concatenate(([-1], separators, [len(raw)]))
+    is_newline = np.concatenate(([False], raw[separators] == ord('\n'), [True]))
+    fields = np.flatnonzero(np.diff(bounds) > 1)
+    starts = bounds[fields] + 1
+    lengths = bounds[fields + 1] - starts
+    if np.any(lengths > MAX_HEX_DIGITS):
+        raise ValueError("Trace field does not fit in 32 bits")
+
+    # Every line must hold exactly three fields
+    line = np.cumsum(is_newline)[fields]
+    if len(line) % 3 or np.any(line[1::3] != line[0::3]) or np.any(line[2::3] != line[0::3]) or \
+            np.any(np.diff(line[0::3]) <= 0):
+        raise ValueError("Every trace line must have three fields")
+
+    # Horner's rule over fields of the same length at once
+    values = np.empty(len(starts), dtype=np.uint32)
+    digits = digits.view(np.uint8)
+    for length in range(1, MAX_HEX_DIGITS + 1):
+        selected = np.flatnonzero(lengths == length)
+        if not len(selected):
+            continue
+        positions = starts[selected]
+        value = digits[positions].astype(np.uint32)
+        for i in range(1, length):
+            value <<= 4
+            value |= digits[positions + i]
+        values[selected] = value
+
+    return values[0::3].astype(np.uint8), values[1::3].copy(), values[2::3].copy()
+
+
+def iter_din_chunks(din_path: str, chunk_size: int = 16 * Size.MB) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Decode a .din file chunk_size bytes at a time, cutting every chunk at its last newline
+    """
+    with open(din_path, 'rb') as file:
+        remainder = b''
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                break
+            data = remainder + data
+            cut = data.rfind(b'\n') + 1
+            remainder = data[cut:]
+            if cut:
+                yield decode_din(data[:cut])
+        if remainder.strip():
+            yield decode_din(remainder)
+
+
+def load_din(din_path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    chunks = list(iter_din_chunks(din_path))
+    if not chunks:
+        return np.empty(0, np.uint8), np.empty(0, np.uint32), np.empty(0, np.uint32)
+    return tuple(np.concatenate(column) for column in zip(*chunks))
+
+
+def to_records(op: np.ndarray, address: np.ndarray, value: np.ndarray) -> np.ndarray:
+    records = np.empty(len(op), dtype=TRACE_DTYPE)
+    records['op'] = op
+    records['address'] = address
+    records['value'] = value
+    return records
+
+
+def trace_columns(trace) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Accept either binary trace records or an (op, address, value) tuple and return the three columns
+    """
+    if isinstance(trace, tuple):
+        return trace
+    return trace['op'], trace['address'], trace['value']
+
+
+def convert_din_to_binary(din_path: str, binary_path: Optional[str] = None) -> str:
+    """
+    Pack a text .din trace into the fixed-width binary format, return the binary path
+    """
+    if binary_path is None:
+        binary_path = os.path.splitext(din_path)[0] + TRACE_SUFFIX
+
+    # Write to a temporary file first so a half converted trace is never picked up
+    temp_path = binary_path + '.tmp'
+    count = 0
+    with open(temp_path, 'wb') as file:
+        file.write(b'\x00' * TRACE_HEADER_SIZE)
+        for op, address, value in iter_din_chunks(din_path):
+            to_records(op, address, value).tofile(file)
+            count += len(op)
+        file.seek(0)
+        file.write(TRACE_MAGIC + count.to_bytes(8, byteorder='little'))
+    os.replace(temp_path, binary_path)
+    return binary_path
+
+
+def ensure_binary_trace(din_path: str) -> str:
+    """
+    Return the binary version of din_path, converting it only if missing or out of date
+    """
+    if din_path.endswith(TRACE_SUFFIX):
+        return din_path
+    binary_path = os.path.splitext(din_path)[0] + TRACE_SUFFIX
+    if not os.path.exists(binary_path) or os.path.getmtime(binary_path) < os.path.getmtime(din_path):
+        convert_din_to_binary(din_path, binary_path)
+    return binary_path
+
+
+def load_binary_trace(binary_path: str) -> np.ndarray:
+    """
+    Memory map a binary trace, the returned records are a read only zero copy view of the file
+    """
+    with open(binary_path, 'rb') as file:
+        header = file.read(TRACE_HEADER_SIZE)
+    if len(header) != TRACE_HEADER_SIZE or header[:8] != TRACE_MAGIC:
+        raise ValueError(f"{binary_path} is not a binary trace")
+    count = int.from_bytes(header[8:], byteorder='little')
+    if count == 0:
+        return np.empty(0, dtype=TRACE_DTYPE)
+    return np.memmap(binary_path, dtype=TRACE_DTYPE, mode='r', offset=TRACE_HEADER_SIZE, shape=(count,))
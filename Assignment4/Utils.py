@@ -24,6 +24,45 @@ class CacheReplaceAlgorithm(Enum):
     LRU = 1
     FIFO = 2
     Random = 3
+    PLRU = 4
+    SRRIP = 5
+    BRRIP = 6
+    LFU = 7
+    # Belady's optimal replacement, needs the future accesses of the cache (see AssociativeCacheBase.set_future)
+    OPT = 8
+
+
+class WritePolicy(Enum):
+    WriteBack = 1
+    WriteThrough = 2
+
+
+class InclusionPolicy(Enum):
+    # How a cache level relates to the levels above it
+    Inclusive = 1
+    Exclusive = 2
+    # Non inclusive non exclusive
+    NINE = 3
+
+
+class PrefetcherType(Enum):
+    NextLine = 1
+    Stride = 2
+    Stream = 3
+
+
+class MESIState(Enum):
+    Modified = 1
+    Exclusive = 2
+    Shared = 3
+    Invalid = 4
+
+
+class Scheduler(Enum):
+    # Cores take turns, a quantum of instructions each
+    RoundRobin = 1
+    # The core with the fewest cycles so far runs the next quantum, as if the cores ran in parallel
+    LeastCycles = 2
 
 
 class OP(Enum):
@@ -37,4 +76,6 @@ class OP(Enum):
 class CacheLevel(Enum):
     L1 = 1
     L2 = 2
+    # Missed L1 and was swapped back in from the victim cache behind it
+    Victim = 3
     NoCache = 0
\ No newline at end of file
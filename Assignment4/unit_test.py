@@ -1,12 +1,58 @@
+import csv
+import json
 import math
+import os
 import random
+import tempfile
 import unittest
-from Simulator import SimulatorConfigure, Simulator
-from Memory import Memory, MemoryPage, Size
+from collections import OrderedDict
+from dataclasses import replace
+from unittest.mock import patch
+import numpy as np
+from Simulator import SimulatorConfigure, Simulator, iter_instructions
+from MultiCore import MultiCore, MultiCoreConfigure
+from LatencyHistogram import LatencyHistogram
+from ResultStore import ResultStore, config_key
+from StackDistance import StackDistanceProfiler, profile_hierarchy
+from Sweep import SweepPoint, run_sweep, case_1_grid, case_2_grid, case_3_grid, case_4_grid, case_5_grid, \
+    DEFAULT_CASES, EXTRA_CASES
+from Trace import convert_din_to_binary, load_binary_trace, load_din, decode_din
+from Memory import FrameAllocator, Memory, MappedMemory, MemoryPage, Size
 from Page import PageTable, page_index, MultiLevelPageTable
-from TLBCache import TLB
-from Cache import DirectCacheBase, AssociativeCacheBase
-from Utils import CacheReplaceAlgorithm, Associativity
+from Prefetcher import NextLinePrefetcher, StridePrefetcher, StreamPrefetcher
+from TLBCache import TLB, TLBHierarchy, PageWalkCache
+from CacheHierarchy import CacheHierarchy, CacheLevelSpec
+from Cache import DirectCacheBase, AssociativeCacheBase, Level2Cache, SplitCache, MissStatusHoldingRegisters
+from Utils import CacheLevel, CacheReplaceAlgorithm, Associativity, InclusionPolicy, MESIState, PrefetcherType, \
+    Scheduler, WritePolicy
+
+
+def write_trace(num_instructions: int = 300, seed: int = 0, directory: str = None) -> str:
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(num_instructions):
+        op = rng.choice([0, 1, 2])
+        address = rng.choice([0x00400000, 0x10000000, 0x7fff0000]) + rng.randint(0, 4096) * 4
+        lines.append(f"{op} {address:x} {rng.randint(0, 0xffffffff):x}")
+    file = tempfile.NamedTemporaryFile('w', suffix='.din', dir=directory, delete=False)
+    file.write("\n".join(lines) + "\n")
+    file.close()
+    return file.name
+
+
+class TraceFixtureTest(unittest.TestCase):
+    # Arguments of the trace written for every test
+    trace_arguments = {}
+
+    def setUp(self):
+        # Traces and whatever is derived from them live in a directory removed after the test
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.trace_path = self.write_trace(**self.trace_arguments)
+
+    def write_trace(self, **kwargs) -> str:
+        return write_trace(directory=self.directory, **kwargs)
 
 
 class MyTestCase(unittest.TestCase):
@@ -71,6 +117,24 @@ class MyTestCase(unittest.TestCase):
     def test_large_read_and_write(self):
         self.test_continuously_read_and_write(1 * Size.MB)
 
+    def test_page_boundary_read_and_write(self):
+        self.memory.flush()
+        for page in range(3):
+            self.memory.allocate_page_at_address(page * 4 * Size.KB)
+        self.assertIsNone(self.memory.allocated_pages[1].data)
+        self.assertEqual(self.memory.read_bytes(4 * Size.KB - 2, 4), b'\x00' * 4)
+
+        data = random.randbytes(5 * Size.KB)
+        self.memory.write_bytes(3 * Size.KB, data)
+        self.assertEqual(self.memory.read_bytes(3 * Size.KB, len(data)), data)
+        self.assertEqual(len(self.memory.allocated_pages[1].data), 4 * Size.KB)
+
+        # A range inside one page is a view that follows later writes
+        view = self.memory.read_view(5 * Size.KB, 4)
+        self.assertIsInstance(view, memoryview)
+        self.memory.write_bytes(5 * Size.KB, b'\x12\x34\x56\x78')
+        self.assertEqual(bytes(view), b'\x12\x34\x56\x78')
+
     def test_basic_page_table(self, virtual_address: int = 0x12345678):
         # virtual_address = 0x12345678
         self.multi_page.L1PageTable.load_from_memory(self.multi_page.root_page_address, self.memory)
@@ -110,6 +174,26 @@ class MyTestCase(unittest.TestCase):
         physical_address5 = self.test_basic_page_table(virtual_address5)
         self.assertEqual(page_index(physical_address4), page_index(physical_address5))
 
+    def test_page_table_layout(self):
+        page_table = PageTable(page_bits=6, is_last=True)
+        page_table.add_entry(3, 0x12345)
+        self.assertIn(3, page_table)
+        self.assertNotIn(4, page_table)
+        self.assertNotIn(64, page_table)
+        self.assertEqual(page_table.value(3), 0x12345)
+        self.assertEqual(bytes(page_table.serialize()[12:16]), b'\x01\x01\x23\x45')
+
+        # Only the valid bit and the low 21 bits of a last level entry survive a round trip
+        raw = bytearray(page_table.page_size)
+        raw[4:8] = b'\xff\xff\xff\xff'
+        raw[8:12] = b'\x02\x00\x00\x07'
+        page_table.deserialize(bytes(raw))
+        self.assertFalse(page_table.dirty)
+        self.assertEqual(page_table[1].value, 0x1fffff)
+        self.assertTrue(page_table[1].valid)
+        self.assertNotIn(2, page_table)
+        self.assertEqual(bytes(page_table.serialize()[4:12]), b'\x01\x1f\xff\xff\x00\x00\x00\x07')
+
     def test_tlb_single(self):
         self.tlb.update(0x12345678, 0x87654321 >> 12)
 
@@ -145,6 +229,196 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(self.tlb.query(last_virtual_address).frame_number, last_frame_number)
 
 
+class TLBTest(TraceFixtureTest):
+    def test_policies(self):
+        for replace_algorithm, survivor in [(CacheReplaceAlgorithm.FIFO, 1), (CacheReplaceAlgorithm.LRU, 0)]:
+            tlb = TLB(4, replace_algorithm)
+            for page in range(4):
+                tlb.update(page << 12, page)
+            tlb.query(0)
+            tlb.update(4 << 12, 4)
+            # FIFO evicts page 0 although it was just used, LRU evicts page 1
+            self.assertIn(survivor << 12, tlb)
+            self.assertNotIn((1 - survivor) << 12, tlb)
+
+    def test_unsupported_policy(self):
+        with self.assertRaises(AssertionError):
+            TLB(4, None)
+        # The cache only policies would otherwise run as FIFO
+        for replace_algorithm in [CacheReplaceAlgorithm.PLRU, CacheReplaceAlgorithm.SRRIP, CacheReplaceAlgorithm.BRRIP,
+                                  CacheReplaceAlgorithm.LFU, CacheReplaceAlgorithm.OPT]:
+            with self.assertRaises(AssertionError):
+                TLB(2, replace_algorithm)
+            with self.assertRaises(AssertionError):
+                Simulator(SimulatorConfigure(file_path='dummy.txt', streaming=True, STLB_size=8,
+                                             STLB_replace_algorithm=replace_algorithm))
+
+    def test_set_associative(self):
+        tlb = TLB(8, CacheReplaceAlgorithm.FIFO, Associativity.SetAssociative, 2)
+        self.assertEqual(tlb.num_sets, 4)
+        for page in [0, 4, 8]:
+            tlb.update(page << 12, page)
+        self.assertNotIn(0, tlb)
+        self.assertEqual(len(tlb), 2)
+        self.assertEqual(TLB(8, associativity=Associativity.DirectMapped).num_sets, 8)
+
+    def test_random(self):
+        tlb = TLB(16, CacheReplaceAlgorithm.Random)
+        for page in range(100):
+            tlb.update(page << 12, page)
+            self.assertEqual(len(tlb), min(page + 1, 16))
+            self.assertEqual(sorted(tlb.random_pages[0]), sorted(tlb.sets[0]))
+            self.assertTrue(all(tlb.random_pages[0][position] == page_number
+                                for page_number, position in tlb.random_positions.items()))
+
+    def test_hierarchy(self):
+        l1_tlb, stlb = TLB(2), TLB(8, CacheReplaceAlgorithm.LRU, Associativity.SetAssociative, 4)
+        hierarchy = TLBHierarchy([l1_tlb, stlb], [1, 7])
+        self.assertEqual(hierarchy.lookup_cycles, [1, 8, 8])
+        self.assertEqual(hierarchy.lookup(0x1000), (2, None))
+        for page in range(3):
+            hierarchy.update(page << 12, page + 100)
+
+        # Page 0 fell out of the L1 TLB, the STLB serves it and refills the L1 TLB
+        level, entry = hierarchy.lookup(0x0123)
+        self.assertEqual((level, entry.frame_number), (1, 100))
+        self.assertIn(0, l1_tlb)
+        self.assertEqual(hierarchy.lookup(0x0456)[0], 0)
+
+    def test_stlb(self):
+        simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, TLB_size=2, STLB_size=64))
+        simulator.start_simulation()
+        result = simulator.result()
+        self.assertEqual(result["STLB_access"], result["TLB_access"] - result["TLB_hit"])
+        self.assertGreater(result["STLB_hit"], 0)
+
+    def test_huge_pages(self):
+        tlb = TLB(4)
+        tlb.update(0x12345678, 1000, page_bits=26)
+        tlb.update(0x00401000, 7)
+        # A single entry covers the whole huge page, every 4 KiB of it gets its own frame
+        entry = tlb.query(0x12345678 + 0x5000)
+        self.assertEqual(entry.page_bits, 26)
+        self.assertEqual(entry.translate(0x12345678 + 0x5000), 1000 + (0x1234a678 >> 12 & 0x3fff))
+        self.assertEqual(tlb.query(0x10000000).translate(0x10000000), 1000)
+        self.assertEqual(tlb.query(0x00401fff).translate(0x00401fff), 7)
+        self.assertNotIn(0x14000000, tlb)
+        self.assertNotIn(0x00402000, tlb)
+
+    def test_huge_page_walk(self):
+        # Timing only keeps page tables apart from the data written by the trace
+        config = SimulatorConfigure(file_path=self.trace_path, timing_only=True,
+                                    huge_page_regions=((0x10000000, 0x20000000),))
+        simulator = Simulator(config)
+        simulator.start_simulation()
+        reference = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True))
+        reference.start_simulation()
+
+        # The region around 0x10000000 fits in one huge page, walked once, the rest stays on 4 KiB pages
+        self.assertEqual(simulator.huge_page_walks, 1)
+        self.assertLess(simulator.page_walks, reference.page_walks)
+        self.assertEqual(simulator.tlb_access, reference.tlb_access)
+        self.assertTrue(simulator.multi_page.L1PageTable.is_leaf(simulator.multi_page.l1_index(0x10000000)))
+
+        # Translation stays a function of the 4 KiB page
+        self.assertEqual(simulator.address_translate(0x10001004), simulator.address_translate(0x10001ffc))
+        self.assertNotEqual(simulator.address_translate(0x10001004), simulator.address_translate(0x10002004))
+
+    def test_split(self):
+        simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, TLB_split=True, TLB_size=16))
+        self.assertIsNot(simulator.itlb, simulator.tlb)
+        self.assertEqual(simulator.itlb.size, 8)
+        simulator.start_simulation()
+        self.assertEqual(simulator.tlb_access, 300)
+        self.assertGreater(len(simulator.itlb), 0)
+        self.assertGreater(len(simulator.tlb), 0)
+
+
+class FrameAllocatorTest(unittest.TestCase):
+    @staticmethod
+    def first_fit(pages, pages_needed):
+        # The original scan over the sorted allocated pages
+        pages = sorted(pages)
+        if len(pages) == 0:
+            return 0
+        for i in range(len(pages) - 1):
+            if pages[i + 1] - pages[i] > pages_needed:
+                return pages[i] + 1
+        return pages[-1] + 1
+
+    def test_matches_first_fit(self):
+        rng = random.Random(0)
+        # Small buckets so they split and empty often
+        with patch.object(FrameAllocator, "BUCKET_SIZE", 2):
+            memory = Memory(0)
+            for _ in range(2000):
+                choice = rng.random()
+                if choice < 0.4:
+                    pages_needed = rng.choice([1, 1, 2, 3])
+                    expected = self.first_fit(list(memory.allocated_pages), pages_needed)
+                    self.assertEqual(memory.allocate_page(pages_needed * 4 * Size.KB)[0], expected)
+                elif choice < 0.7:
+                    memory.allocate_page_at_address(rng.randint(0, 300) << 12)
+                elif memory.allocated_pages:
+                    memory.free_page(rng.choice(list(memory.allocated_pages)))
+        self.assertEqual(FrameAllocator.BUCKET_SIZE, 256)
+
+    def test_coalesce(self):
+        memory = Memory(0)
+        for page in range(10):
+            memory.allocate_page_at_address(page << 12)
+        for page in [2, 4, 3, 7]:
+            memory.free_page(page)
+        self.assertEqual(len(memory.frames), 2)
+        self.assertEqual(memory.allocate_page(3 * 4 * Size.KB)[0], 2)
+        memory.free_page(0)
+        self.assertEqual(memory.frames.lowest, 1)
+
+    def test_mark_allocated_twice(self):
+        frames = FrameAllocator()
+        for page in [0, 5, 3]:
+            frames.mark_allocated(page)
+        # Before the first free extent and inside a gap between two
+        for page in [0, 3]:
+            with self.assertRaises(AssertionError):
+                frames.mark_allocated(page)
+
+
+class MappedMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.memory = MappedMemory(0, reserve_size=8 * Size.KB)
+
+    def tearDown(self):
+        self.memory.close()
+
+    def test_read_and_write(self):
+        for page in range(4):
+            self.memory.allocate_page_at_address(page * 4 * Size.KB)
+        # Four pages do not fit in the reserved space, the map grows
+        self.assertGreaterEqual(len(self.memory.map), 16 * Size.KB)
+
+        data = random.randbytes(9 * Size.KB)
+        self.memory.write_bytes(2 * Size.KB, data)
+        self.assertEqual(self.memory.read_bytes(2 * Size.KB, len(data)), data)
+        self.memory.write(0x10, 0xab)
+        self.assertEqual(self.memory.read(0x10), 0xab)
+
+        # Reallocating a page wipes it, a freed slot comes back zeroed
+        self.memory.allocate_page_at_address(4 * Size.KB)
+        self.assertEqual(self.memory.read_bytes(4 * Size.KB, 4 * Size.KB), b'\x00' * 4 * Size.KB)
+        self.memory.free_page(2)
+        self.memory.allocate_page_at_address(7 * 4 * Size.KB)
+        self.assertEqual(self.memory.read_bytes(7 * 4 * Size.KB, 4 * Size.KB), b'\x00' * 4 * Size.KB)
+
+    def test_matches_memory(self):
+        memory = Memory(0)
+        self.assertEqual(self.memory.allocate_page(3 * Size.KB), memory.allocate_page(3 * Size.KB))
+        self.assertEqual(self.memory.allocate_page(3 * Size.KB), memory.allocate_page(3 * Size.KB))
+        self.assertEqual(sorted(self.memory.allocated_pages), sorted(memory.allocated_pages))
+        self.memory.flush()
+        self.assertNotIn(0, self.memory)
+
+
 class CacheTest(unittest.TestCase):
     def setUp(self):
         self.l1_cache = DirectCacheBase(cache_size=Size.KB * 32, cache_line_size=Size.B * 64,
@@ -299,6 +573,128 @@ class CacheTest(unittest.TestCase):
         for address in wrote_value:
             self.assertEqual(self.l2_cache.read_cache(address), wrote_value[address])
 
+    def test_tag_store(self):
+        self.l2_cache.flush()
+        address = (3 << self.l2_cache.offset_bits) + (5 << (self.l2_cache.index_bits + self.l2_cache.offset_bits))
+        line = random.randbytes(self.l2_cache.cache_line_size)
+        self.l2_cache.replace_cache_line(address, line)
+
+        slot = 3 * self.l2_cache.n_way
+        self.assertEqual(self.l2_cache.tags[slot], 5)
+        self.assertEqual(self.l2_cache.valid[slot], 1)
+        self.assertEqual(self.l2_cache.read_cache(address), line)
+
+        self.l2_cache.flush()
+        self.assertFalse(self.l2_cache.access_cache_free(address))
+
+    def test_lookup(self):
+        for cache in [SplitCache(Size.KB * 32, Size.B * 64, CacheReplaceAlgorithm.FIFO, Size.KB * 512, Size.B * 64,
+                                 CacheReplaceAlgorithm.LRU, Associativity.SetAssociative, 4),
+                      Level2Cache(Size.KB * 32, Size.B * 64, CacheReplaceAlgorithm.FIFO, Size.KB * 512, Size.B * 64,
+                                  CacheReplaceAlgorithm.LRU, Associativity.SetAssociative, 4)]:
+            l1_cache = cache.L1DCache if isinstance(cache, SplitCache) else cache.L1Cache
+            address = 0x12345640
+            line = random.randbytes(64)
+
+            self.assertEqual(cache.lookup(address), (CacheLevel.NoCache, -1))
+            cache.fill(address, line)
+            cache_level, slot = cache.lookup(address)
+            self.assertEqual(cache_level, CacheLevel.L1)
+            self.assertEqual(cache.read(address, cache_level, slot), line)
+
+            # Evict the line from L1 only, it is then served and promoted from L2
+            l1_cache.flush()
+            cache_level, slot = cache.lookup(address)
+            self.assertEqual(cache_level, CacheLevel.L2)
+            new_line = random.randbytes(64)
+            cache.write(address, cache_level, slot, new_line)
+            self.assertEqual(cache.read_cache(address), (CacheLevel.L1, new_line))
+            self.assertEqual(cache.L2Cache.hits, 1)
+            self.assertEqual(cache.L2Cache.misses, 1)
+
+    def test_lru_after_misses(self):
+        # A, B, C, D into one 2-way set, LRU keeps the last two lines however many hits there were
+        cache = AssociativeCacheBase(associative=Associativity.SetAssociative, n_way=2, cache_size=Size.B * 128,
+                                     cache_line_size=Size.B * 64, replace_algorithm=CacheReplaceAlgorithm.LRU)
+        lines = [line << 6 for line in range(4)]
+        for address in lines:
+            self.assertLess(cache.probe(address), 0)
+            cache.replace_cache_line(address, None)
+        self.assertEqual([address in cache for address in lines], [False, False, True, True])
+
+    def test_lru_fully_associative(self):
+        for replace_algorithm in [CacheReplaceAlgorithm.LRU, CacheReplaceAlgorithm.FIFO]:
+            cache = AssociativeCacheBase(associative=Associativity.FullyAssociative, n_way=64,
+                                         cache_size=Size.B * 64 * 64, cache_line_size=Size.B * 64,
+                                         replace_algorithm=replace_algorithm)
+            reference = OrderedDict()
+            rng = random.Random(0)
+            for _ in range(5000):
+                line = rng.randrange(100)
+                hit = cache.probe(line << 6) >= 0
+                self.assertEqual(hit, line in reference)
+                if hit:
+                    if replace_algorithm == CacheReplaceAlgorithm.LRU:
+                        reference.move_to_end(line)
+                    continue
+                cache.replace_cache_line(line << 6, None)
+                if len(reference) == 64:
+                    reference.popitem(last=False)
+                reference[line] = None
+            self.assertEqual(sorted(cache.line_slots), sorted(reference))
+
+    @staticmethod
+    def replay(cache, lines):
+        hits = 0
+        for line in lines:
+            if cache.probe(line << cache.offset_bits) >= 0:
+                hits += 1
+            else:
+                cache.replace_cache_line(line << cache.offset_bits, None)
+        return hits
+
+    def test_replacement_policies(self):
+        def make_cache(replace_algorithm):
+            return AssociativeCacheBase(associative=Associativity.SetAssociative, n_way=4, cache_size=Size.B * 512,
+                                        cache_line_size=Size.B * 64, replace_algorithm=replace_algorithm)
+
+        rng = random.Random(0)
+        lines = [rng.choice(range(24)) if rng.random() < 0.7 else rng.randrange(1000) for _ in range(3000)]
+        hits = {}
+        for replace_algorithm in CacheReplaceAlgorithm:
+            cache = make_cache(replace_algorithm)
+            if replace_algorithm == CacheReplaceAlgorithm.OPT:
+                cache.set_future(lines)
+            hits[replace_algorithm] = self.replay(cache, lines)
+            self.assertEqual(cache.hits, hits[replace_algorithm])
+        # Belady's OPT is an upper bound for every other policy
+        self.assertEqual(max(hits.values()), hits[CacheReplaceAlgorithm.OPT])
+        self.assertGreater(hits[CacheReplaceAlgorithm.OPT], hits[CacheReplaceAlgorithm.FIFO])
+
+    def test_plru(self):
+        cache = AssociativeCacheBase(associative=Associativity.FullyAssociative, n_way=4, cache_size=Size.B * 256,
+                                     cache_line_size=Size.B * 64, replace_algorithm=CacheReplaceAlgorithm.PLRU)
+        self.replay(cache, [0, 1, 2, 3, 0, 2])
+        # 0 and 2 were used last, the tree points at the pair they are not in, then at 1 before 3
+        self.replay(cache, [4])
+        self.assertNotIn(1 << 6, cache)
+        self.assertEqual([line << 6 in cache for line in [0, 2, 3, 4]], [True] * 4)
+
+    def test_rrip_and_lfu(self):
+        # A scan of lines used once does not flush a reused working set out of RRIP or LFU, unlike LRU
+        # SRRIP ages the working set while the scan goes on, so it only resists short scans
+        working_set = [0, 1, 2]
+        for replace_algorithm, scan_length, survives in [(CacheReplaceAlgorithm.LRU, 2, False),
+                                                         (CacheReplaceAlgorithm.SRRIP, 2, True),
+                                                         (CacheReplaceAlgorithm.SRRIP, 40, False),
+                                                         (CacheReplaceAlgorithm.BRRIP, 40, True),
+                                                         (CacheReplaceAlgorithm.LFU, 40, True)]:
+            cache = AssociativeCacheBase(associative=Associativity.FullyAssociative, n_way=4,
+                                         cache_size=Size.B * 256, cache_line_size=Size.B * 64,
+                                         replace_algorithm=replace_algorithm)
+            self.replay(cache, working_set * 4 + list(range(100, 100 + scan_length)))
+            self.assertEqual(self.replay(cache, working_set) == 3, survives, replace_algorithm)
+
 
 class SimulatorTest(unittest.TestCase):
     def setUp(self):
@@ -324,5 +720,754 @@ class SimulatorTest(unittest.TestCase):
         print(self.simulator.cycle)
 
 
+class StreamingTest(TraceFixtureTest):
+    def test_streaming_matches_eager(self):
+        eager = Simulator(SimulatorConfigure(file_path=self.trace_path))
+        eager.start_simulation()
+
+        streaming = Simulator(SimulatorConfigure(file_path=self.trace_path, streaming=True, stream_chunk_size=64))
+        self.assertIsNone(streaming.instructions)
+        streaming.start_simulation()
+
+        self.assertEqual(streaming.instruction_count, 300)
+        self.assertEqual(streaming.result(), eager.result())
+
+
+class OptimalReplacementTest(TraceFixtureTest):
+    trace_arguments = {"num_instructions": 2000}
+
+    def test_opt_bounds_l2(self):
+        hits, accesses = {}, set()
+        for replace_algorithm in [CacheReplaceAlgorithm.FIFO, CacheReplaceAlgorithm.LRU, CacheReplaceAlgorithm.OPT]:
+            simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True,
+                                                     L1_cache_size=Size.KB, L2_cache_size=2 * Size.KB,
+                                                     L2_replace_algorithm=replace_algorithm))
+            simulator.start_simulation()
+            hits[replace_algorithm] = simulator.l2_hit
+            accesses.add(simulator.l2_access)
+        # The lines reaching L2 do not depend on the L2 policy, OPT saw all of them in advance
+        self.assertEqual(accesses, {len(simulator.cache.L2Cache.future)})
+        self.assertGreaterEqual(hits[CacheReplaceAlgorithm.OPT], hits[CacheReplaceAlgorithm.FIFO])
+        self.assertGreaterEqual(hits[CacheReplaceAlgorithm.OPT], hits[CacheReplaceAlgorithm.LRU])
+
+    def test_functional_mode_rejected(self):
+        # The lines reaching L2 depend on the L2 policy in functional mode, a FIFO replay does not predict them
+        config = SimulatorConfigure(file_path=self.trace_path, L2_replace_algorithm=CacheReplaceAlgorithm.OPT)
+        with self.assertRaises(AssertionError):
+            Simulator(config)
+        levels = (CacheLevelSpec(Size.KB),
+                  CacheLevelSpec(2 * Size.KB, n_way=4, replace_algorithm=CacheReplaceAlgorithm.OPT))
+        with self.assertRaises(AssertionError):
+            Simulator(replace(config, L2_replace_algorithm=CacheReplaceAlgorithm.FIFO, cache_levels=levels))
+
+
+class WritePolicyTest(TraceFixtureTest):
+    def simulator(self, **kwargs):
+        return Simulator(SimulatorConfigure(file_path=self.trace_path, L1_cache_size=Size.KB, L1_cacheline_size=64,
+                                            L2_cache_size=2 * Size.KB, L2_cacheline_size=64, **kwargs))
+
+    def test_write_back_keeps_data(self):
+        # Far more lines than both levels hold, every value survives its evictions
+        simulator = self.simulator(write_policy=WritePolicy.WriteBack)
+        addresses = [line * 64 for line in range(200)]
+        for address in addresses:
+            simulator.simu_write_data(address, address.to_bytes(4, 'big'))
+        self.assertGreater(simulator.cache.l2_writebacks, 0)
+        self.assertGreaterEqual(simulator.memory_writes, simulator.cache.l2_writebacks)
+        for address in addresses:
+            self.assertEqual(simulator.simu_read_data(address, 4), address.to_bytes(4, 'big'))
+
+        # A flush writes the remaining dirty lines to memory
+        simulator.cache.flush()
+        for address in addresses:
+            self.assertEqual(simulator.memory.read_bytes(address, 4), address.to_bytes(4, 'big'))
+
+    def test_write_through(self):
+        simulator = self.simulator(write_policy=WritePolicy.WriteThrough)
+        for address in [0, 64, 0, 4096]:
+            simulator.simu_write_data(address, b'\x01\x02\x03\x04')
+        # Every write reaches memory, nothing is ever dirty
+        self.assertEqual(simulator.memory_writes, 4)
+        self.assertEqual(simulator.memory_write_cycles, 4 * simulator.config.Memory_write_access)
+        self.assertEqual(simulator.cache.l1_writebacks + simulator.cache.l2_writebacks, 0)
+        self.assertEqual(simulator.memory.read_bytes(4096, 4), b'\x01\x02\x03\x04')
+
+    def test_no_write_allocate(self):
+        for write_policy in WritePolicy:
+            simulator = self.simulator(write_policy=write_policy, write_allocate=False)
+            simulator.simu_write_data(0x1000, b'\x01\x02\x03\x04')
+            self.assertNotIn(0x1000, simulator.cache)
+            self.assertEqual(simulator.memory_writes, 1)
+            self.assertEqual(simulator.simu_read_data(0x1000, 4), b'\x01\x02\x03\x04')
+            self.assertIn(0x1000, simulator.cache)
+
+    def test_timing_only(self):
+        result = {}
+        for write_policy in [None, WritePolicy.WriteBack, WritePolicy.WriteThrough]:
+            simulator = self.simulator(write_policy=write_policy, timing_only=True)
+            simulator.start_simulation()
+            result[write_policy] = simulator.result()
+        self.assertEqual(result[None]["Memory_writes"], 0)
+        self.assertGreater(result[WritePolicy.WriteThrough]["Memory_writes"],
+                           result[WritePolicy.WriteBack]["Memory_writes"])
+        self.assertEqual(result[WritePolicy.WriteBack]["L1_access"], result[None]["L1_access"])
+
+
+class PrefetcherTest(TraceFixtureTest):
+    def test_next_line(self):
+        self.assertEqual(NextLinePrefetcher(64, 2).access(0x1010), [0x1040, 0x1080])
+
+    def test_stride(self):
+        prefetcher = StridePrefetcher(64, degree=2)
+        issued = [prefetcher.access(0x1000 + i * 256) for i in range(5)]
+        # The stride has to repeat before anything is issued
+        self.assertEqual(issued[:3], [[], [], []])
+        self.assertEqual(issued[4], [0x1500, 0x1600])
+        # Another region trains its own entry
+        self.assertEqual(prefetcher.access(0x9000), [])
+
+    def test_stream(self):
+        prefetcher = StreamPrefetcher(64, degree=2, buffers=2, depth=4)
+        self.assertEqual(prefetcher.access(0), [64, 128])
+        # A miss inside the buffer tops it up, at most degree lines at a time and depth lines ahead
+        self.assertEqual(prefetcher.access(64), [192, 256])
+        self.assertEqual(prefetcher.access(128), [320, 384])
+        self.assertEqual(prefetcher.access(192), [448])
+        # Two new streams push the first one out, its lines start a new buffer
+        prefetcher.access(0x10000)
+        prefetcher.access(0x20000)
+        self.assertEqual(prefetcher.access(256), [320, 384])
+
+    def test_simulator(self):
+        issued = {}
+        for prefetcher in [None] + list(PrefetcherType):
+            simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True,
+                                                     prefetcher=prefetcher))
+            for address in range(0, 64 * 64, 64):
+                simulator.simu_read_data(address, 4)
+            issued[prefetcher] = simulator.prefetch_issued
+            if prefetcher is None:
+                misses = simulator.l2_access - simulator.l2_hit
+                continue
+            # A sequential walk over lines is covered, back to back accesses catch most prefetches in flight
+            self.assertLess(simulator.l2_access - simulator.l2_hit, misses)
+            self.assertGreater(simulator.prefetch_useful, 0)
+            self.assertLessEqual(simulator.prefetch_useful, simulator.prefetch_issued)
+            self.assertGreater(simulator.prefetch_late, 0)
+            self.assertLessEqual(simulator.prefetch_late, simulator.prefetch_useful)
+        self.assertEqual(issued[None], 0)
+
+    def test_opt(self):
+        # OPT ranks a prefetched line by its own next use in L2, not by the one of the line probed last
+        opt = CacheReplaceAlgorithm.OPT
+        for cache_levels in [(), (CacheLevelSpec(Size.KB), CacheLevelSpec(2 * Size.KB, n_way=4, access=8,
+                                                                          replace_algorithm=opt))]:
+            simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True,
+                                                     L1_cache_size=Size.KB, L2_cache_size=2 * Size.KB,
+                                                     L2_replace_algorithm=opt, prefetcher=PrefetcherType.NextLine,
+                                                     cache_levels=cache_levels))
+            l2_cache = simulator.cache.L2Cache
+            l2_cache.set_future(simulator.record_l2_probes())
+            for instruction in simulator.instruction_stream():
+                simulator.execute(instruction)
+                for slot in range(l2_cache.cache_line_num):
+                    if l2_cache.valid[slot]:
+                        line = l2_cache.line_address(slot) >> l2_cache.offset_bits
+                        self.assertEqual(l2_cache.policy_data[slot], l2_cache.upcoming_use(line))
+            self.assertGreater(simulator.prefetch_issued, 0)
+
+
+class VictimCacheTest(unittest.TestCase):
+    def cache(self, victim_cache_size, write_policy=None):
+        # 16 line direct mapped L1, lines 1KB apart share a slot
+        return Level2Cache(l1_cache_size=Size.KB, l1_cache_line_size=64, l1_cache_policy=CacheReplaceAlgorithm.LRU,
+                           l2_cache_size=4 * Size.KB, l2_cache_line_size=64, l2_cache_policy=CacheReplaceAlgorithm.LRU,
+                           l2_cache_associativity=Associativity.SetAssociative, l2_n_way=4,
+                           write_policy=write_policy, victim_cache_size=victim_cache_size)
+
+    def replay(self, cache, addresses):
+        levels = []
+        for address in addresses:
+            cache_level, slot = cache.lookup(address)
+            if cache_level == CacheLevel.NoCache:
+                cache.fill(address, address.to_bytes(64, 'big'))
+            else:
+                self.assertEqual(cache.read(address, cache_level, slot), address.to_bytes(64, 'big'))
+            levels.append(cache_level)
+        return levels
+
+    def test_conflict_misses(self):
+        # Three lines fighting over one slot
+        addresses = [0, Size.KB, 2 * Size.KB] * 4
+        levels = self.replay(self.cache(0), addresses)
+        self.assertEqual(levels[3:], [CacheLevel.L2] * 9)
+
+        cache = self.cache(2)
+        levels = self.replay(cache, addresses)
+        self.assertEqual(levels[3:], [CacheLevel.Victim] * 9)
+        self.assertEqual(cache.L1Cache.victim_hits, 9)
+        self.assertEqual(cache.L2Cache.hits, 0)
+
+        # One victim line is not enough for three lines, LRU pushes out the next one needed
+        levels = self.replay(self.cache(1), addresses)
+        self.assertEqual(levels[3:], [CacheLevel.L2] * 9)
+
+    def test_dirty_victims(self):
+        written = []
+        cache = self.cache(1, WritePolicy.WriteBack)
+        cache.write_memory = lambda address, value: written.append(address)
+        cache.write_miss(0, b'\x01' * 64)
+        self.replay(cache, [Size.KB])
+        # The dirty line waits in the victim cache and comes back dirty
+        self.assertEqual(cache.l1_writebacks, 0)
+        self.assertEqual(cache.lookup(0)[0], CacheLevel.Victim)
+        self.replay(cache, [Size.KB, 2 * Size.KB])
+        self.assertEqual(cache.l1_writebacks, 1)
+        self.assertEqual(cache.L2Cache.read_cache(0), b'\x01' * 64)
+
+        cache.write_miss(3 * Size.KB, b'\x02' * 64)
+        self.replay(cache, [4 * Size.KB])
+        # A flush empties the victim cache too, both dirty lines reach memory through L2
+        cache.flush()
+        self.assertEqual(cache.l1_writebacks, 2)
+        self.assertEqual(sorted(written), [0, 3 * Size.KB])
+
+
+class MSHRTest(TraceFixtureTest):
+    def test_registers(self):
+        mshr = MissStatusHoldingRegisters(2)
+        # Non blocking misses only take a register
+        self.assertEqual(mshr.access(0, 10, 100, False), 10)
+        self.assertEqual(mshr.access(64, 11, 100, False), 11)
+        # A blocking access to a line in flight waits for it
+        self.assertEqual(mshr.access(0, 20, 0, True), 110)
+        self.assertEqual(mshr.merges, 1)
+        # Both registers are busy, the first one frees up at cycle 110
+        self.assertEqual(mshr.access(128, 12, 100, False), 110)
+        self.assertEqual(mshr.access(192, 115, 100, True), 215)
+        self.assertEqual((mshr.allocations, mshr.full_stalls, mshr.stall_cycles), (4, 1, 90 + 98))
+
+    def test_simulator(self):
+        result = {}
+        for mshr_entries in [0, 1, 8]:
+            simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True,
+                                                     mshr_entries=mshr_entries))
+            # Line aligned reads of 32 byte lines, each line read twice in a row
+            for address in range(0, 32 * 64, 32):
+                simulator.simu_read_data(address, 4, blocking=False)
+                simulator.simu_read_data(address, 4, blocking=False)
+            result[mshr_entries] = simulator
+        # Hit and miss counts do not depend on the registers, only the cycles do
+        self.assertEqual({simulator.l1_hit for simulator in result.values()}, {result[0].l1_hit})
+        self.assertEqual(result[0].mshr, None)
+        self.assertLess(result[8].cycle, result[1].cycle)
+        self.assertLess(result[1].cycle, result[0].cycle)
+        # The second read of every line finds it in flight
+        self.assertEqual(result[8].mshr.merges, 64)
+        self.assertEqual(result[8].mshr.allocations, 64)
+        self.assertGreater(result[1].mshr.full_stalls, 0)
+
+
+class CacheHierarchyTest(TraceFixtureTest):
+    def hierarchy(self, inclusion, write_policy=None):
+        # 4 line direct mapped L1, 8 line L2 and 16 line L3
+        return CacheHierarchy([CacheLevelSpec(256, 64),
+                               CacheLevelSpec(512, 64, n_way=2, inclusion=inclusion),
+                               CacheLevelSpec(Size.KB, 64, n_way=4, inclusion=inclusion)], write_policy=write_policy)
+
+    def replay(self, cache, memory, accesses):
+        for address, value in accesses:
+            depth, slot = cache.lookup(address)
+            if value is not None:
+                if slot < 0:
+                    cache.write_miss(address, value)
+                else:
+                    cache.write(address, depth, slot, value)
+                memory[address] = value
+            elif slot < 0:
+                cache.fill(address, memory.get(address, bytes(64)))
+            else:
+                self.assertEqual(cache.read(address, depth, slot), memory.get(address, bytes(64)))
+
+    def lines(self, cache):
+        # Line addresses held by every level
+        levels = []
+        for level in cache.levels:
+            held = [slot for slot in range(level.cache_line_num)
+                    if (level.valid[slot] if isinstance(level, AssociativeCacheBase) else level.cache[slot])]
+            levels.append({level.line_address(slot) for slot in held})
+        return levels
+
+    def test_inclusion(self):
+        rng = random.Random(0)
+        accesses = [(rng.randrange(32) * 64, None) for _ in range(2000)]
+        hits = {}
+        for inclusion in InclusionPolicy:
+            cache = self.hierarchy(inclusion)
+            for start in range(0, len(accesses), 50):
+                self.replay(cache, {}, accesses[start:start + 50])
+                l1, l2, l3 = self.lines(cache)
+                if inclusion == InclusionPolicy.Inclusive:
+                    self.assertTrue(l1 <= l2 <= l3)
+                elif inclusion == InclusionPolicy.Exclusive:
+                    self.assertFalse(l1 & l2 or l1 & l3 or l2 & l3)
+            hits[inclusion] = sum(level.hits for level in cache.levels)
+            self.assertEqual(cache.back_invalidations > 0, inclusion == InclusionPolicy.Inclusive)
+        # Exclusive levels hold the most distinct lines
+        self.assertGreater(hits[InclusionPolicy.Exclusive], hits[InclusionPolicy.NINE])
+        self.assertGreaterEqual(hits[InclusionPolicy.NINE], hits[InclusionPolicy.Inclusive])
+
+    def test_write_back(self):
+        rng = random.Random(1)
+        for inclusion in InclusionPolicy:
+            cache = self.hierarchy(inclusion, WritePolicy.WriteBack)
+            written = {}
+            cache.write_memory = written.__setitem__
+            memory = {}
+            accesses = [(rng.randrange(48) * 64, bytes([rng.randrange(256)]) * 64 if rng.random() < 0.3 else None)
+                        for _ in range(3000)]
+            # Reads check every value against the last one written
+            self.replay(cache, memory, accesses)
+            cache.flush()
+            self.assertEqual(written, {address: value for address, value in memory.items()})
+
+    def test_matches_two_levels(self):
+        # A two level hierarchy without inclusion is the unified Level2Cache
+        for write_policy in [None, WritePolicy.WriteBack]:
+            config = SimulatorConfigure(file_path=self.trace_path, separate_instruction_data=False, timing_only=True,
+                                        L1_cache_size=Size.KB, L2_cache_size=4 * Size.KB, write_policy=write_policy)
+            levels = (CacheLevelSpec(Size.KB, access=config.L1_cache_access),
+                      CacheLevelSpec(4 * Size.KB, n_way=4, replace_algorithm=CacheReplaceAlgorithm.FIFO,
+                                     access=config.L2_cache_access))
+            two_level = Simulator(config)
+            two_level.start_simulation()
+            hierarchy = Simulator(replace(config, cache_levels=levels))
+            hierarchy.start_simulation()
+            self.assertEqual(hierarchy.served, two_level.served)
+            self.assertEqual(hierarchy.cycle, two_level.cycle)
+            self.assertEqual(hierarchy.memory_writes, two_level.memory_writes)
+
+    def test_three_levels(self):
+        levels = (CacheLevelSpec(Size.KB), CacheLevelSpec(2 * Size.KB, n_way=2, access=8),
+                  CacheLevelSpec(8 * Size.KB, n_way=4, access=20, inclusion=InclusionPolicy.Exclusive))
+        simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True, cache_levels=levels))
+        simulator.start_simulation()
+        result = simulator.result()
+        # Every access pays the lookups of the levels it went through
+        self.assertEqual(simulator.access_cycles, [1, 9, 29, 129])
+        self.assertEqual(result["L3_access"], result["L2_access"] - result["L2_hit"])
+        self.assertEqual(simulator.served[3], result["L3_access"] - result["L3_hit"])
+        self.assertGreater(result["L3_hit"], 0)
+        with self.assertRaises(AssertionError):
+            Simulator(SimulatorConfigure(file_path=self.trace_path, cache_levels=levels, victim_cache_size=8))
+
+    def test_opt(self):
+        opt = CacheReplaceAlgorithm.OPT
+        # Only L2 gets a recorded future
+        for depth in [0, 2]:
+            specs = [CacheLevelSpec(Size.KB, n_way=2), CacheLevelSpec(2 * Size.KB, n_way=2),
+                     CacheLevelSpec(8 * Size.KB, n_way=4)]
+            specs[depth] = replace(specs[depth], replace_algorithm=opt)
+            with self.assertRaises(AssertionError):
+                CacheHierarchy(specs)
+
+        # An exclusive L2 only takes lines evicted from L1, OPT ranks them by their own next use
+        levels = (CacheLevelSpec(Size.KB), CacheLevelSpec(2 * Size.KB, n_way=4, access=8, replace_algorithm=opt,
+                                                          inclusion=InclusionPolicy.Exclusive))
+        simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True, cache_levels=levels))
+        l2_cache = simulator.cache.L2Cache
+        l2_cache.set_future(simulator.record_l2_probes())
+        for instruction in simulator.instruction_stream():
+            simulator.execute(instruction)
+            for slot in range(l2_cache.cache_line_num):
+                if l2_cache.valid[slot]:
+                    line = l2_cache.line_address(slot) >> l2_cache.offset_bits
+                    self.assertEqual(l2_cache.policy_data[slot], l2_cache.upcoming_use(line))
+        self.assertGreater(simulator.l2_hit, 0)
+
+
+class MultiCoreTest(TraceFixtureTest):
+    def setUp(self):
+        super().setUp()
+        self.trace_paths = [self.trace_path, self.write_trace(num_instructions=200, seed=1)]
+
+    def multi_core(self, **kwargs):
+        core = SimulatorConfigure(timing_only=True, write_policy=WritePolicy.WriteBack)
+        return MultiCore(MultiCoreConfigure(file_paths=tuple(self.trace_paths), core=core, **kwargs))
+
+    def test_mesi(self):
+        multi_core = self.multi_core()
+        first, second = multi_core.cores
+        directory = multi_core.directory
+        states = lambda: (directory.state(0, 0x100), directory.state(1, 0x100))
+
+        first.simu_read_data(0x100, 4)
+        self.assertEqual(states(), (MESIState.Exclusive, MESIState.Invalid))
+        second.simu_read_data(0x100, 4)
+        self.assertEqual(states(), (MESIState.Shared, MESIState.Shared))
+        second.simu_write_data(0x100, bytes(4))
+        self.assertEqual(states(), (MESIState.Invalid, MESIState.Modified))
+        self.assertEqual(directory.invalidations, [1, 0])
+
+        # The first core lost the line to the write, the modified copy is written back to the shared L2
+        first.simu_read_data(0x100, 4)
+        self.assertEqual(states(), (MESIState.Shared, MESIState.Shared))
+        self.assertEqual(directory.coherence_misses, [1, 0])
+        self.assertEqual(second.cache.l1_writebacks, 1)
+        self.assertEqual(first.served[1], 1)
+
+        # A downgrade of a line the shared L2 dropped writes it to memory, the owner pays for it
+        second.simu_write_data(0x100, bytes(4))
+        multi_core.l2_cache.invalidate(multi_core.l2_cache.locate(0x100))
+        cycle = second.cycle
+        first.simu_read_data(0x100, 4)
+        self.assertEqual(states(), (MESIState.Shared, MESIState.Shared))
+        self.assertEqual((second.cache.l1_writebacks, second.memory_writes), (2, 1))
+        self.assertEqual(second.cycle - cycle, SimulatorConfigure.Memory_write_access)
+        self.assertEqual(directory.invalidations, [2, 0])
+
+        # An upgrade from Shared invalidates the other copy without a miss
+        l1_hit = first.l1_hit
+        first.simu_write_data(0x100, bytes(4))
+        self.assertEqual(states(), (MESIState.Modified, MESIState.Invalid))
+        self.assertEqual(directory.invalidations, [2, 1])
+        self.assertEqual(first.l1_hit, l1_hit + 1)
+
+    def test_write_policy_required(self):
+        with self.assertRaises(AssertionError):
+            MultiCore(MultiCoreConfigure(file_paths=tuple(self.trace_paths), core=SimulatorConfigure(timing_only=True)))
+
+    def test_flush_and_evictions(self):
+        multi_core = self.multi_core()
+        first, second = multi_core.cores
+        directory = multi_core.directory
+        first.simu_read_data(0x100, 4)
+        # A line mapping to the same L1 slot replaces it, the directory sees it leave
+        first.simu_read_data(0x100 + first.config.L1_cache_size // 2, 4)
+        second.simu_write_data(0x100, bytes(4))
+        self.assertEqual(directory.invalidations, [0, 0])
+
+        # A flush empties the private caches only
+        second.flush()
+        self.assertEqual(directory.state(1, 0x100), MESIState.Modified)
+        first.simu_read_data(0x100, 4)
+        self.assertEqual(directory.state(1, 0x100), MESIState.Invalid)
+        self.assertEqual(first.served[1], 1)
+        self.assertEqual(directory.coherence_misses, [0, 0])
+
+    def test_schedulers(self):
+        for scheduler in Scheduler:
+            for shared_address_space in [False, True]:
+                multi_core = self.multi_core(scheduler=scheduler, quantum=3, shared_address_space=shared_address_space)
+                multi_core.start_simulation()
+                result = multi_core.result()
+                self.assertEqual([core.instruction_count for core in multi_core.cores], [300, 200])
+                self.assertEqual(result["Total_Cycles"], max(core["Total_Cycles"] for core in result["Cores"]))
+                self.assertEqual(result["L2_access"], sum(core["L2_access"] for core in result["Cores"]))
+                # Page table lines are written by every walk, so both cores keep taking them from each other
+                for core in result["Cores"]:
+                    self.assertGreater(core["Invalidations"], 0)
+                    self.assertLessEqual(core["Coherence_misses"], core["Invalidations"])
+
+
+class LatencyHistogramTest(TraceFixtureTest):
+    def test_buckets(self):
+        histogram = LatencyHistogram(sub_bucket_bits=3, max_bits=20)
+        # Every value falls inside the range of its bucket and the buckets tile the values without gaps
+        previous_high = -1
+        for index in range(len(histogram.counts)):
+            low, high = histogram.bucket_range(index)
+            self.assertEqual(low, previous_high + 1)
+            self.assertEqual((histogram.bucket(low), histogram.bucket(high)), (index, index))
+            self.assertLessEqual(high - low + 1, max(low // 8, 1))
+            previous_high = high
+        # Fixed memory, values past the last bucket are clamped into it
+        self.assertEqual(histogram.bucket(1 << 40), len(histogram.counts) - 1)
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(99), 0)
+        values = list(range(1, 10001))
+        random.Random(0).shuffle(values)
+        for value in values:
+            histogram.record(value)
+        for percent in [50, 90, 99, 99.9]:
+            exact = math.ceil(percent * 100)
+            self.assertGreaterEqual(histogram.percentile(percent), exact)
+            self.assertLessEqual(histogram.percentile(percent), exact * 17 / 16)
+        self.assertEqual(histogram.percentile(100), 10000)
+        self.assertEqual(histogram.percentile(0), 1)
+
+        other = LatencyHistogram()
+        other.record(5, count=10000)
+        histogram.merge(other)
+        self.assertEqual((histogram.count, histogram.min, histogram.max), (20000, 1, 10000))
+        self.assertEqual(histogram.percentile(50), 5)
+
+    def test_simulator(self):
+        simulator = Simulator(SimulatorConfigure(file_path=self.write_trace(seed=2), timing_only=True,
+                                                 latency_histograms=True))
+        simulator.start_simulation()
+        result = simulator.result()
+        latency = result["Latency"]
+        self.assertEqual(list(latency)[-3:], ["served/L1", "served/L2", "served/Memory"])
+        for group in ["op", "tlb", "served"]:
+            histograms = [summary for name, summary in latency.items() if name.startswith(group + "/")]
+            self.assertEqual(sum(summary["count"] for summary in histograms), 300)
+            self.assertEqual(sum(summary["count"] * summary["mean"] for summary in histograms), result["Total_Cycles"])
+        self.assertEqual(latency["tlb/hit"]["count"], result["TLB_hit"])
+        self.assertGreater(latency["tlb/miss"]["p50"], latency["tlb/hit"]["p99.9"])
+
+        simulator.latency.to_csv(os.path.join(self.directory, "latency.csv"))
+        with open(os.path.join(self.directory, "latency.csv")) as file:
+            rows = list(csv.DictReader(file))
+        simulator.latency.to_json(os.path.join(self.directory, "latency.json"))
+        with open(os.path.join(self.directory, "latency.json")) as file:
+            histograms = json.load(file)
+        self.assertEqual([(row["group"], row["name"]) for row in rows],
+                         [(histogram["group"], histogram["name"]) for histogram in histograms])
+        self.assertEqual(int(rows[0]["p99"]), latency["op/MemoryRead"]["p99"])
+        self.assertEqual(sum(count for _, _, count in histograms[0]["buckets"]), latency["op/MemoryRead"]["count"])
+
+
+class PageWalkCacheTest(TraceFixtureTest):
+    def test_fifo(self):
+        page_walk_cache = PageWalkCache(2)
+        for key in range(3):
+            page_walk_cache.update(1, key, key * 10)
+        self.assertIsNone(page_walk_cache.query(1, 0))
+        self.assertEqual(page_walk_cache.query(1, 2), 20)
+        self.assertIsNone(page_walk_cache.query(2, 2))
+        page_walk_cache.flush()
+        self.assertIsNone(page_walk_cache.query(1, 2))
+
+    def test_page_walk(self):
+        simulator = Simulator(SimulatorConfigure(file_path=self.trace_path, page_walk_cache_size=4))
+        reference = Simulator(SimulatorConfigure(file_path=self.trace_path))
+        for address in [0x12345678, 0x12345679, 0x12346678, 0x22345678]:
+            self.assertEqual(simulator.page_walk(address), reference.page_walk(address))
+        self.assertEqual(simulator.pwc_access, 4)
+        self.assertEqual(simulator.pwc_hit, 2)
+
+        # A walk served by the cache only reads the L3 table and writes nothing back
+        l1_access = simulator.l1_access
+        simulator.page_walk(0x12345678)
+        self.assertEqual(simulator.l1_access - l1_access, simulator.multi_page.L3PageTable.page_size //
+                         simulator.config.L1_cacheline_size)
+
+
+class TimingOnlyTest(TraceFixtureTest):
+    def test_timing_only(self):
+        functional = Simulator(SimulatorConfigure(file_path=self.trace_path))
+        functional.start_simulation()
+
+        timing = Simulator(SimulatorConfigure(file_path=self.trace_path, timing_only=True))
+        timing.start_simulation()
+        result = timing.result()
+
+        # Translation does not depend on line payloads
+        self.assertEqual(result["TLB_hit"], functional.tlb_hit)
+        self.assertEqual(result["TLB_access"], functional.tlb_access)
+        self.assertGreater(result["L1_access"], 0)
+
+        # No payload is cached and memory never holds data
+        self.assertEqual(len(timing.cache.L2Cache.data), 0)
+        self.assertTrue(all(entry == () or entry[1] is None for entry in timing.cache.L1DCache.cache))
+        self.assertTrue(all(not page.data for page in timing.memory.allocated_pages.values()))
+
+
+class BinaryTraceTest(TraceFixtureTest):
+    def setUp(self):
+        super().setUp()
+        self.binary_path = convert_din_to_binary(self.trace_path)
+
+    def test_round_trip(self):
+        records = load_binary_trace(self.binary_path)
+        instructions = list(iter_instructions(self.trace_path))
+        self.assertEqual(len(records), len(instructions))
+        for record, instruction in zip(records, instructions):
+            self.assertEqual(record['op'], instruction.op.value)
+            self.assertEqual(record['address'], instruction.address)
+            self.assertEqual(record['value'], instruction.value)
+
+    def test_replay_matches_text(self):
+        text = Simulator(SimulatorConfigure(file_path=self.trace_path))
+        text.start_simulation()
+
+        binary = Simulator(SimulatorConfigure(file_path=self.binary_path))
+        binary.start_simulation()
+        self.assertEqual(binary.result(), text.result())
+
+        decoded = Simulator(SimulatorConfigure(file_path=self.trace_path), load_din(self.trace_path))
+        decoded.start_simulation()
+        self.assertEqual(decoded.result(), text.result())
+
+    def test_decode(self):
+        ops, addresses, values = decode_din(b"2 0 0\r\n1  ABCDEF01 ffffffff\n0 10 7\n")
+        self.assertEqual(ops.tolist(), [2, 1, 0])
+        self.assertEqual(addresses.tolist(), [0, 0xabcdef01, 0x10])
+        self.assertEqual(values.tolist(), [0, 0xffffffff, 7])
+
+        for malformed in [b"2 0\n1 2 3 4\n", b"1 123456789 0\n", b"1 x 0\n"]:
+            with self.assertRaises(ValueError):
+                decode_din(malformed)
+
+
+class SweepTest(TraceFixtureTest):
+
+    def test_grids(self):
+        self.assertEqual(len(case_1_grid()), 72)
+        self.assertEqual(len(case_2_grid()), 108)
+        self.assertEqual(len(case_2_grid(with_opt=True)), 252)
+        # OPT is compared with the other policies in its own case, all of them timed on tags only
+        opt_points = [point for point in case_2_grid(with_opt=True) if point.case == "case2_opt"]
+        self.assertEqual({point.config.timing_only for point in opt_points}, {True})
+        self.assertEqual(len(case_3_grid()), 108)
+        self.assertEqual(len(case_4_grid()), 15)
+        # The victim cache, MSHR and inclusion grids are only run when asked for
+        self.assertEqual(list(DEFAULT_CASES), ["case1", "case2", "case3"])
+        self.assertEqual(list(EXTRA_CASES), ["case4", "case5"])
+        self.assertEqual(len(case_5_grid()), 9)
+
+    def test_modes_not_mixed(self):
+        config = SimulatorConfigure(file_path=self.trace_path)
+        points = [SweepPoint("case", "functional", (0,), config),
+                  SweepPoint("case", "timing", (0,), replace(config, timing_only=True))]
+        with self.assertRaises(AssertionError):
+            run_sweep(points, stream_path=os.path.join(self.directory, "sweep.jsonl"))
+
+    def test_parallel_sweep(self):
+        points = [SweepPoint("case", str(n_way), (n_way,),
+                             SimulatorConfigure(file_path=self.trace_path, L2_n_way=n_way, random_seed=0,
+                                                L2_replace_algorithm=CacheReplaceAlgorithm.Random))
+                  for n_way in [1, 2, 4]]
+        stream_path = os.path.join(self.directory, "sweep.jsonl")
+        total_result = run_sweep(points, stream_path, processes=2)
+
+        for point in points:
+            simulator = Simulator(point.config)
+            simulator.start_simulation()
+            self.assertEqual(total_result["case"][point.group][point.key], simulator.result())
+
+        with open(stream_path) as file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual(sorted(row["key"] for row in rows), [[1], [2], [4]])
+
+    def test_resume_from_store(self):
+        points = [SweepPoint("case", str(n_way), (n_way,), SimulatorConfigure(file_path=self.trace_path, L2_n_way=n_way))
+                  for n_way in [2, 4]]
+        store = ResultStore(os.path.join(self.directory, "store"))
+        stream_path = os.path.join(self.directory, "sweep.jsonl")
+
+        first = run_sweep(points[:1], stream_path, processes=1, store=store)
+        second = run_sweep(points, stream_path, processes=1, store=store)
+        self.assertEqual(second["case"]["2"], first["case"]["2"])
+        self.assertEqual(store.hits, 1)
+
+        # Only the point missing from the store was simulated again
+        with open(stream_path) as file:
+            self.assertEqual([json.loads(line)["key"] for line in file], [[2], [4]])
+
+
+class ResultStoreTest(TraceFixtureTest):
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.directory, "store")
+
+    def test_key(self):
+        config = SimulatorConfigure(file_path=self.trace_path)
+        key = config_key(config)
+        self.assertEqual(config_key(SimulatorConfigure(file_path=self.trace_path)), key)
+        self.assertNotEqual(config_key(SimulatorConfigure(file_path=self.trace_path, TLB_size=8)), key)
+
+        other_path = self.write_trace(seed=1)
+        self.assertNotEqual(config_key(SimulatorConfigure(file_path=other_path)), key)
+
+    def test_put_get_and_evict(self):
+        config = SimulatorConfigure(file_path=self.trace_path)
+        old_store = ResultStore(self.root, version="old")
+        self.assertIsNone(old_store.get(config))
+        old_store.put(config, {"Total_Cycles": 1})
+        self.assertEqual(old_store.get(config), {"Total_Cycles": 1})
+
+        new_store = ResultStore(self.root, version="new")
+        self.assertNotIn(config, new_store)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "old")))
+
+
+class StackDistanceTest(unittest.TestCase):
+    @staticmethod
+    def lru_hits(lines, num_sets, n_way):
+        sets = [OrderedDict() for _ in range(num_sets)]
+        hits = 0
+        for line in lines:
+            cache_set = sets[line % num_sets]
+            if line in cache_set:
+                hits += 1
+                cache_set.move_to_end(line)
+            else:
+                if len(cache_set) == n_way:
+                    cache_set.popitem(last=False)
+                cache_set[line] = True
+        return hits
+
+    def test_profiler_matches_lru(self):
+        rng = random.Random(0)
+        lines = [rng.randint(0, 255) for _ in range(5000)]
+        profiler = StackDistanceProfiler([4, 8, 16], max_ways=8)
+        for line in lines:
+            profiler.access(line)
+        for num_sets in [4, 8, 16]:
+            for n_way in [1, 2, 4, 8]:
+                self.assertEqual(profiler.hits(num_sets, n_way), self.lru_hits(lines, num_sets, n_way))
+
+    def test_profile_hierarchy(self):
+        rng = random.Random(1)
+        ops = [rng.choice([0, 1, 2]) for _ in range(3000)]
+        addresses = [rng.randint(0, 1 << 14) for _ in range(3000)]
+        trace = (np.array(ops, dtype=np.uint8), np.array(addresses, dtype=np.uint32), np.zeros(3000, dtype=np.uint32))
+        result = profile_hierarchy(trace, [32], [1 * Size.KB], [(4 * Size.KB, 2), (8 * Size.KB, 4)], splits=(False,))
+
+        # Reference: a direct mapped L1 in front of plain LRU caches
+        tags = [-1] * 32
+        l1_hits = 0
+        misses = []
+        for address in addresses:
+            line = address >> 5
+            if tags[line % 32] == line:
+                l1_hits += 1
+            else:
+                tags[line % 32] = line
+                misses.append(line)
+
+        for l2_size, n_way in [(4 * Size.KB, 2), (8 * Size.KB, 4)]:
+            stats = result[False][(32, 1 * Size.KB, l2_size, n_way)]
+            self.assertEqual(stats["L1_hit"], l1_hits)
+            self.assertEqual(stats["L2_access"], len(misses))
+            self.assertEqual(stats["L2_hit"], self.lru_hits(misses, l2_size // (32 * n_way), n_way))
+
+    def test_matches_simulator(self):
+        # Line aligned accesses fed to the caches of the simulator directly, so no translation or page walk
+        # comes in between, with a unified L1 and an LRU L2 both count the same hits
+        rng = random.Random(2)
+        ops = [rng.choice([0, 1, 2]) for _ in range(3000)]
+        addresses = [rng.randint(0, 1 << 9) << 5 for _ in range(3000)]
+        trace = (np.array(ops, dtype=np.uint8), np.array(addresses, dtype=np.uint32), np.zeros(3000, dtype=np.uint32))
+        stats = profile_hierarchy(trace, [32], [1 * Size.KB], [(4 * Size.KB, 4)], splits=(False,))[False]
+        stats = stats[(32, 1 * Size.KB, 4 * Size.KB, 4)]
+
+        simulator = Simulator(SimulatorConfigure(file_path='dummy.txt', streaming=True, timing_only=True,
+                                                 separate_instruction_data=False, L1_cache_size=Size.KB,
+                                                 L2_cache_size=4 * Size.KB,
+                                                 L2_replace_algorithm=CacheReplaceAlgorithm.LRU))
+        for op, address in zip(ops, addresses):
+            if op == 1:
+                simulator.simu_write_data(address, bytes(4))
+            else:
+                simulator.simu_read_data(address, 4)
+        self.assertEqual((simulator.l1_hit, simulator.l1_access, simulator.l2_hit, simulator.l2_access),
+                         (stats["L1_hit"], stats["L1_access"], stats["L2_hit"], stats["L2_access"]))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,12 @@
 import math
+import os
 import random
+import sys
 from collections import deque
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Assignment4'))
+from Trace import load_din
+
 # change l2 directcache.py to l2 4 way set associative cache
 memory_access_time = 100  # Time to access memory
 
@@ -82,8 +87,11 @@ class D1CacheSimulator(CacheSimulatorBase):
         parts = trace_line.split()
         op = int(parts[0])  # Operation code is in decimal
         address = int(parts[1], 16)  # Address is in hexadecimal
-        address &= (1 << 32) - 1  # Ensure 32-bit address
         value = int(parts[2], 16)
+        self.process_instruction(op, address, value)
+
+    def process_instruction(self, op, address, value):
+        address &= (1 << 32) - 1  # Ensure 32-bit address
 
         if op == 0 or op == 1:  # Memory read or write
             self.access_cache(address, value)
@@ -156,14 +164,21 @@ class D2CacheSimulator(CacheSimulatorBase):
         return self.hits, self.misses
 
 
-def run_simulator(d1_cache_size, d1_access_time, d2_cache_size, d2_access_time, line_size, trace_file, cache_policy):
+def run_simulator(d1_cache_size, d1_access_time, d2_cache_size, d2_access_time, line_size, trace_file, cache_policy,
+                  trace=None):
     d2_simulator = D2CacheSimulator(d2_cache_size, line_size, cache_policy)
     d1_simulator = D1CacheSimulator(d1_cache_size // 2, line_size, d2_simulator,
                                     cache_policy)  # L1 is split in half between instructions and data.
 
-    with open(trace_file, 'r') as file:
-        for line in file:
-            d1_simulator.process_trace(line)
+    if trace is None:
+        with open(trace_file, 'r') as file:
+            for line in file:
+                d1_simulator.process_trace(line)
+    else:
+        # (op, address, value) arrays decoded once by Trace.load_din
+        ops, addresses, values = trace
+        for op, address, value in zip(ops.tolist(), addresses.tolist(), values.tolist()):
+            d1_simulator.process_instruction(op, address, value)
 
     l1_hits, l1_misses = d1_simulator.report_stats()
     l2_hits, l2_misses = d2_simulator.report_stats()
@@ -185,10 +200,12 @@ if __name__ == '__main__':
 
     # cache_policies = ["Random", "LRU", "FIFO"]
     cache_policy = "FIFO"
+    trace = load_din(trace_file)
 
     for d1_cache_size, d1_access_time in d1_cache_sizes:
         for d2_cache_size, d2_access_time in d2_cache_sizes:
             for line_size in line_sizes:
                 # for cache_policy in cache_policies:
-                run_simulator(d1_cache_size, d1_access_time, d2_cache_size, d2_access_time, line_size, trace_file, cache_policy)
+                run_simulator(d1_cache_size, d1_access_time, d2_cache_size, d2_access_time, line_size, trace_file, cache_policy,
+                              trace)
                 print("-------------------------------------")